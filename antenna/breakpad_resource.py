@@ -18,6 +18,7 @@ from falcon.request_helpers import BoundedStream
 from gevent.pool import Pool
 import markus
 
+from antenna.dedupe import DEDUPE_FAKEACCEPT, DEDUPE_ORIGINAL, DuplicateDetector
 from antenna.heartbeat import register_for_life, register_for_heartbeat
 from antenna.throttler import (
     REJECT,
@@ -141,6 +142,7 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
         self.crashstorage = self.config('crashstorage_class')(config.with_namespace('crashstorage'))
         self.crashpublish = self.config('crashpublish_class')(config.with_namespace('crashpublish'))
         self.throttler = Throttler(config)
+        self.dedupe = DuplicateDetector(config)
 
         # Gevent pool for crashmover workers
         self.crashmover_pool = Pool(size=self.config('concurrent_crashmovers'))
@@ -163,6 +165,9 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
         for item in self.throttler.get_runtime_config():
             yield item
 
+        for item in self.dedupe.get_runtime_config():
+            yield item
+
         for item in self.crashstorage.get_runtime_config(['crashstorage']):
             yield item
 
@@ -171,6 +176,7 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
 
     def check_health(self, state):
         """Return health state."""
+        self.throttler.check_health(state)
         if hasattr(self.crashstorage, 'check_health'):
             self.crashstorage.check_health(state)
         if hasattr(self.crashpublish, 'check_health'):
@@ -183,6 +189,10 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
         # up means impending doom
         mymetrics.gauge('work_queue_size', value=len(self.crashmover_queue))
 
+        # Whether crashmovers are paused because crash storage can't take
+        # crashes right now
+        mymetrics.gauge('crashmover_paused', value=int(self.crashstorage.is_paused()))
+
     def has_work_to_do(self):
         """Return whether this still has work to do."""
         work_to_do = (
@@ -380,6 +390,20 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
         }
         raw_crash['MinidumpSha256Hash'] = raw_crash['dump_checksums'].get('upload_file_minidump', '')
 
+        # If this crash report was already submitted, maybe don't save it again
+        original_crash_id = self.dedupe.find_original(raw_crash)
+        if original_crash_id is not None:
+            if self.dedupe.action == DEDUPE_ORIGINAL:
+                logger.info('%s: duplicate; returned original crash id', original_crash_id)
+                resp.body = 'CrashID=%s%s\n' % (self.config('dump_id_prefix'), original_crash_id)
+                return
+
+            if self.dedupe.action == DEDUPE_FAKEACCEPT:
+                crash_id = create_crash_id(timestamp=current_timestamp, throttle_result=FAKEACCEPT)
+                logger.info('%s: duplicate of %s; fake accepted', crash_id, original_crash_id)
+                resp.body = 'CrashID=%s%s\n' % (self.config('dump_id_prefix'), crash_id)
+                return
+
         # First throttle the crash which gives us the information we need
         # to generate a crash id.
         throttle_result, rule_name, percentage = self.get_throttle_result(raw_crash)
@@ -417,6 +441,7 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
         else:
             # If the result is not REJECT, then save it and return the CrashID to
             # the client
+            self.dedupe.add(raw_crash, crash_id)
             crash_report = CrashReport(raw_crash, dumps, crash_id)
             crash_report.set_state(STATE_SAVE)
             self.crashmover_queue.append(crash_report)
@@ -426,8 +451,12 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
     def hb_run_crashmover(self):
         """Spawn a crashmover if there's work to do."""
         # Spawn a new crashmover if there's stuff in the queue and we haven't
-        # hit the limit of how many we can run
-        if self.crashmover_queue and self.crashmover_pool.free_count() > 0:
+        # hit the limit of how many we can run and crash storage isn't paused
+        if (
+                self.crashmover_queue and
+                self.crashmover_pool.free_count() > 0 and
+                not self.crashstorage.is_paused()
+        ):
             self.crashmover_pool.spawn(self.crashmover_process_queue)
 
     def crashmover_process_queue(self):
@@ -437,8 +466,15 @@ class BreakpadSubmitterResource(RequiredConfigMixin):
         If there's any kind of problem, this must return the crash report to
         the relevant queue.
 
+        If crash storage is paused, this stops and leaves crash reports in the
+        queue. The heartbeat spawns a new crashmover when it's unpaused.
+
         """
         while self.crashmover_queue:
+            if self.crashstorage.is_paused():
+                logger.warning('crash storage is paused; leaving crashes in the queue')
+                return
+
             crash_report = self.crashmover_queue.popleft()
 
             try:
@@ -0,0 +1,199 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Detects crash reports that were already submitted.
+
+Clients retry submitting crash reports when they don't get a response and
+users resubmit crash reports from ``about:crashes``. Resubmitted crash
+reports have the ``uuid`` of the original crash report. Retried crash reports
+have the same minidump and so the same ``MinidumpSha256Hash``.
+
+"""
+
+import logging
+import time
+
+from everett.component import ConfigOptions, RequiredConfigMixin
+from everett.manager import parse_class
+import markus
+
+from antenna.heartbeat import register_for_heartbeat
+from antenna.util import LRUCache, validate_crash_id
+
+
+logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('dedupe')
+
+
+#: Don't check for duplicates
+DEDUPE_OFF = 'off'
+
+#: Count duplicates, but save them anyway
+DEDUPE_COUNT = 'count'
+
+#: Don't save duplicates and return the original crash id
+DEDUPE_ORIGINAL = 'original'
+
+#: Don't save duplicates and return a new crash id
+DEDUPE_FAKEACCEPT = 'fakeaccept'
+
+DEDUPE_ACTIONS = (DEDUPE_OFF, DEDUPE_COUNT, DEDUPE_ORIGINAL, DEDUPE_FAKEACCEPT)
+
+
+def parse_dedupe_action(val):
+    """Everett parser for dedupe actions."""
+    val = val.strip().lower()
+    if val not in DEDUPE_ACTIONS:
+        raise ValueError('%r is not one of %s' % (val, ', '.join(DEDUPE_ACTIONS)))
+    return val
+
+
+class MemoryDuplicateStore(RequiredConfigMixin):
+    """Keeps recently saved crash ids in memory.
+
+    Each process has its own store, so a duplicate that goes to a different
+    process or node isn't detected. A store shared between processes can
+    implement ``get``, ``set`` and ``__len__`` and be set with
+    ``DEDUPE_STORE_CLASS``.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'dedupe_max_entries',
+        default='100000',
+        parser=int,
+        doc='Maximum number of keys to remember.'
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+
+        # key -> (crash id, time it expires)
+        self.entries = LRUCache(self.config('dedupe_max_entries'))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the crash id for key or None if it's not there or expired."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        crash_id, expires = entry
+        if expires <= time.monotonic():
+            del self.entries[key]
+            return None
+        return crash_id
+
+    def set(self, key, crash_id, ttl):
+        """Remember the crash id for key for ttl seconds."""
+        self.entries[key] = (crash_id, time.monotonic() + ttl)
+
+
+class DuplicateDetector(RequiredConfigMixin):
+    """Detects crash reports that were already submitted.
+
+    Crash reports are duplicates if they have the ``uuid`` of a crash report
+    that was saved or the same ``MinidumpSha256Hash`` as one in the last
+    ``DEDUPE_WINDOW`` seconds.
+
+    ``DEDUPE_ACTION`` is one of:
+
+    ``off``
+        Don't check for duplicates. This is the default.
+
+    ``count``
+        Count duplicates, but save them anyway. Use this to see how many
+        duplicates there are before doing anything about them.
+
+    ``original``
+        Don't save duplicates and return the crash id of the original crash
+        report.
+
+    ``fakeaccept``
+        Don't save duplicates and return a new crash id like ``FAKEACCEPT``.
+
+    This sends ``dedupe.unique`` and ``dedupe.duplicate`` counters (tagged
+    with the key that matched) so you can see the dedupe rate.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'dedupe_action',
+        default=DEDUPE_OFF,
+        parser=parse_dedupe_action,
+        doc='What to do with duplicate crash reports: %s' % ', '.join(DEDUPE_ACTIONS)
+    )
+    required_config.add_option(
+        'dedupe_window',
+        default='3600',
+        parser=int,
+        doc='Number of seconds to remember crash reports for.'
+    )
+    required_config.add_option(
+        'dedupe_store_class',
+        default='antenna.dedupe.MemoryDuplicateStore',
+        parser=parse_class,
+        doc='Class for storing keys of recently saved crash reports.'
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.action = self.config('dedupe_action')
+        self.window = self.config('dedupe_window')
+        self.store = self.config('dedupe_store_class')(config)
+
+        if self.is_enabled():
+            register_for_heartbeat(self.hb_report_health_stats)
+
+    def get_runtime_config(self, namespace=None):
+        """Return generator for items in runtime configuration."""
+        for item in super().get_runtime_config(namespace):
+            yield item
+
+        for item in self.store.get_runtime_config(namespace):
+            yield item
+
+    def is_enabled(self):
+        """Return whether duplicates are checked for."""
+        return self.action != DEDUPE_OFF
+
+    def get_keys(self, raw_crash):
+        """Return list of (key type, key) for a crash report."""
+        keys = []
+        crash_id = raw_crash.get('uuid')
+        if crash_id and validate_crash_id(crash_id):
+            keys.append(('uuid', 'uuid:%s' % crash_id))
+        minidump_hash = raw_crash.get('MinidumpSha256Hash')
+        if minidump_hash:
+            keys.append(('minidump_hash', 'minidump_hash:%s' % minidump_hash))
+        return keys
+
+    def find_original(self, raw_crash):
+        """Return the crash id of the original if this is a duplicate or None."""
+        if not self.is_enabled():
+            return None
+
+        for key_type, key in self.get_keys(raw_crash):
+            crash_id = self.store.get(key)
+            if crash_id is not None:
+                mymetrics.incr('duplicate', tags=['key:%s' % key_type, 'action:%s' % self.action])
+                return crash_id
+
+        mymetrics.incr('unique')
+        return None
+
+    def add(self, raw_crash, crash_id):
+        """Remember a crash report that's being saved."""
+        if not self.is_enabled():
+            return
+
+        for key_type, key in self.get_keys(raw_crash):
+            self.store.set(key, crash_id, self.window)
+
+    def hb_report_health_stats(self):
+        """Heartbeat function to report the number of remembered keys."""
+        mymetrics.gauge('entries', value=len(self.store))
@@ -5,18 +5,133 @@
 import logging
 
 from everett.component import ConfigOptions, RequiredConfigMixin
+from everett.manager import parse_bool
+import markus
+
+from antenna.throttler import ACCEPT, DEFER
 
 
 logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('crashpublish')
+
+
+#: Throttle results that can be in routes; other results are never published
+ROUTE_RESULTS = {
+    'ACCEPT': ACCEPT,
+    'DEFER': DEFER,
+}
+
+
+def parse_routes(val):
+    """Everett parser for crash publish routes.
+
+    Routes are comma-separated ``CONDITIONS:DESTINATION`` items. Conditions
+    are separated by ``&`` and are either a throttle result (``ACCEPT`` or
+    ``DEFER``) or ``KEY=VALUE`` for an annotation in the raw crash. For
+    example::
+
+        DEFER:socorro_deferred,ACCEPT&ProductName=Fenix:socorro_fenix
+
+    :returns: list of ``(conditions, destination)`` where conditions is a
+        tuple of ``(raw crash key, value)``
+
+    """
+    routes = []
+    for item in val.split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        conditions, sep, destination = item.rpartition(':')
+        destination = destination.strip()
+        if not sep or not conditions.strip() or not destination:
+            raise ValueError('route %r is not CONDITIONS:DESTINATION' % item)
+
+        parsed = []
+        for condition in conditions.split('&'):
+            condition = condition.strip()
+            if condition in ROUTE_RESULTS:
+                parsed.append(('legacy_processing', ROUTE_RESULTS[condition]))
+            elif '=' in condition:
+                key, value = condition.split('=', 1)
+                if not key.strip():
+                    raise ValueError('route condition %r has no key' % condition)
+                parsed.append((key.strip(), value.strip()))
+            else:
+                raise ValueError(
+                    'route condition %r is not %s or KEY=VALUE' % (
+                        condition, ' or '.join(sorted(ROUTE_RESULTS))
+                    )
+                )
+
+        routes.append((tuple(parsed), destination))
+    return routes
 
 
 class CrashPublishBase(RequiredConfigMixin):
-    """Crash publishstorage base class."""
+    """Crash publishstorage base class.
+
+    Crash ids can be routed to different destinations (for example, Pub/Sub
+    topics) by throttle result and annotations with ``ROUTES``. The first
+    route whose conditions all match the crash is used. Crashes that match no
+    route go to the publisher's default destination.
+
+    If ``PUBLISH_DEFER`` is false, crashes the throttler deferred are saved,
+    but not published, so downstream consumers don't have to fetch and throw
+    them out.
+
+    Subclasses should call ``should_publish()`` and ``get_destination()`` in
+    ``publish_crash()``.
+
+    """
 
     required_config = ConfigOptions()
+    required_config.add_option(
+        'routes',
+        default='',
+        parser=parse_routes,
+        doc=(
+            'Comma-separated list of CONDITIONS:DESTINATION routes. CONDITIONS are '
+            'ACCEPT, DEFER or KEY=VALUE for an annotation, separated by &. Crashes '
+            'that match no route go to the default destination.'
+        )
+    )
+    required_config.add_option(
+        'publish_defer',
+        default='true',
+        parser=parse_bool,
+        doc='Whether to publish crashes the throttler deferred.'
+    )
 
     def __init__(self, config):
         self.config = config.with_options(self)
+        self.routes = self.config('routes')
+        self.publish_defer = self.config('publish_defer')
+
+    def get_destinations(self):
+        """Return the set of destinations in routes."""
+        return {destination for conditions, destination in self.routes}
+
+    def should_publish(self, crash_report):
+        """Return whether the crash report should be published."""
+        if not self.publish_defer and crash_report.raw_crash.get('legacy_processing') == DEFER:
+            logger.info('%s: deferred; not published', crash_report.crash_id)
+            mymetrics.incr('skipped', tags=['result:defer'])
+            return False
+        return True
+
+    def get_destination(self, crash_report):
+        """Return the destination for the crash report.
+
+        :returns: the destination of the first route that matches or None for
+            the default destination
+
+        """
+        raw_crash = crash_report.raw_crash
+        for conditions, destination in self.routes:
+            if all(raw_crash.get(key) == value for key, value in conditions):
+                return destination
+        return None
 
     def publish_crash(self, crash_report):
         """Publish the crash id.
@@ -37,7 +152,8 @@ class NoOpCrashPublish(CrashPublishBase):
 
     It keeps track of the last 10 crash ids in ``.published_things`` instance
     attribute with the most recently published crash id at the end of the list.
-    This helps when writing unit tests for Antenna.
+    Crash ids that were routed have the ``destination``, too. This helps when
+    writing unit tests for Antenna.
 
     """
 
@@ -47,9 +163,16 @@ class NoOpCrashPublish(CrashPublishBase):
 
     def publish_crash(self, crash_report):
         """Publish the crash id."""
+        if not self.should_publish(crash_report):
+            return
+
         crash_id = crash_report.crash_id
-        logger.info('crash publish no-op: %s', crash_id)
-        self.published_things.append({'crash_id': crash_id})
+        destination = self.get_destination(crash_report)
+        logger.info('crash publish no-op: %s (%s)', crash_id, destination or 'default')
+        if destination is None:
+            self.published_things.append({'crash_id': crash_id})
+        else:
+            self.published_things.append({'crash_id': crash_id, 'destination': destination})
 
         # Nix all but the last 10 crashes
         self.published_things = self.published_things[-10:]
@@ -22,6 +22,16 @@ class CrashStorageBase(RequiredConfigMixin):
         """Save the crash report."""
         raise NotImplementedError
 
+    def is_paused(self):
+        """Return whether crashmovers should stop saving crashes for now.
+
+        Crash storage that can't take more crashes for a while (for example,
+        because the disk is full) should return True. Crashes wait in the
+        queue until this returns False again.
+
+        """
+        return False
+
 
 class NoOpCrashStorage(CrashStorageBase):
     """This is a no-op crash storage that logs crashes it would have stored.
@@ -5,14 +5,259 @@
 import logging
 import os
 import os.path
+import tempfile
+import time
 
 from everett.component import ConfigOptions
+import gevent
+from gevent.event import Event
+from gevent.threadpool import ThreadPool
+import markus
 
 from antenna.ext.crashstorage_base import CrashStorageBase
-from antenna.util import get_date_from_crash_id, json_ordered_dumps
+from antenna.ext.fs.layout import FSLayout, get_crash_hour
+from antenna.ext.fs.retention import FSRetention
+from antenna.heartbeat import register_for_heartbeat
+from antenna.util import json_ordered_dumps
 
 
 logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('fscrashstorage')
+
+
+#: Fsync modes
+FSYNC_NONE = 'none'
+FSYNC_ALWAYS = 'always'
+FSYNC_GROUP = 'group'
+
+
+def parse_fsync_mode(val):
+    """Everett parser for fsync modes."""
+    if val not in (FSYNC_NONE, FSYNC_ALWAYS, FSYNC_GROUP):
+        raise ValueError('%r is not a valid fsync mode' % val)
+    return val
+
+
+def fsync_dir(path):
+    """Fsync a directory so renames in it are durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def make_dirs(path, fsync):
+    """Make a directory and any missing parents.
+
+    If ``fsync`` is True, this fsyncs the parent of each directory it makes so
+    the new directory is durable, too.
+
+    """
+    missing = []
+    while not os.path.isdir(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+
+    for path in reversed(missing):
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            # Another worker made it at the same time; it might not have
+            # fsynced the parent yet, so we still do
+            pass
+        if fsync:
+            fsync_dir(os.path.dirname(path))
+
+
+class PendingFile:
+    """A file written to a temp file that hasn't been renamed into place yet."""
+
+    def __init__(self, fp, tmp_path, path):
+        self.fp = fp
+        self.tmp_path = tmp_path
+        self.path = path
+
+    def commit(self, fsync):
+        """Close the temp file and rename it into place."""
+        try:
+            if fsync:
+                os.fsync(self.fp.fileno())
+        finally:
+            self.fp.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        """Close and remove the temp file if it's still there."""
+        self.fp.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+def commit_files(pending_files, fsync):
+    """Rename pending files into place in order.
+
+    If ``fsync`` is True, this fsyncs every file before renaming it and then
+    fsyncs every directory that has new files once.
+
+    If anything fails, the remaining temp files are removed and the exception
+    is re-raised.
+
+    """
+    for i, pending_file in enumerate(pending_files):
+        try:
+            pending_file.commit(fsync=fsync)
+        except Exception:
+            for remaining_file in pending_files[i:]:
+                remaining_file.abort()
+            raise
+
+    if fsync:
+        directories = []
+        for pending_file in pending_files:
+            directory = os.path.dirname(pending_file.path)
+            if directory not in directories:
+                directories.append(directory)
+
+        for directory in directories:
+            fsync_dir(directory)
+
+
+def run_in_threadpool(threadpool, metrics, fun, *args, **kwargs):
+    """Call a function in a threadpool and wait for it to return.
+
+    This emits the time the call waited in the queue as
+    ``threadpool.queue_wait``.
+
+    :arg threadpool: a ``gevent.threadpool.ThreadPool`` or None to call the
+        function in the calling greenlet
+    :arg metrics: the markus metrics interface to emit timings with
+    :arg fun: the function to call
+
+    """
+    if threadpool is None:
+        return fun(*args, **kwargs)
+
+    queued_time = time.time()
+    start_times = []
+
+    def run():
+        start_times.append(time.time())
+        return fun(*args, **kwargs)
+
+    try:
+        return threadpool.apply(run)
+    finally:
+        if start_times:
+            # NOTE: time.time returns seconds, but .timing() wants
+            # milliseconds, so we multiply!
+            metrics.timing(
+                'threadpool.queue_wait',
+                value=(start_times[0] - queued_time) * 1000
+            )
+
+
+class CommitBatch:
+    """Files that get fsynced and renamed into place together."""
+
+    def __init__(self):
+        self.files = []
+        self.done = Event()
+        self.exc = None
+
+
+class GroupCommitter:
+    """Batches fsyncs for files written within a short window.
+
+    The first writer to add files to an empty batch schedules a commit for
+    ``window`` seconds later. Writers that come in before then add their files
+    to the same batch. At commit time, every file in the batch is fsynced and
+    renamed into place and then every directory that has new files is fsynced
+    once. Writers block until the batch they're in is committed.
+
+    :arg float window: seconds to wait for more files before committing
+    :arg run: function to call ``commit_files`` with; this lets the caller
+        run it in a threadpool
+
+    """
+
+    def __init__(self, window, run=None):
+        self.window = window
+        self.run = run or (lambda fun, *args, **kwargs: fun(*args, **kwargs))
+        self.batch = None
+
+    def commit(self, pending_files):
+        """Commit files and return when they're durable.
+
+        :arg list pending_files: list of ``PendingFile`` instances in the order
+            they should be renamed into place
+
+        :raises OSError: if fsyncing or renaming failed
+
+        """
+        if self.batch is None:
+            self.batch = CommitBatch()
+            gevent.spawn_later(self.window, self._commit_batch, self.batch)
+
+        batch = self.batch
+        batch.files.extend(pending_files)
+        batch.done.wait()
+        if batch.exc is not None:
+            raise batch.exc
+
+    def _commit_batch(self, batch):
+        # New writers go into a new batch
+        self.batch = None
+
+        start_time = time.time()
+        try:
+            self.run(commit_files, batch.files, fsync=True)
+        except Exception as exc:
+            logger.exception('Exception when committing files')
+            batch.exc = exc
+
+        finally:
+            mymetrics.histogram('group_commit.batch_size', value=len(batch.files))
+            # NOTE: time.time returns seconds, but .timing() wants
+            # milliseconds, so we multiply!
+            mymetrics.timing('group_commit.time', value=(time.time() - start_time) * 1000)
+            batch.done.set()
+
+
+class DirectoryCache:
+    """Remembers directories that have been created, grouped by date.
+
+    Crashes are saved into ``<FS_ROOT>/<YYYYMMDD>/`` directories, so most
+    directories stop being used after a day. This only keeps directories for
+    the most recent ``max_dates`` dates.
+
+    :arg int max_dates: the number of dates to keep directories for
+
+    """
+
+    def __init__(self, max_dates=3):
+        self.max_dates = max_dates
+        self.dates = {}
+
+    def __contains__(self, key):
+        date, path = key
+        return path in self.dates.get(date, ())
+
+    def add(self, date, path):
+        """Remember a directory exists."""
+        self.dates.setdefault(date, set()).add(path)
+        while len(self.dates) > self.max_dates:
+            del self.dates[min(self.dates)]
+
+    def discard(self, date, path):
+        """Forget about a directory."""
+        self.dates.get(date, set()).discard(path)
+
+    def clear(self):
+        """Forget about all directories."""
+        self.dates.clear()
 
 
 class FSCrashStorage(CrashStorageBase):
@@ -32,16 +277,46 @@ class FSCrashStorage(CrashStorageBase):
                 <DUMP_NAME>/
                     <CRASHID>
 
+    Date directories can be partitioned further by hour and crash id. See
+    ``FSLayout`` for details. Readers should use ``FSLayout`` to find files.
 
     Couple of things to note:
 
-    1. This doesn't ever delete anything from the tree. You should run another
-       process to clean things up.
+    1. This doesn't delete anything from the tree unless retention limits are
+       set. See ``FSRetention``.
 
     2. If you run out of disk space, this component will fail miserably.
        There's no way to recover from a full disk--you will lose crashes.
 
-    FIXME(willkg): Can we alleviate or reduce the likelihood of the above?
+    To reduce the likelihood of the above, the heartbeat checks free space
+    and free inodes on ``FS_ROOT`` and emits them as gauges. If either is
+    below ``SOFT_WATERMARK`` percent, the node reports itself as unhealthy.
+    If either is below ``HARD_WATERMARK`` percent, crash storage is paused:
+    crashmovers stop saving crashes and they wait in the queue until there's
+    free space again.
+
+    Files are written to a temp file in the same directory and then renamed
+    into place, so readers never see partially written files. Temp files start
+    with a ``.``--skip those when reading the tree.
+
+    ``FSYNC_MODE`` determines when data is fsynced:
+
+    * ``none``: never; a power loss can lose recently saved crashes
+    * ``always``: every file and directory is fsynced before the save returns
+    * ``group``: files from all crashes saved within ``GROUP_COMMIT_WINDOW``
+      seconds are fsynced together and saves return once their files are
+      durable; this is a lot faster than ``always`` when saving many crashes
+
+    File system calls that can block (making directories, writing, fsyncing
+    and renaming) run in a pool of ``THREADPOOL_SIZE`` native threads so a
+    slow disk doesn't block the gevent hub and everything else the process
+    is doing. Set ``THREADPOOL_SIZE`` to 0 to make those calls in the
+    calling greenlet.
+
+    Directories that have been created are cached for the most recent few
+    dates, so saving a crash usually doesn't need to check whether its
+    directories exist. If something removes a cached directory, the cache is
+    cleared and the directory is created again.
 
     """
 
@@ -51,65 +326,275 @@ class FSCrashStorage(CrashStorageBase):
         default='/tmp/antenna_crashes',  # nosec
         doc='path to where files should be stored'
     )
-
-    # FIXME(willkg): umask
+    required_config.add_option(
+        'fsync_mode',
+        default=FSYNC_NONE,
+        parser=parse_fsync_mode,
+        doc='When to fsync saved files: ``none``, ``always`` or ``group``'
+    )
+    required_config.add_option(
+        'group_commit_window',
+        default='0.01',
+        parser=float,
+        doc='Seconds to batch files for before fsyncing them in ``group`` fsync mode'
+    )
+    required_config.add_option(
+        'soft_watermark',
+        default='10',
+        parser=float,
+        doc=(
+            'Percent of free space or free inodes on fs_root below which the '
+            'node is unhealthy'
+        )
+    )
+    required_config.add_option(
+        'hard_watermark',
+        default='2',
+        parser=float,
+        doc=(
+            'Percent of free space or free inodes on fs_root below which crash '
+            'storage is paused'
+        )
+    )
+    required_config.add_option(
+        'threadpool_size',
+        default='4',
+        parser=int,
+        doc=(
+            'Number of native threads for blocking file system calls; 0 makes '
+            'them in the calling greenlet'
+        )
+    )
 
     def __init__(self, config):
         self.config = config.with_options(self)
 
         self.root = os.path.abspath(self.config('fs_root')).rstrip(os.sep)
+        self.fsync_mode = self.config('fsync_mode')
+        threadpool_size = self.config('threadpool_size')
+        self.threadpool = ThreadPool(threadpool_size) if threadpool_size > 0 else None
+        self.group_committer = GroupCommitter(
+            self.config('group_commit_window'),
+            run=self._run_in_threadpool
+        )
+
+        # Percent of free space and free inodes on fs_root from the last check
+        # or None if it hasn't been checked yet
+        self.free_space = None
+        self.free_inodes = None
+        self.paused = False
+        self.dir_cache = DirectoryCache()
+        self.layout = FSLayout(config)
+
+        # Temp files are created with 0600, so we fix the mode to what open()
+        # would have created the file with
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode = 0o666 & ~umask
 
         # FIXME(willkg): We should probably do more to validate fs_root. Can we
         # write files to it?
         if not os.path.isdir(self.root):
             os.makedirs(self.root)
 
-    def _get_raw_crash_path(self, crash_id):
+        register_for_heartbeat(self.hb_check_free_space)
+
+        self.retention = FSRetention(config, run_blocking=self._run_in_threadpool)
+        if self.retention.is_enabled():
+            register_for_heartbeat(self.retention.hb_run)
+
+    def get_runtime_config(self, namespace=None):
+        """Return generator for items in runtime configuration."""
+        for item in super().get_runtime_config(namespace):
+            yield item
+
+        for item in self.layout.get_runtime_config(namespace):
+            yield item
+
+        for item in self.retention.get_runtime_config(namespace):
+            yield item
+
+    def get_free_space(self):
+        """Return percent of free space and free inodes on fs_root."""
+        stat = self._run_in_threadpool(os.statvfs, self.root)
+        # NOTE: Some file systems don't have a fixed number of inodes
+        # and report 0 for f_files
+        free_space = 100.0 * stat.f_bavail / stat.f_blocks if stat.f_blocks else 100.0
+        free_inodes = 100.0 * stat.f_favail / stat.f_files if stat.f_files else 100.0
+        return free_space, free_inodes
+
+    def hb_check_free_space(self):
+        """Heartbeat function to check free space and pause if it's too low."""
+        try:
+            self.free_space, self.free_inodes = self.get_free_space()
+        except OSError:
+            logger.exception('Threw exception while trying to check free space on %r', self.root)
+            return
+
+        mymetrics.gauge('free_space_percent', value=self.free_space)
+        mymetrics.gauge('free_inodes_percent', value=self.free_inodes)
+
+        paused = min(self.free_space, self.free_inodes) < self.config('hard_watermark')
+        if paused and not self.paused:
+            logger.error(
+                'Free space on %r below hard watermark: %.1f%% space, %.1f%% inodes; pausing',
+                self.root, self.free_space, self.free_inodes
+            )
+        elif self.paused and not paused:
+            logger.info('Free space on %r above hard watermark; unpausing', self.root)
+        self.paused = paused
+
+    def is_paused(self):
+        """Return whether free space is below the hard watermark."""
+        return self.paused
+
+    def check_health(self, state):
+        """Check free space on fs_root."""
+        if self.free_space is None:
+            return
+
+        state.add_statsd(self, 'free_space_percent', self.free_space)
+        state.add_statsd(self, 'free_inodes_percent', self.free_inodes)
+        if min(self.free_space, self.free_inodes) < self.config('soft_watermark'):
+            state.add_error(
+                'FSCrashStorage',
+                'Free space on %r below soft watermark: %.1f%% space, %.1f%% inodes' % (
+                    self.root, self.free_space, self.free_inodes
+                )
+            )
+
+    def _get_raw_crash_path(self, crash_id, hour=None):
         """Return path for where the raw crash should go."""
-        return os.path.join(
-            self.root,
-            get_date_from_crash_id(crash_id),
-            'raw_crash',
-            crash_id + '.json'
-        )
+        return self.layout.get_raw_crash_path(crash_id, hour)
 
-    def _get_dump_names_path(self, crash_id):
+    def _get_dump_names_path(self, crash_id, hour=None):
         """Return path for where the dump_names list should go."""
-        return os.path.join(
-            self.root,
-            get_date_from_crash_id(crash_id),
-            'dump_names',
-            crash_id + '.json'
-        )
+        return self.layout.get_dump_names_path(crash_id, hour)
 
-    def _get_dump_name_path(self, crash_id, dump_name):
+    def _get_dump_name_path(self, crash_id, dump_name, hour=None):
         """Return path for a given dump."""
-        return os.path.join(
-            self.root,
-            get_date_from_crash_id(crash_id),
-            dump_name,
-            crash_id
-        )
+        return self.layout.get_dump_path(crash_id, dump_name, hour)
 
-    def _save_file(self, fn, contents):
-        logger.debug('Saving file %r', fn)
-        path = os.path.dirname(fn)
+    def _run_in_threadpool(self, fun, *args, **kwargs):
+        """Call a function in the threadpool and wait for it to return."""
+        return run_in_threadpool(self.threadpool, mymetrics, fun, *args, **kwargs)
+
+    def _ensure_dir(self, path):
+        """Make sure a directory exists.
+
+        :returns: True if the directory exists and False if it couldn't be
+            created
+
+        """
+        date = os.path.relpath(path, self.root).split(os.sep)[0]
+        if (date, path) in self.dir_cache:
+            return True
 
         # FIXME(willkg): What happens if there is something here already and
         # it's not a directory?
-        if not os.path.exists(path):
-            try:
-                os.makedirs(path)
-            except OSError:
-                logger.exception('Threw exception while trying to make path %r', path)
-                # FIXME(willkg): If we ever make this production-ready, we
-                # need a better option here.
-                return
+        try:
+            # Files are only durable if the directories they're in are, so
+            # fsync the parents of new directories; this happens once per
+            # directory because of the directory cache
+            self._run_in_threadpool(make_dirs, path, fsync=self.fsync_mode != FSYNC_NONE)
+        except OSError:
+            logger.exception('Threw exception while trying to make path %r', path)
+            # FIXME(willkg): If we ever make this production-ready, we
+            # need a better option here.
+            return False
+
+        self.dir_cache.add(date, path)
+        return True
+
+    def _ensure_dirs(self, files):
+        """Make sure directories for files exist.
+
+        :returns: list of ``(path, contents)`` for files whose directory exists
+
+        """
+        files_to_write = []
+        for fn, contents in files:
+            logger.debug('Saving file %r', fn)
+            if self._ensure_dir(os.path.dirname(fn)):
+                files_to_write.append((fn, contents))
+        return files_to_write
+
+    def _write_temp_file(self, fn, contents):
+        """Write contents to a temp file next to fn and return a PendingFile.
+
+        NOTE: This runs in the threadpool, so it shouldn't log, emit
+        metrics or touch anything the hub uses.
+
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(fn), prefix='.' + os.path.basename(fn) + '.'
+        )
+        fp = os.fdopen(fd, 'wb')
+        try:
+            os.fchmod(fd, self.file_mode)
+            fp.write(contents)
+            fp.flush()
+        except Exception:
+            PendingFile(fp, tmp_path, fn).abort()
+            raise
+        return PendingFile(fp, tmp_path, fn)
+
+    def _save_files(self, files):
+        """Save files atomically and fsync them according to fsync mode.
+
+        :arg list files: list of ``(path, contents)`` tuples in the order they
+            should appear in the tree
+
+        """
+        try:
+            pending_files = self._run_in_threadpool(self._write_temp_files, self._ensure_dirs(files))
+        except FileNotFoundError:
+            # A directory was removed after we cached it, so forget about the
+            # cached directories and try again
+            self.dir_cache.clear()
+            pending_files = self._run_in_threadpool(self._write_temp_files, self._ensure_dirs(files))
+
+        if self.fsync_mode == FSYNC_GROUP:
+            self.group_committer.commit(pending_files)
+            return
 
         # FIXME(willkg): This will stomp on existing crashes. Is that ok?
         # Should we detect and do something different somehow?
-        with open(fn, 'wb') as fp:
-            fp.write(contents)
+        self._run_in_threadpool(commit_files, pending_files, fsync=self.fsync_mode == FSYNC_ALWAYS)
+
+    def _write_temp_files(self, files):
+        pending_files = []
+        try:
+            for fn, contents in files:
+                pending_files.append(self._write_temp_file(fn, contents))
+        except Exception:
+            for pending_file in pending_files:
+                pending_file.abort()
+            raise
+        return pending_files
+
+    def _save_file(self, fn, contents):
+        self._save_files([(fn, contents)])
+
+    def _get_raw_crash_files(self, crash_id, raw_crash, hour):
+        return [
+            (self._get_raw_crash_path(crash_id, hour), json_ordered_dumps(raw_crash).encode('utf-8'))
+        ]
+
+    def _get_dumps_files(self, crash_id, dumps, hour):
+        # Add dump_names to the list of files to save. We always generate this
+        # even if there are no dumps.
+        files = [
+            (
+                self._get_dump_names_path(crash_id, hour),
+                json_ordered_dumps(list(sorted(dumps.keys()))).encode('utf-8')
+            )
+        ]
+
+        # Add the dump files if there are any.
+        for dump_name, dump in dumps.items():
+            files.append((self._get_dump_name_path(crash_id, dump_name, hour), dump))
+        return files
 
     def save_raw_crash(self, crash_id, raw_crash):
         """Save the raw crash and related dumps.
@@ -120,27 +605,18 @@ class FSCrashStorage(CrashStorageBase):
         :arg dict raw_crash: dict The raw crash as a dict.
 
         """
-        self._save_file(self._get_raw_crash_path(crash_id), json_ordered_dumps(raw_crash).encode('utf-8'))
+        self._save_files(self._get_raw_crash_files(crash_id, raw_crash, get_crash_hour(raw_crash)))
 
-    def save_dumps(self, crash_id, dumps):
+    def save_dumps(self, crash_id, dumps, raw_crash=None):
         """Save dump data.
 
         :arg str crash_id: The crash id
         :arg dict dumps: dump name -> dump
+        :arg dict raw_crash: the raw crash; pass this so the dumps go in the same
+            hour directory as the raw crash
 
         """
-        files = {}
-
-        # Add dump_names to the list of files to save. We always generate this
-        # even if there are no dumps.
-        files[self._get_dump_names_path(crash_id)] = json_ordered_dumps(list(sorted(dumps.keys()))).encode('utf-8')
-
-        # Add the dump files if there are any.
-        for dump_name, dump in dumps.items():
-            files[self._get_dump_name_path(crash_id, dump_name)] = dump
-
-        for fn, contents in files.items():
-            self._save_file(fn, contents)
+        self._save_files(self._get_dumps_files(crash_id, dumps, get_crash_hour(raw_crash)))
 
     def save_crash(self, crash_report):
         """Save crash data."""
@@ -148,8 +624,10 @@ class FSCrashStorage(CrashStorageBase):
         raw_crash = crash_report.raw_crash
         dumps = crash_report.dumps
 
-        # Save dumps first
-        self.save_dumps(crash_id, dumps)
-
-        # Save raw crash
-        self.save_raw_crash(crash_id, raw_crash)
+        # Save dumps first and raw crash last in one go so that in group fsync
+        # mode, the whole crash is in one batch
+        hour = get_crash_hour(raw_crash)
+        self._save_files(
+            self._get_dumps_files(crash_id, dumps, hour) +
+            self._get_raw_crash_files(crash_id, raw_crash, hour)
+        )
@@ -0,0 +1,172 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import re
+
+from everett.component import ConfigOptions, RequiredConfigMixin
+from everett.manager import ConfigManager, parse_bool
+import isodate
+
+from antenna.util import get_date_from_crash_id, utc_now
+
+
+HOUR_DIR_RE = re.compile(r'^\d{2}$')
+
+
+def get_crash_hour(raw_crash):
+    """Return the hour a crash was submitted as a two digit string.
+
+    This uses ``submitted_timestamp`` from the raw crash and falls back to the
+    current hour if it's not there.
+
+    """
+    timestamp = (raw_crash or {}).get('submitted_timestamp')
+    if timestamp:
+        try:
+            return '%02d' % isodate.parse_datetime(timestamp).hour
+        except (ValueError, isodate.ISO8601Error):
+            pass
+    return '%02d' % utc_now().hour
+
+
+class FSLayout(RequiredConfigMixin):
+    """Paths for crash files in an FSCrashStorage tree.
+
+    By default, all the crashes for a day go in the same directories::
+
+        <FS_ROOT>/
+            <YYYYMMDD>/
+                raw_crash/
+                    <CRASHID>.json
+                dump_names/
+                    <CRASHID>.json
+                <DUMP_NAME>/
+                    <CRASHID>
+
+    At high crash volumes, that's hundreds of thousands of files in one
+    directory. Partitioning adds directories between the date directory and
+    the file type directories:
+
+    * ``PARTITION_HOURLY`` adds an ``<HH>`` directory for the hour the crash
+      was submitted
+    * ``PARTITION_FANOUT`` adds a directory named after the first
+      ``PARTITION_FANOUT`` characters of the crash id; crash ids start with
+      random hex digits, so 2 spreads crashes across 256 directories
+
+    For example, with both::
+
+        <FS_ROOT>/<YYYYMMDD>/<HH>/<CRASHID[:2]>/raw_crash/<CRASHID>.json
+
+    Readers should use this class to find files. The hour isn't in the crash
+    id, so with hourly partitioning, readers that only have a crash id need
+    ``find_crash_dir``.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'fs_root',
+        default='/tmp/antenna_crashes',  # nosec
+        doc='path to where files are stored'
+    )
+    required_config.add_option(
+        'partition_hourly',
+        default='false',
+        parser=parse_bool,
+        doc='whether to partition date directories by submission hour'
+    )
+    required_config.add_option(
+        'partition_fanout',
+        default='0',
+        parser=int,
+        doc='number of crash id characters to partition date directories by; 0 disables this'
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.root = os.path.abspath(self.config('fs_root')).rstrip(os.sep)
+        self.hourly = self.config('partition_hourly')
+        self.fanout = self.config('partition_fanout')
+
+    @classmethod
+    def from_root(cls, root, **config):
+        """Build a layout for a root with configuration in keyword arguments.
+
+        For example::
+
+            layout = FSLayout.from_root('/data/antenna_crashes', partition_fanout='2')
+
+        """
+        config = dict((key.upper(), val) for key, val in config.items())
+        config['FS_ROOT'] = root
+        return cls(ConfigManager.from_dict(config))
+
+    def get_crash_dir(self, crash_id, hour=None):
+        """Return the partition directory for a crash.
+
+        :arg str crash_id: the crash id
+        :arg str hour: the two digit submission hour; required if partitioning
+            by hour
+
+        """
+        parts = [self.root, get_date_from_crash_id(crash_id)]
+        if self.hourly:
+            if hour is None:
+                raise ValueError('hour is required for hourly partitions')
+            parts.append(hour)
+        if self.fanout > 0:
+            parts.append(crash_id[:self.fanout])
+        return os.path.join(*parts)
+
+    def get_raw_crash_path(self, crash_id, hour=None):
+        """Return path for the raw crash."""
+        return os.path.join(self.get_crash_dir(crash_id, hour), 'raw_crash', crash_id + '.json')
+
+    def get_dump_names_path(self, crash_id, hour=None):
+        """Return path for the list of dump names."""
+        return os.path.join(self.get_crash_dir(crash_id, hour), 'dump_names', crash_id + '.json')
+
+    def get_dump_path(self, crash_id, dump_name, hour=None):
+        """Return path for a dump."""
+        return os.path.join(self.get_crash_dir(crash_id, hour), dump_name, crash_id)
+
+    def iter_crash_dirs(self, day):
+        """Yield partition directories in a date directory in sorted order."""
+        dirs = [os.path.join(self.root, day)]
+        levels = []
+        if self.hourly:
+            levels.append(lambda name: HOUR_DIR_RE.match(name))
+        if self.fanout > 0:
+            levels.append(lambda name: len(name) == self.fanout)
+
+        for matches in levels:
+            next_dirs = []
+            for path in dirs:
+                if not os.path.isdir(path):
+                    continue
+                next_dirs.extend(
+                    os.path.join(path, name) for name in sorted(os.listdir(path))
+                    if matches(name) and os.path.isdir(os.path.join(path, name))
+                )
+            dirs = next_dirs
+
+        for path in dirs:
+            if os.path.isdir(path):
+                yield path
+
+    def find_crash_dir(self, crash_id):
+        """Return the partition directory with the crash's raw crash.
+
+        With hourly partitioning, this looks in every hour of the day.
+
+        :returns: path or None if the crash isn't in the tree
+
+        """
+        hours = ['%02d' % hour for hour in range(24)] if self.hourly else [None]
+        for hour in hours:
+            crash_dir = self.get_crash_dir(crash_id, hour)
+            if os.path.exists(os.path.join(crash_dir, 'raw_crash', crash_id + '.json')):
+                return crash_dir
+        return None
@@ -0,0 +1,502 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import errno
+import fcntl
+import json
+import logging
+import os
+import re
+import tarfile
+import time
+
+from everett.component import ConfigOptions, RequiredConfigMixin
+import gevent
+import markus
+
+from antenna.ext.fs.layout import FSLayout
+from antenna.ext.segmentlog.segment import (
+    INDEX_SUFFIX,
+    SEGMENT_SUFFIX,
+    encode_index_entry,
+    encode_record,
+)
+from antenna.util import utc_now
+
+
+logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('fsretention')
+
+
+DATE_DIR_RE = re.compile(r'^\d{8}$')
+
+#: Retention actions
+ACTION_DELETE = 'delete'
+ACTION_ARCHIVE = 'archive'
+
+#: Archive formats
+FORMAT_TAR = 'tar'
+FORMAT_SEGMENTLOG = 'segmentlog'
+
+
+def parse_action(val):
+    """Everett parser for retention actions."""
+    if val not in (ACTION_DELETE, ACTION_ARCHIVE):
+        raise ValueError('%r is not a valid retention action' % val)
+    return val
+
+
+def parse_archive_format(val):
+    """Everett parser for archive formats."""
+    if val not in (FORMAT_TAR, FORMAT_SEGMENTLOG):
+        raise ValueError('%r is not a valid archive format' % val)
+    return val
+
+
+class RateLimiter:
+    """Limits the rate of work by sleeping.
+
+    :arg float rate: units of work per second; 0 means unlimited
+
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start_time = time.time()
+        self.amount = 0
+
+    def consume(self, amount):
+        """Record work and sleep if it's going faster than the rate."""
+        if self.rate <= 0:
+            return
+
+        self.amount += amount
+        delay = (self.amount / self.rate) - (time.time() - self.start_time)
+        if delay > 0:
+            gevent.sleep(delay)
+
+
+class FSRetention(RequiredConfigMixin):
+    """Removes or archives old date directories in an FSCrashStorage tree.
+
+    ``FSCrashStorage`` saves crashes in ``<FS_ROOT>/<YYYYMMDD>/``
+    directories and never deletes anything. This removes date directories
+    that are older than ``RETENTION_MAX_AGE_DAYS`` days and then removes the
+    oldest date directories until the tree is under ``RETENTION_MAX_SIZE``
+    bytes. The directory for today is never removed.
+
+    If ``RETENTION_ACTION`` is ``archive``, each date directory is packed into
+    a single file in ``RETENTION_ARCHIVE_DIR`` before it's removed. The file is
+    either a tarball of the directory or a segment log that can be read with
+    ``antenna.ext.segmentlog.segment.SegmentLogReader``. Segment log archives
+    only have complete crashes--files that aren't part of a crash with a raw
+    crash are dropped.
+
+    File reads, writes and removals are limited to ``RETENTION_IO_RATE`` bytes
+    per second so cleaning up doesn't thrash the disk.
+
+    When ``FSCrashStorage`` is the crash storage, this runs from the heartbeat
+    every ``RETENTION_INTERVAL`` seconds if either limit is set. File system
+    calls go through the ``FSCrashStorage`` threadpool a batch at a time, so
+    runs don't block handling requests. Only one process at a time works on a
+    tree. It can also be run with ``bin/fs_retention.py``.
+
+    Sizes of date directories are walked once and remembered. Only today's and
+    yesterday's directories, which crashes are still being saved to, and new
+    directories are walked again on later runs.
+
+    :arg config: the config manager
+    :arg run_blocking: function to call blocking file system functions with;
+        this lets the caller run them in a threadpool
+
+    """
+
+    #: Number of files to remove or archive in one call to ``run_blocking``
+    batch_size = 100
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'fs_root',
+        default='/tmp/antenna_crashes',  # nosec
+        doc='path to where files are stored'
+    )
+    required_config.add_option(
+        'retention_max_age_days',
+        default='0',
+        parser=int,
+        doc='remove date directories older than this many days; 0 disables this'
+    )
+    required_config.add_option(
+        'retention_max_size',
+        default='0',
+        parser=int,
+        doc='remove oldest date directories until the tree is under this many bytes; 0 disables this'
+    )
+    required_config.add_option(
+        'retention_action',
+        default=ACTION_DELETE,
+        parser=parse_action,
+        doc='what to do with date directories: ``delete`` or ``archive``'
+    )
+    required_config.add_option(
+        'retention_archive_dir',
+        default='',
+        doc='path to where archives go; required for ``archive``'
+    )
+    required_config.add_option(
+        'retention_archive_format',
+        default=FORMAT_TAR,
+        parser=parse_archive_format,
+        doc='archive format: ``tar`` or ``segmentlog``'
+    )
+    required_config.add_option(
+        'retention_io_rate',
+        default='0',
+        parser=int,
+        doc='bytes per second to read, write and remove; 0 is unlimited'
+    )
+    required_config.add_option(
+        'retention_interval',
+        default='3600',
+        parser=int,
+        doc='seconds between runs from the heartbeat'
+    )
+
+    def __init__(self, config, run_blocking=None):
+        self.config = config.with_options(self)
+        self.run_blocking = run_blocking or (lambda fun, *args, **kwargs: fun(*args, **kwargs))
+        self.root = os.path.abspath(self.config('fs_root')).rstrip(os.sep)
+        self.max_age_days = self.config('retention_max_age_days')
+        self.max_size = self.config('retention_max_size')
+        self.action = self.config('retention_action')
+        self.archive_dir = self.config('retention_archive_dir')
+        self.archive_format = self.config('retention_archive_format')
+        self.layout = FSLayout(config)
+
+        if self.action == ACTION_ARCHIVE and not self.archive_dir:
+            raise ValueError('retention_archive_dir is required to archive')
+
+        self.last_run_time = 0
+        self.greenlet = None
+
+        # date directory name -> size in bytes for directories that are done
+        # changing
+        self.day_sizes = {}
+
+    def is_enabled(self):
+        """Return whether any limits are set."""
+        return self.max_age_days > 0 or self.max_size > 0
+
+    def hb_run(self):
+        """Heartbeat function to start a run if it's time."""
+        if self.greenlet is not None and not self.greenlet.dead:
+            return
+        if time.time() - self.last_run_time < self.config('retention_interval'):
+            return
+
+        self.last_run_time = time.time()
+        self.greenlet = gevent.spawn(self.run)
+
+    def get_days(self):
+        """Return sorted list of date directory names."""
+        return sorted(
+            name for name in os.listdir(self.root)
+            if DATE_DIR_RE.match(name) and os.path.isdir(os.path.join(self.root, name))
+        )
+
+    def _iter_files(self, day):
+        """Yield ``(path, size)`` for files in a date directory in order."""
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, day)):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                path = os.path.join(dirpath, fn)
+                try:
+                    yield path, os.lstat(path).st_size
+                except FileNotFoundError:
+                    pass
+
+    def get_size(self, day):
+        """Return total size of files in a date directory."""
+        return sum(size for path, size in self._iter_files(day))
+
+    def _list_files(self, day):
+        return list(self._iter_files(day))
+
+    def get_sizes(self, days):
+        """Return date directory name -> size in bytes.
+
+        :arg list days: sorted list of date directory names
+
+        """
+        yesterday = (utc_now() - datetime.timedelta(days=1)).strftime('%Y%m%d')
+        sizes = {}
+        for day in days:
+            if day in self.day_sizes:
+                sizes[day] = self.day_sizes[day]
+                continue
+
+            sizes[day] = self.run_blocking(self.get_size, day)
+            if day < yesterday:
+                self.day_sizes[day] = sizes[day]
+
+        # Forget directories that are gone
+        self.day_sizes = {day: size for day, size in self.day_sizes.items() if day in sizes}
+        return sizes
+
+    def _batches(self, items):
+        """Yield lists of at most ``batch_size`` items."""
+        for i in range(0, len(items), self.batch_size):
+            yield items[i:i + self.batch_size]
+
+    def get_days_to_expire(self, days, sizes):
+        """Return the date directories to remove, oldest first.
+
+        :arg list days: sorted list of date directory names
+        :arg dict sizes: date directory name -> size in bytes
+
+        """
+        today = utc_now().strftime('%Y%m%d')
+        candidates = [day for day in days if day < today]
+
+        expire = []
+        if self.max_age_days > 0:
+            cutoff = (utc_now() - datetime.timedelta(days=self.max_age_days)).strftime('%Y%m%d')
+            expire = [day for day in candidates if day < cutoff]
+
+        if self.max_size > 0:
+            total = sum(sizes[day] for day in days if day not in expire)
+            for day in candidates:
+                if total <= self.max_size:
+                    break
+                if day not in expire:
+                    expire.append(day)
+                    total -= sizes[day]
+
+        return sorted(expire)
+
+    def _lock(self):
+        """Return open lock file or None if another process has the lock."""
+        fp = open(os.path.join(self.root, '.retention.lock'), 'w')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.close()
+            return None
+        return fp
+
+    def run(self):
+        """Remove or archive date directories that are past the limits.
+
+        Errors are logged and end the run. The next run picks up where this
+        one left off.
+
+        :returns: list of date directory names that were removed
+
+        """
+        removed = []
+        try:
+            if not self.run_blocking(os.path.isdir, self.root):
+                return removed
+
+            lock_fp = self.run_blocking(self._lock)
+            if lock_fp is None:
+                logger.info('Another process is cleaning up %r; skipping', self.root)
+                return removed
+
+            start_time = time.time()
+            try:
+                days = self.run_blocking(self.get_days)
+                sizes = self.get_sizes(days)
+                mymetrics.gauge('tree_size', value=sum(sizes.values()))
+
+                limiter = RateLimiter(self.config('retention_io_rate'))
+                for day in self.get_days_to_expire(days, sizes):
+                    if self.action == ACTION_ARCHIVE:
+                        self.archive_day(day, limiter)
+                        mymetrics.incr('archived_days.count')
+                    self.remove_day(day, limiter)
+                    self.day_sizes.pop(day, None)
+                    removed.append(day)
+                    mymetrics.incr('removed_days.count')
+                    logger.info('Removed %s (%d bytes)', day, sizes[day])
+
+            finally:
+                self.run_blocking(lock_fp.close)
+                # NOTE: time.time returns seconds, but .timing() wants
+                # milliseconds, so we multiply!
+                mymetrics.timing('run.time', value=(time.time() - start_time) * 1000)
+
+        except Exception:
+            logger.exception('Exception when cleaning up %r', self.root)
+            mymetrics.incr('run_failed.count')
+
+        return removed
+
+    def _list_day(self, day):
+        """Return ``(files, dirs)`` for a date directory with dirs deepest first."""
+        files = []
+        dirs = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, day), topdown=False):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                try:
+                    files.append((path, os.lstat(path).st_size))
+                except FileNotFoundError:
+                    pass
+            dirs.append(dirpath)
+        return files, dirs
+
+    def _remove_files(self, files):
+        for path, size in files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _remove_dirs(self, dirs):
+        """Remove empty directories and return the ones that weren't empty."""
+        not_empty = []
+        for path in dirs:
+            try:
+                os.rmdir(path)
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                # A crash with an old date was saved into it after it was
+                # listed; the next run removes it
+                if exc.errno != errno.ENOTEMPTY:
+                    raise
+                not_empty.append(path)
+        return not_empty
+
+    def remove_day(self, day, limiter):
+        """Remove a date directory.
+
+        Directories that get new files while they're being removed are left
+        for the next run.
+
+        """
+        files, dirs = self.run_blocking(self._list_day, day)
+        for batch in self._batches(files):
+            self.run_blocking(self._remove_files, batch)
+            limiter.consume(sum(size for path, size in batch))
+        not_empty = self.run_blocking(self._remove_dirs, dirs)
+        if not_empty:
+            logger.info('%s got new files while it was being removed; leaving %d directories', day, len(not_empty))
+
+    def _get_archive_name(self, day, suffix):
+        """Return an archive name that isn't used yet.
+
+        Crashes can have old dates, so a date directory can come back after
+        it's been archived.
+
+        """
+        name = day
+        i = 0
+        while os.path.exists(os.path.join(self.archive_dir, name + suffix)):
+            i += 1
+            name = '%s-%d' % (day, i)
+        return name
+
+    def archive_day(self, day, limiter):
+        """Pack a date directory into a file in the archive directory."""
+        self.run_blocking(os.makedirs, self.archive_dir, exist_ok=True)
+
+        if self.archive_format == FORMAT_TAR:
+            self._archive_tar(day, limiter)
+        else:
+            self._archive_segmentlog(day, limiter)
+
+    def _add_to_tar(self, tar, files):
+        for path, size in files:
+            tar.add(path, arcname=os.path.relpath(path, self.root), recursive=False)
+
+    def _archive_tar(self, day, limiter):
+        name = self.run_blocking(self._get_archive_name, day, '.tar')
+        tmp_path = os.path.join(self.archive_dir, '.' + name + '.tar')
+
+        # Skip temp files
+        files = [
+            (path, size) for path, size in self.run_blocking(self._list_files, day)
+            if not os.path.basename(path).startswith('.')
+        ]
+
+        tar = self.run_blocking(tarfile.open, tmp_path, 'w')
+        try:
+            for batch in self._batches(files):
+                self.run_blocking(self._add_to_tar, tar, batch)
+                limiter.consume(sum(size for path, size in batch) * 2)
+        finally:
+            self.run_blocking(tar.close)
+        self.run_blocking(os.rename, tmp_path, os.path.join(self.archive_dir, name + '.tar'))
+
+    def _list_crash_dirs(self, day):
+        return list(self.layout.iter_crash_dirs(day))
+
+    def _list_raw_crash_files(self, crash_dir):
+        raw_crash_dir = os.path.join(crash_dir, 'raw_crash')
+        if not os.path.isdir(raw_crash_dir):
+            return []
+
+        return [
+            fn for fn in sorted(os.listdir(raw_crash_dir))
+            if not fn.startswith('.') and fn.endswith('.json')
+        ]
+
+    def _read_crash(self, crash_dir, fn):
+        """Return ``(crash_id, raw_crash, dumps, size)`` for a raw crash file."""
+        crash_id = fn[:-len('.json')]
+
+        with open(os.path.join(crash_dir, 'raw_crash', fn), 'rb') as fp:
+            raw_crash = json.loads(fp.read().decode('utf-8'))
+
+        dump_names = []
+        dump_names_path = os.path.join(crash_dir, 'dump_names', crash_id + '.json')
+        if os.path.exists(dump_names_path):
+            with open(dump_names_path, 'rb') as fp:
+                dump_names = json.loads(fp.read().decode('utf-8'))
+
+        dumps = {}
+        for dump_name in dump_names:
+            dump_path = os.path.join(crash_dir, dump_name, crash_id)
+            if os.path.exists(dump_path):
+                with open(dump_path, 'rb') as fp:
+                    dumps[dump_name] = fp.read()
+
+        return crash_id, raw_crash, dumps, sum(len(dump) for dump in dumps.values())
+
+    def _archive_crashes(self, crash_dir, filenames, segment_fp, index_fp):
+        """Append crashes to a segment log and return the bytes read and written."""
+        amount = 0
+        for fn in filenames:
+            crash_id, raw_crash, dumps, size = self._read_crash(crash_dir, fn)
+            record = encode_record(crash_id, raw_crash, dumps)
+            index_fp.write(encode_index_entry(crash_id, segment_fp.tell(), len(record)))
+            segment_fp.write(record)
+            amount += size + len(record)
+        return amount
+
+    def _archive_segmentlog(self, day, limiter):
+        name = self.run_blocking(self._get_archive_name, day, SEGMENT_SUFFIX)
+        tmp_segment_path = os.path.join(self.archive_dir, '.' + name + SEGMENT_SUFFIX)
+        tmp_index_path = os.path.join(self.archive_dir, '.' + name + INDEX_SUFFIX)
+
+        segment_fp = self.run_blocking(open, tmp_segment_path, 'wb')
+        try:
+            index_fp = self.run_blocking(open, tmp_index_path, 'wb')
+            try:
+                for crash_dir in self.run_blocking(self._list_crash_dirs, day):
+                    filenames = self.run_blocking(self._list_raw_crash_files, crash_dir)
+                    for batch in self._batches(filenames):
+                        limiter.consume(self.run_blocking(
+                            self._archive_crashes, crash_dir, batch, segment_fp, index_fp
+                        ))
+            finally:
+                self.run_blocking(index_fp.close)
+        finally:
+            self.run_blocking(segment_fp.close)
+
+        self.run_blocking(os.rename, tmp_segment_path, os.path.join(self.archive_dir, name + SEGMENT_SUFFIX))
+        self.run_blocking(os.rename, tmp_index_path, os.path.join(self.archive_dir, name + INDEX_SUFFIX))
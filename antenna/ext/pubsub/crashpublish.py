@@ -67,11 +67,25 @@ class PubSubCrashPublish(CrashPublishBase):
     If something in the above isn't created, then Antenna may not start.
 
 
+    Routes
+    ======
+
+    Route destinations are topic names in the same project. For example, this
+    publishes deferred crashes to their own topic and everything else to
+    ``CRASHPUBLISH_TOPIC_NAME``::
+
+        CRASHPUBLISH_ROUTES=DEFER:socorro_deferred
+
+    Each topic needs a subscription and the service account needs publisher
+    permissions for each topic.
+
+
     Verification
     ============
 
-    This component verifies that it can publish to the topic by publishing a
-    fake crash id of ``test``. Downstream consumer should throw this out.
+    This component verifies that it can publish to the topic and the topics in
+    routes by publishing a fake crash id of ``test``. Downstream consumer
+    should throw this out.
 
 
     Local emulaior
@@ -112,23 +126,44 @@ class PubSubCrashPublish(CrashPublishBase):
         self.publisher._batch_class = SynchronousBatch
         self.topic_path = self.publisher.topic_path(self.project_id, self.topic_name)
 
+        # destination topic name -> topic path
+        self.route_topic_paths = {
+            destination: self.publisher.topic_path(self.project_id, destination)
+            for destination in self.get_destinations()
+        }
+
         register_for_verification(self.verify_topic)
 
+    def get_topic_paths(self):
+        """Return list of the default topic path and route topic paths."""
+        return [self.topic_path] + sorted(set(self.route_topic_paths.values()) - {self.topic_path})
+
     def verify_topic(self):
-        """Verify topic can be published to by publishing fake crash id."""
-        future = self.publisher.publish(self.topic_path, data=b'test')
-        future.result()
+        """Verify topics can be published to by publishing fake crash id."""
+        for topic_path in self.get_topic_paths():
+            future = self.publisher.publish(topic_path, data=b'test')
+            future.result()
 
     def check_health(self, state):
         """Check Pub/Sub connection health."""
-        try:
-            self.publisher.get_topic(self.topic_path)
-        except Exception as exc:
-            state.add_error('PubSubCrashPublish', repr(exc))
+        for topic_path in self.get_topic_paths():
+            try:
+                self.publisher.get_topic(topic_path)
+            except Exception as exc:
+                state.add_error('PubSubCrashPublish', repr(exc))
 
     def publish_crash(self, crash_report):
         """Publish a crash id to a Pub/Sub topic."""
+        if not self.should_publish(crash_report):
+            return
+
+        destination = self.get_destination(crash_report)
+        if destination is None:
+            topic_path = self.topic_path
+        else:
+            topic_path = self.route_topic_paths[destination]
+
         crash_id = crash_report.crash_id
         data = crash_id.encode('utf-8')
-        future = self.publisher.publish(self.topic_path, data=data)
+        future = self.publisher.publish(topic_path, data=data)
         future.result()
@@ -3,20 +3,28 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import bisect
+from collections import deque
 import io
 import logging
 import random
+import socket
+import time
 import uuid
 
 import boto3
 from botocore.client import ClientError, Config
+from botocore.vendored.requests.packages.urllib3.connection import HTTPConnection
 from everett.component import ConfigOptions, RequiredConfigMixin
+from everett.manager import parse_bool
 import gevent
+import markus
 
 from antenna.util import retry
 
 
 logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('s3connection')
 
 
 def generate_test_filepath():
@@ -50,6 +58,73 @@ def wait_times_save():
         yield i
 
 
+def parse_bucket_names(val):
+    """Everett parser for a comma-separated list of bucket names."""
+    buckets = [bucket.strip() for bucket in val.split(',') if bucket.strip()]
+    if not buckets:
+        raise ValueError('at least one bucket name is required')
+    return buckets
+
+
+class LatencyTracker:
+    """Keeps the most recent latencies and computes percentiles over them.
+
+    Samples are kept in arrival order to know which one to drop and in sorted
+    order so percentiles are a lookup rather than a sort.
+
+    :arg int size: the number of samples to keep
+
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.samples = deque()
+        self.ordered = []
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, value):
+        """Add a latency sample in seconds."""
+        if len(self.samples) == self.size:
+            oldest = self.samples.popleft()
+            del self.ordered[bisect.bisect_left(self.ordered, oldest)]
+        self.samples.append(value)
+        bisect.insort(self.ordered, value)
+
+    def percentile(self, pct):
+        """Return the latency at the given percentile or None if no samples."""
+        if not self.ordered:
+            return None
+        index = min(len(self.ordered) - 1, int(len(self.ordered) * pct / 100.0))
+        return self.ordered[index]
+
+
+class HedgeBudget:
+    """Limits hedged requests to a percentage of the most recent requests.
+
+    :arg float percent: the maximum percentage of requests that can be hedged
+    :arg int size: the number of recent requests to consider
+
+    """
+
+    def __init__(self, percent, size=1000):
+        self.percent = percent
+        self.window = deque(maxlen=size)
+        self.hedged = 0
+
+    def record(self, hedged):
+        """Record whether a request was hedged."""
+        if len(self.window) == self.window.maxlen:
+            self.hedged -= self.window[0]
+        self.window.append(int(hedged))
+        self.hedged += int(hedged)
+
+    def allows(self):
+        """Return whether another hedged request fits in the budget."""
+        return (self.hedged + 1) <= len(self.window) * self.percent / 100.0
+
+
 class S3Connection(RequiredConfigMixin):
     """Connection object for S3.
 
@@ -79,12 +154,41 @@ class S3Connection(RequiredConfigMixin):
       startup.
 
 
+    **Multiple buckets**
+
+    ``BUCKET_NAME`` can be a comma-separated list of buckets. In that case,
+    ``S3CrashStorage`` shards crashes across the buckets by crash id. The
+    verification and health checks cover every bucket. All buckets must be in
+    the region specified by ``REGION``.
+
+
     **Retrying saves**
 
     When saving crashes, this connection will retry saving several times. Then
     give up. The crashmover coroutine will put the crash back in the queue to
     retry later. Crashes are never thrown out.
 
+
+    **Connection pool**
+
+    boto3 keeps a pool of ``MAX_POOL_CONNECTIONS`` connections to S3. If more
+    requests than that are in flight, the extra requests open connections that
+    get thrown away afterwards which means more TLS handshakes. Set this to at
+    least the number of concurrent crashmovers.
+
+    At startup, this opens ``WARMUP_CONNECTIONS`` connections to S3 so that the
+    first crashes after a deploy don't pay for TLS handshakes and credential
+    fetches. This defaults to the value of ``CONCURRENT_CRASHMOVERS``.
+
+
+    **Hedging saves**
+
+    S3 PUT latency has a long tail. If ``HEDGE_ENABLED`` is true, then when a
+    PUT hasn't finished within the ``HEDGE_PERCENTILE`` percentile of recent
+    PUT latencies, this starts a second identical PUT and uses whichever
+    finishes first. ``HEDGE_BUDGET`` caps the percentage of PUTs that can be
+    hedged so a slow S3 doesn't get twice the traffic.
+
     """
 
     required_config = ConfigOptions()
@@ -123,17 +227,91 @@ class S3Connection(RequiredConfigMixin):
     )
     required_config.add_option(
         'bucket_name',
+        parser=parse_bucket_names,
         doc=(
             'AWS S3 bucket to save to. Note that the bucket must already have been '
-            'created and must be in the region specified by ``region``.'
+            'created and must be in the region specified by ``region``. This can '
+            'be a comma-separated list of buckets to shard crashes across.'
+        )
+    )
+    required_config.add_option(
+        'max_pool_connections',
+        default='10',
+        parser=int,
+        doc='Maximum number of connections to keep in the connection pool.'
+    )
+    required_config.add_option(
+        'connect_timeout',
+        default='60',
+        parser=float,
+        doc='Seconds to wait for a connection to S3 to be established.'
+    )
+    required_config.add_option(
+        'read_timeout',
+        default='60',
+        parser=float,
+        doc='Seconds to wait to read from a connection to S3.'
+    )
+    required_config.add_option(
+        'tcp_keepalive',
+        default='False',
+        parser=parse_bool,
+        doc='Whether or not to enable TCP keepalive on connections to S3.'
+    )
+    required_config.add_option(
+        'warmup_connections',
+        # NOTE: This has to match the CONCURRENT_CRASHMOVERS default because
+        # the alternate key is only used when CONCURRENT_CRASHMOVERS is set
+        default='2',
+        alternate_keys=['root:concurrent_crashmovers'],
+        parser=int,
+        doc=(
+            'Number of connections to open at startup. Defaults to the number of '
+            'concurrent crashmovers. Set to 0 to not warm up connections.'
+        )
+    )
+    required_config.add_option(
+        'hedge_enabled',
+        default='False',
+        parser=parse_bool,
+        doc='Whether or not to hedge slow PUTs by issuing a second identical PUT.'
+    )
+    required_config.add_option(
+        'hedge_percentile',
+        default='95',
+        parser=float,
+        doc=(
+            'Percentile of recent PUT latencies after which a PUT that hasn\'t '
+            'finished gets hedged.'
         )
     )
+    required_config.add_option(
+        'hedge_budget',
+        default='5',
+        parser=float,
+        doc='Maximum percentage of recent PUTs that can be hedged.'
+    )
+
+    #: Number of PUT latencies to keep track of
+    latency_window = 1000
+
+    #: Minimum number of PUT latencies to have before hedging
+    hedge_min_samples = 20
 
     def __init__(self, config):
         self.config = config.with_options(self)
-        self.bucket = self.config('bucket_name')
+        self.buckets = self.config('bucket_name')
+        self.bucket = self.buckets[0]
+        self.max_pool_connections = self.config('max_pool_connections')
         self.client = self._build_client()
 
+        # Number of requests currently using a connection from the pool
+        self.in_flight = 0
+
+        self.hedge_enabled = self.config('hedge_enabled')
+        self.put_latency = LatencyTracker(size=self.latency_window)
+        self.hedge_budget = HedgeBudget(self.config('hedge_budget'), size=self.latency_window)
+
     @retry(
         retryable_exceptions=[
             # FIXME(willkg): Seems like botocore always raises ClientError
@@ -163,34 +341,81 @@ class S3Connection(RequiredConfigMixin):
         kwargs = {
             'service_name': 's3',
             'region_name': self.config('region'),
-            # NOTE(willkg): We use path-style because that lets us have dots in
-            # our bucket names and use SSL.
-            'config': Config(s3={'addressing_style': 'path'})
+            'config': Config(
+                # NOTE(willkg): We use path-style because that lets us have
+                # dots in our bucket names and use SSL.
+                s3={'addressing_style': 'path'},
+                max_pool_connections=self.max_pool_connections,
+                connect_timeout=self.config('connect_timeout'),
+                read_timeout=self.config('read_timeout'),
+            )
         }
         if self.config('endpoint_url'):
             kwargs['endpoint_url'] = self.config('endpoint_url')
 
-        return session.client(**kwargs)
+        client = session.client(**kwargs)
+        if self.config('tcp_keepalive'):
+            self._enable_tcp_keepalive(client)
+        return client
 
-    def verify_write_to_bucket(self):
-        """Verify S3 bucket exists and can be written to.
+    def _enable_tcp_keepalive(self, client):
+        # NOTE: The version of botocore we use doesn't support
+        # tcp_keepalive in Config, so we add the socket option to the pool
+        # manager of each mounted adapter.
+        socket_options = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        for adapter in client._endpoint.http_session.adapters.values():
+            adapter.poolmanager.connection_pool_kw['socket_options'] = socket_options
+
+    def verify_write_to_bucket(self, bucket=None):
+        """Verify S3 buckets exist and can be written to.
 
         This will do multiple attempts and then give up and throw an exception.
 
+        :arg str bucket: the bucket to verify; if None, verifies all buckets
+
         """
-        self.client.upload_fileobj(
-            Fileobj=io.BytesIO(b'test'),
-            Bucket=self.bucket,
-            Key=generate_test_filepath()
+        buckets = [bucket] if bucket is not None else self.buckets
+        for bucket in buckets:
+            self.client.upload_fileobj(
+                Fileobj=io.BytesIO(b'test'),
+                Bucket=bucket,
+                Key=generate_test_filepath()
+            )
+
+    def warm_up(self):
+        """Open connections to S3 so they're in the pool when crashes come in.
+
+        This makes ``WARMUP_CONNECTIONS`` concurrent HEAD requests spread
+        across the buckets so each bucket gets warmed up. Problems are logged,
+        but otherwise ignored.
+
+        """
+        num_connections = min(self.config('warmup_connections'), self.max_pool_connections)
+        if num_connections <= 0:
+            return
+
+        logger.info(
+            'Warming up %s connections to S3 for %s buckets', num_connections, len(self.buckets)
         )
+        greenlets = [
+            gevent.spawn(self.client.head_bucket, Bucket=self.buckets[i % len(self.buckets)])
+            for i in range(num_connections)
+        ]
+        gevent.joinall(greenlets)
+        for greenlet in greenlets:
+            if not greenlet.successful():
+                logger.warning('Warming up connection failed: %r', greenlet.exception)
 
     def check_health(self, state):
         """Check S3 connection health."""
-        try:
-            # HEAD the bucket to verify S3 is up and we can connect to it.
-            self.client.head_bucket(Bucket=self.bucket)
-        except Exception as exc:
-            state.add_error('S3Connection', repr(exc))
+        for bucket in self.buckets:
+            try:
+                # HEAD the bucket to verify S3 is up and we can connect to it.
+                self.client.head_bucket(Bucket=bucket)
+            except Exception as exc:
+                state.add_error('S3Connection', '%s: %r' % (bucket, exc))
 
     @retry(
         retryable_exceptions=[
@@ -202,7 +427,7 @@ class S3Connection(RequiredConfigMixin):
         sleep_function=gevent.sleep,
         module_logger=logger,
     )
-    def save_file(self, path, data):
+    def save_file(self, path, data, bucket=None):
         """Save a single file to S3.
 
         This will retry a handful of times in short succession so as to deal
@@ -213,6 +438,26 @@ class S3Connection(RequiredConfigMixin):
 
         :arg bytes data: the data to save
 
+        :arg str bucket: the bucket to save to; defaults to the first bucket
+
+        :raises botocore.exceptions.ClientError: connection issues, permissions
+            issues, bucket is missing, etc.
+
+        """
+        self.save_file_once(path, data, bucket=bucket)
+
+    def save_file_once(self, path, data, bucket=None):
+        """Save a single file to S3 without retrying.
+
+        Use this when the caller has somewhere else to save the file, so it
+        doesn't wait out ``save_file``'s retries before trying there.
+
+        :arg str path: the path to save to
+
+        :arg bytes data: the data to save
+
+        :arg str bucket: the bucket to save to; defaults to the first bucket
+
         :raises botocore.exceptions.ClientError: connection issues, permissions
             issues, bucket is missing, etc.
 
@@ -220,8 +465,97 @@ class S3Connection(RequiredConfigMixin):
         if not isinstance(data, bytes):
             raise TypeError('data argument must be bytes')
 
-        self.client.upload_fileobj(
-            Fileobj=io.BytesIO(data),
-            Bucket=self.bucket,
-            Key=path,
-        )
+        bucket = bucket or self.bucket
+        if self.hedge_enabled:
+            self._hedged_put(path, data, bucket)
+        else:
+            self.put_latency.add(self._put(path, data, bucket))
+
+    def load_file(self, path, bucket=None):
+        """Load a single file from S3.
+
+        :arg str path: the path to load from
+
+        :arg str bucket: the bucket to load from; defaults to the first bucket
+
+        :returns: bytes
+
+        :raises botocore.exceptions.ClientError: connection issues, permissions
+            issues, missing key, etc.
+
+        """
+        resp = self.client.get_object(Bucket=bucket or self.bucket, Key=path)
+        return resp['Body'].read()
+
+    def _put(self, path, data, bucket):
+        """PUT a file and return how long it took in seconds."""
+        if self.in_flight >= self.max_pool_connections:
+            # There are no free connections in the pool, so this request will
+            # open a new one that gets thrown away afterwards
+            mymetrics.incr('pool_exhausted.count')
+
+        self.in_flight += 1
+        try:
+            start_time = time.time()
+            self.client.upload_fileobj(
+                Fileobj=io.BytesIO(data),
+                Bucket=bucket,
+                Key=path,
+            )
+            delta = time.time() - start_time
+
+            # NOTE: time.time returns seconds, but .timing() wants
+            # milliseconds, so we multiply!
+            mymetrics.timing('put.time', value=delta * 1000, tags=['bucket:%s' % bucket])
+            return delta
+        finally:
+            self.in_flight -= 1
+
+    def _put_no_raise(self, path, data, bucket):
+        # Returns (exception, None) or (None, seconds) rather than raising so
+        # that a losing hedged PUT that fails doesn't get reported by the
+        # gevent hub
+        try:
+            return None, self._put(path, data, bucket)
+        except Exception as exc:
+            return exc, None
+
+    def get_hedge_delay(self):
+        """Return seconds to wait before hedging a PUT or None to not hedge."""
+        if len(self.put_latency) < self.hedge_min_samples:
+            return None
+        return self.put_latency.percentile(self.config('hedge_percentile'))
+
+    def _hedged_put(self, path, data, bucket):
+        delay = self.get_hedge_delay()
+        primary = gevent.spawn(self._put_no_raise, path, data, bucket)
+        pending = [primary]
+        hedged = False
+
+        if delay is not None:
+            primary.join(timeout=delay)
+            if not primary.ready() and self.hedge_budget.allows():
+                hedged = True
+                mymetrics.incr('hedged_put.count')
+                pending.append(gevent.spawn(self._put_no_raise, path, data, bucket))
+
+        self.hedge_budget.record(hedged)
+
+        # NOTE: The losing PUT saves the same data to the same key, so
+        # we let it finish in the background rather than killing it in the
+        # middle of a request which would leave the connection in a bad state.
+        exc = None
+        while pending:
+            done = gevent.wait(pending, count=1)[0]
+            pending.remove(done)
+            exc, delta = done.value
+            if exc is None:
+                # Only the winner's latency counts; the loser's would push the
+                # percentile up and make hedging fire less over time
+                self.put_latency.add(delta)
+                if hedged:
+                    winner = 'primary' if done is primary else 'hedge'
+                    mymetrics.incr('hedged_put.winner', tags=['winner:%s' % winner])
+                return
+
+        raise exc
@@ -2,17 +2,21 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
 import logging
 
 from everett.component import ConfigOptions
-from everett.manager import parse_class
+from everett.manager import parse_bool, parse_class
+import markus
 
 from antenna.heartbeat import register_for_verification
 from antenna.ext.crashstorage_base import CrashStorageBase
-from antenna.util import get_date_from_crash_id, json_ordered_dumps
+from antenna.ext.s3.keylayout import encode_dump_pointer, get_bucket_for_crash_id
+from antenna.util import LRUCache, json_ordered_dumps
 
 
 logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('s3crashstorage')
 
 
 class S3CrashStorage(CrashStorageBase):
@@ -34,6 +38,18 @@ class S3CrashStorage(CrashStorageBase):
                        <YYYYMMDD>/
                            <CRASHID>
 
+    The key layout is configurable. See ``S3KeyLayout`` for details.
+
+    If the connection has multiple buckets, each crash is saved to one of them
+    picked by a hash of the crash id. See ``get_bucket_for_crash_id``.
+
+    If ``DEDUPE_DUMPS`` is true, each dump is saved once under its sha256 at
+    ``v1/dump_by_hash/<ENTROPY>/<SHA256>`` (see ``DUMP_HASH_KEY_TEMPLATE``)
+    and ``v1/<DUMPNAME>/<CRASHID>`` is a small pointer to it. Hashes of the
+    last ``DEDUPE_CACHE_SIZE`` dumps saved are kept in memory so duplicate
+    dumps aren't uploaded again. Readers have to follow pointers.
+    ``antenna.ext.s3.keylayout.read_crash_file`` does that.
+
     """
 
     required_config = ConfigOptions()
@@ -43,15 +59,36 @@ class S3CrashStorage(CrashStorageBase):
         parser=parse_class,
         doc='S3 connection class to use'
     )
+    required_config.add_option(
+        'key_layout_class',
+        default='antenna.ext.s3.keylayout.S3KeyLayout',
+        parser=parse_class,
+        doc='S3 key layout class to use'
+    )
+    required_config.add_option(
+        'dedupe_dumps',
+        default='false',
+        parser=parse_bool,
+        doc='Whether to save dumps once by content hash and save pointers to them.'
+    )
+    required_config.add_option(
+        'dedupe_cache_size',
+        default='10000',
+        parser=int,
+        doc='Number of recently saved dump hashes to remember when deduping dumps.'
+    )
 
     def __init__(self, config):
         self.config = config.with_options(self)
         self.conn = self.config('connection_class')(config)
+        self.layout = self.config('key_layout_class')(config)
+        self.dedupe_cache = LRUCache(self.config('dedupe_cache_size'))
         register_for_verification(self.verify_write_to_bucket)
 
     def verify_write_to_bucket(self):
         """Verify S3 bucket exists and can be written to."""
         self.conn.verify_write_to_bucket()
+        self.conn.warm_up()
 
     def get_runtime_config(self, namespace=None):
         """Return generator for items in runtime configuration."""
@@ -61,33 +98,32 @@ class S3CrashStorage(CrashStorageBase):
         for item in self.conn.get_runtime_config(namespace):
             yield item
 
+        for item in self.layout.get_runtime_config(namespace):
+            yield item
+
     def check_health(self, state):
         """Check connection health."""
         self.conn.check_health(state)
 
+    def get_bucket(self, crash_id, conn=None):
+        """Return the bucket the crash is saved to."""
+        conn = conn or self.conn
+        return get_bucket_for_crash_id(crash_id, conn.buckets)
+
     def _get_raw_crash_path(self, crash_id):
-        return 'v2/raw_crash/{entropy}/{date}/{crash_id}'.format(
-            entropy=crash_id[:3],
-            date=get_date_from_crash_id(crash_id),
-            crash_id=crash_id
-        )
+        return self.layout.get_raw_crash_path(crash_id)
 
     def _get_dump_names_path(self, crash_id):
-        return 'v1/dump_names/{crash_id}'.format(crash_id=crash_id)
+        return self.layout.get_dump_names_path(crash_id)
 
     def _get_dump_name_path(self, crash_id, dump_name):
-        # NOTE(willkg): This is something that Socorro collector did. I'm not
-        # really sure why, but in order to maintain backwards compatability, we
-        # need to keep doing it.
-        if dump_name in (None, '', 'upload_file_minidump'):
-            dump_name = 'dump'
-
-        return 'v1/{dump_name}/{crash_id}'.format(
-            dump_name=dump_name,
-            crash_id=crash_id
-        )
+        return self.layout.get_dump_name_path(crash_id, dump_name)
+
+    def _save_file(self, conn, path, data, bucket):
+        """Save a single file with a connection."""
+        conn.save_file(path, data, bucket=bucket)
 
-    def save_raw_crash(self, crash_id, raw_crash):
+    def save_raw_crash(self, crash_id, raw_crash, conn=None):
         """Save the raw crash and related dumps.
 
         .. Note::
@@ -97,6 +133,7 @@ class S3CrashStorage(CrashStorageBase):
 
         :arg str crash_id: The crash id as a string.
         :arg dict raw_crash: dict The raw crash as a dict.
+        :arg conn: the connection to save with; defaults to ``self.conn``
 
         :raises botocore.exceptions.ClientError: connection issues, permissions
             issues, bucket is missing, etc.
@@ -106,34 +143,72 @@ class S3CrashStorage(CrashStorageBase):
         # botocore.exceptions.ClientError if the perms aren't right. That needs
         # to surface to "this node is not healthy".
 
+        conn = conn or self.conn
+
         # Save raw_crash
-        self.conn.save_file(
+        self._save_file(
+            conn,
             self._get_raw_crash_path(crash_id),
-            json_ordered_dumps(raw_crash).encode('utf-8')
+            json_ordered_dumps(raw_crash).encode('utf-8'),
+            self.get_bucket(crash_id, conn)
         )
 
-    def save_dumps(self, crash_id, dumps):
+    def save_dump(self, crash_id, dump_name, dump, bucket, conn, sha256=None):
+        """Save a dump or a pointer to it if deduping dumps.
+
+        :arg str sha256: the sha256 hex digest of the dump if it's already known
+
+        """
+        path = self._get_dump_name_path(crash_id, dump_name)
+        if not self.config('dedupe_dumps'):
+            self._save_file(conn, path, dump, bucket)
+            return
+
+        sha256 = sha256 or hashlib.sha256(dump).hexdigest()
+        hash_path = self.layout.get_dump_hash_path(sha256)
+
+        # NOTE: Failover storage has a connection per endpoint and
+        # bucket names aren't unique across endpoints
+        cache_key = (id(conn), bucket, sha256)
+        # Use get() rather than "in" so hits count as using the entry
+        if self.dedupe_cache.get(cache_key):
+            mymetrics.incr('dedupe.hit')
+            mymetrics.incr('dedupe.bytes_saved', value=len(dump))
+        else:
+            self._save_file(conn, hash_path, dump, bucket)
+            self.dedupe_cache[cache_key] = True
+            mymetrics.incr('dedupe.miss')
+
+        self._save_file(conn, path, encode_dump_pointer(hash_path, sha256, len(dump)), bucket)
+
+    def save_dumps(self, crash_id, dumps, conn=None, checksums=None):
         """Save dump data.
 
         :arg str crash_id: The crash id
         :arg dict dumps: dump name -> dump
+        :arg conn: the connection to save with; defaults to ``self.conn``
+        :arg dict checksums: dump name -> sha256 hex digest for dumps that have
+            already been hashed
 
         :raises botocore.exceptions.ClientError: connection issues, permissions
             issues, bucket is missing, etc.
 
         """
+        conn = conn or self.conn
+        bucket = self.get_bucket(crash_id, conn)
+
         # Save dump_names even if there are no dumps
-        self.conn.save_file(
+        self._save_file(
+            conn,
             self._get_dump_names_path(crash_id),
-            json_ordered_dumps(list(sorted(dumps.keys()))).encode('utf-8')
+            json_ordered_dumps(list(sorted(dumps.keys()))).encode('utf-8'),
+            bucket
         )
 
         # Save dumps
+        checksums = checksums or {}
         for dump_name, dump in dumps.items():
-            self.conn.save_file(
-                self._get_dump_name_path(crash_id, dump_name),
-                dump
-            )
+            self.save_dump(crash_id, dump_name, dump, bucket, conn, sha256=checksums.get(dump_name))
 
     def save_crash(self, crash_report):
         """Save crash data."""
@@ -141,8 +216,9 @@ class S3CrashStorage(CrashStorageBase):
         raw_crash = crash_report.raw_crash
         dumps = crash_report.dumps
 
-        # Save dumps first
-        self.save_dumps(crash_id, dumps)
+        with mymetrics.timer('save_crash.time', tags=['bucket:%s' % self.get_bucket(crash_id)]):
+            # Save dumps first
+            self.save_dumps(crash_id, dumps, checksums=raw_crash.get('dump_checksums'))
 
-        # Save raw crash
-        self.save_raw_crash(crash_id, raw_crash)
+            # Save raw crash
+            self.save_raw_crash(crash_id, raw_crash)
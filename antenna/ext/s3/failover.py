@@ -0,0 +1,322 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import re
+import time
+
+from everett.component import ConfigOptions
+import gevent
+import markus
+
+from antenna.ext.crashstorage_base import CrashStorageBase
+from antenna.ext.s3.crashstorage import S3CrashStorage
+from antenna.ext.s3.keylayout import RAW_CRASH, read_crash_file
+from antenna.health_resource import HealthState
+from antenna.heartbeat import register_for_verification
+from antenna.util import LRUCache
+
+
+logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('s3failover')
+
+
+class EndpointTimeoutError(Exception):
+    """Raised when saving a crash to an endpoint takes too long."""
+
+
+ENDPOINT_NAME_RE = re.compile(r'^[a-z0-9_]+$', re.I)
+
+
+def parse_endpoint_names(val):
+    """Everett parser for a comma-separated list of endpoint names."""
+    names = [name.strip() for name in val.split(',') if name.strip()]
+    if not names:
+        raise ValueError('at least one endpoint name is required')
+    for name in names:
+        if not ENDPOINT_NAME_RE.match(name):
+            raise ValueError('%r is not a valid endpoint name' % name)
+    if len(set(names)) != len(names):
+        raise ValueError('endpoint names must be unique')
+    return names
+
+
+class Endpoint:
+    """Health and latency state for a single S3 endpoint.
+
+    :arg str name: the name of the endpoint
+    :arg conn: the S3 connection for the endpoint
+
+    """
+
+    #: Weight of the newest sample in the latency moving average
+    latency_weight = 0.2
+
+    def __init__(self, name, conn):
+        self.name = name
+        self.conn = conn
+
+        # Number of consecutive failed saves
+        self.failures = 0
+
+        # Time until which this endpoint is skipped; 0 means it's available
+        self.down_until = 0
+
+        # Exponentially weighted moving average of crash save latency in
+        # seconds or None if there aren't any samples
+        self.latency = None
+
+    def is_available(self, now):
+        """Return whether this endpoint should be tried first."""
+        return self.down_until <= now
+
+    def record_success(self, latency):
+        """Record a successful save and its latency in seconds."""
+        self.failures = 0
+        self.down_until = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = (
+                self.latency_weight * latency + (1 - self.latency_weight) * self.latency
+            )
+
+    def mark_down(self, now, cooldown):
+        """Skip this endpoint for ``cooldown`` seconds."""
+        self.down_until = now + cooldown
+        # Start over when this endpoint is tried again after the cooldown
+        self.latency = None
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return '<Endpoint %s>' % self.name
+
+
+class FailoverS3CrashStorage(S3CrashStorage):
+    """Save raw crash files to the first healthy of several S3 endpoints.
+
+    This is like ``S3CrashStorage``, but it has an ordered list of endpoints.
+    Each endpoint has its own ``S3Connection`` configured in a namespace named
+    after the endpoint. For example::
+
+        CRASHSTORAGE_CLASS=antenna.ext.s3.failover.FailoverS3CrashStorage
+        CRASHSTORAGE_ENDPOINTS=uswest,useast
+
+        CRASHSTORAGE_USWEST_REGION=us-west-2
+        CRASHSTORAGE_USWEST_BUCKET_NAME=crashes-uswest
+
+        CRASHSTORAGE_USEAST_REGION=us-east-1
+        CRASHSTORAGE_USEAST_BUCKET_NAME=crashes-useast
+
+    Each crash is saved to the first available endpoint in order. All of a
+    crash's files are saved to the same endpoint. If saving to an endpoint
+    fails, the whole crash is saved to the next endpoint.
+
+    Files are saved without ``S3Connection.save_file``'s retries: the next
+    endpoint is the retry. Saving a crash to one endpoint can take at most
+    ``ENDPOINT_TIMEOUT`` seconds before it counts as failed.
+
+    A crash that failed partway through can leave some of its dumps in an
+    endpoint, but never its raw crash because that's saved last. Those dumps
+    aren't cleaned up, so use a lifecycle rule to expire them. A save that
+    timed out can still finish in S3 after the crash was saved to the next
+    endpoint, so a crash can be in more than one endpoint.
+
+    After ``FAILURE_THRESHOLD`` consecutive failed saves, or if the average
+    save latency goes over ``LATENCY_THRESHOLD``, an endpoint is skipped for
+    ``COOLDOWN`` seconds. After that, it's tried again in order, so crashes
+    fail back to earlier endpoints once they've recovered.
+
+    The name of the endpoint the crash was saved to is recorded in the raw
+    crash in ``storage_endpoint``. Readers can use ``find_crash_endpoint`` to
+    find a crash when they don't have the raw crash.
+
+    The node is only unhealthy if every endpoint is unhealthy.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'endpoints',
+        parser=parse_endpoint_names,
+        doc=(
+            'Comma-separated list of endpoint names in order of preference. Each '
+            'endpoint is configured in a namespace with that name.'
+        )
+    )
+    required_config.add_option(
+        'failure_threshold',
+        default='1',
+        parser=int,
+        doc='Number of consecutive failed saves after which an endpoint is skipped.'
+    )
+    required_config.add_option(
+        'latency_threshold',
+        default='0',
+        parser=float,
+        doc=(
+            'Average crash save latency in seconds after which an endpoint is '
+            'skipped. 0 disables this.'
+        )
+    )
+    required_config.add_option(
+        'cooldown',
+        default='60',
+        parser=float,
+        doc='Seconds to skip an endpoint for before trying it again.'
+    )
+    required_config.add_option(
+        'endpoint_timeout',
+        default='10',
+        parser=float,
+        doc=(
+            'Seconds saving a crash to an endpoint can take before trying the next '
+            'endpoint. 0 disables this.'
+        )
+    )
+
+    def __init__(self, config):
+        CrashStorageBase.__init__(self, config)
+        self.layout = self.config('key_layout_class')(config)
+        self.dedupe_cache = LRUCache(self.config('dedupe_cache_size'))
+        self.endpoints = [
+            Endpoint(name, self.config('connection_class')(config.with_namespace(name)))
+            for name in self.config('endpoints')
+        ]
+        self.conn = self.endpoints[0].conn
+        register_for_verification(self.verify_write_to_bucket)
+
+    def verify_write_to_bucket(self):
+        """Verify S3 buckets exist and can be written to for all endpoints."""
+        for endpoint in self.endpoints:
+            endpoint.conn.verify_write_to_bucket()
+            endpoint.conn.warm_up()
+
+    def get_runtime_config(self, namespace=None):
+        """Return generator for items in runtime configuration."""
+        for item in CrashStorageBase.get_runtime_config(self, namespace):
+            yield item
+
+        for item in self.layout.get_runtime_config(namespace):
+            yield item
+
+        namespace = namespace or []
+        for endpoint in self.endpoints:
+            for item in endpoint.conn.get_runtime_config(namespace + [endpoint.name]):
+                yield item
+
+    def check_health(self, state):
+        """Check health of all endpoints."""
+        healthy = 0
+        errors = []
+        for endpoint in self.endpoints:
+            endpoint_state = HealthState()
+            endpoint.conn.check_health(endpoint_state)
+            if endpoint_state.is_healthy():
+                healthy += 1
+            errors.extend(
+                '%s: %s' % (endpoint.name, error['msg']) for error in endpoint_state.errors
+            )
+            state.add_statsd(self, 'endpoint.%s.healthy' % endpoint.name, int(endpoint_state.is_healthy()))
+            state.add_statsd(self, 'endpoint.%s.available' % endpoint.name, int(endpoint.is_available(time.time())))
+
+        if healthy == 0:
+            for error in errors:
+                state.add_error('FailoverS3CrashStorage', error)
+
+    def get_endpoints(self):
+        """Return endpoints in the order they should be tried."""
+        now = time.time()
+        available = [endpoint for endpoint in self.endpoints if endpoint.is_available(now)]
+        unavailable = [endpoint for endpoint in self.endpoints if not endpoint.is_available(now)]
+
+        # If everything is down, try everything anyway--it's better than
+        # putting the crash back in the queue
+        return available + unavailable
+
+    def record_failure(self, endpoint):
+        """Record a failed save to an endpoint."""
+        endpoint.failures += 1
+        mymetrics.incr('save_failed.count', tags=['endpoint:%s' % endpoint.name])
+        if endpoint.failures >= self.config('failure_threshold'):
+            logger.warning('%s: failed %d times; skipping', endpoint.name, endpoint.failures)
+            mymetrics.incr('endpoint_down.count', tags=['endpoint:%s' % endpoint.name, 'reason:errors'])
+            endpoint.mark_down(time.time(), self.config('cooldown'))
+
+    def record_success(self, endpoint, latency):
+        """Record a successful save to an endpoint."""
+        endpoint.record_success(latency)
+
+        # NOTE: time.time returns seconds, but .timing() wants
+        # milliseconds, so we multiply!
+        mymetrics.timing('save_crash.time', value=latency * 1000, tags=['endpoint:%s' % endpoint.name])
+
+        latency_threshold = self.config('latency_threshold')
+        if latency_threshold > 0 and endpoint.latency > latency_threshold:
+            logger.warning('%s: average latency %.2fs; skipping', endpoint.name, endpoint.latency)
+            mymetrics.incr('endpoint_down.count', tags=['endpoint:%s' % endpoint.name, 'reason:latency'])
+            endpoint.mark_down(time.time(), self.config('cooldown'))
+
+    def _save_file(self, conn, path, data, bucket):
+        """Save a single file without retrying."""
+        conn.save_file_once(path, data, bucket=bucket)
+
+    def save_crash(self, crash_report):
+        """Save crash data to the first endpoint that works.
+
+        :raises Exception: whatever the last endpoint raised if saving failed
+            for all endpoints
+
+        """
+        crash_id = crash_report.crash_id
+        raw_crash = crash_report.raw_crash
+        dumps = crash_report.dumps
+
+        exc = None
+        for i, endpoint in enumerate(self.get_endpoints()):
+            if i > 0:
+                mymetrics.incr('failover.count', tags=['endpoint:%s' % endpoint.name])
+
+            raw_crash['storage_endpoint'] = endpoint.name
+            start_time = time.time()
+            endpoint_timeout = self.config('endpoint_timeout') or None
+            try:
+                with gevent.Timeout(
+                    endpoint_timeout,
+                    EndpointTimeoutError('timed out after %ss' % endpoint_timeout)
+                ):
+                    # Save dumps first
+                    self.save_dumps(
+                        crash_id, dumps, conn=endpoint.conn, checksums=raw_crash.get('dump_checksums')
+                    )
+
+                    # Save raw crash
+                    self.save_raw_crash(crash_id, raw_crash, conn=endpoint.conn)
+            except Exception as save_exc:
+                logger.exception('%s: failed to save to %s', crash_id, endpoint.name)
+                exc = save_exc
+                self.record_failure(endpoint)
+                continue
+
+            self.record_success(endpoint, time.time() - start_time)
+            return
+
+        raise exc
+
+
+def find_crash_endpoint(storage, crash_id):
+    """Return the endpoint a crash was saved to.
+
+    This looks for the raw crash in every endpoint in configuration order.
+
+    :arg FailoverS3CrashStorage storage: the crash storage
+    :arg str crash_id: the crash id
+
+    :returns: endpoint name or None if the crash isn't in any endpoint
+
+    """
+    for endpoint in storage.endpoints:
+        if read_crash_file(endpoint.conn, storage.layout, RAW_CRASH, crash_id) is not None:
+            return endpoint.name
+    return None
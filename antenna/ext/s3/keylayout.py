@@ -0,0 +1,307 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import logging
+
+from botocore.client import ClientError
+from everett.component import ConfigOptions, RequiredConfigMixin
+from everett.manager import ConfigManager
+
+from antenna.util import get_date_from_crash_id
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Object types that get saved to S3
+RAW_CRASH = 'raw_crash'
+DUMP_NAMES = 'dump_names'
+DUMP = 'dump'
+DUMP_HASH = 'dump_hash'
+
+
+#: Key templates for the layout Antenna has always used
+DEFAULT_TEMPLATES = {
+    RAW_CRASH: 'v2/raw_crash/{entropy}/{date}/{crash_id}',
+    DUMP_NAMES: 'v1/dump_names/{crash_id}',
+    DUMP: 'v1/{dump_name}/{crash_id}',
+    DUMP_HASH: 'v1/dump_by_hash/{entropy}/{sha256}',
+}
+
+#: Dump pointers start with this
+DUMP_POINTER_PREFIX = b'antenna-dump-pointer:v1\n'
+
+
+def encode_dump_pointer(key, sha256, size):
+    """Return a pointer to a dump saved by content hash as bytes."""
+    return DUMP_POINTER_PREFIX + json.dumps(
+        {'key': key, 'sha256': sha256, 'size': size},
+        sort_keys=True
+    ).encode('utf-8')
+
+
+def decode_dump_pointer(data):
+    """Return the dump pointer dict or None if data isn't a dump pointer."""
+    if not data.startswith(DUMP_POINTER_PREFIX):
+        return None
+    return json.loads(data[len(DUMP_POINTER_PREFIX):].decode('utf-8'))
+
+
+def entropy_crash_id(crash_id, length):
+    """Return the first ``length`` characters of the crash id."""
+    return crash_id[:length]
+
+
+def entropy_sha256(crash_id, length):
+    """Return the first ``length`` characters of the crash id's sha256."""
+    return hashlib.sha256(crash_id.encode('utf-8')).hexdigest()[:length]
+
+
+ENTROPY_SCHEMES = {
+    'crash_id': entropy_crash_id,
+    'sha256': entropy_sha256,
+}
+
+
+def get_bucket_for_crash_id(crash_id, buckets):
+    """Return the bucket a crash is saved to.
+
+    All the objects for a crash are saved to the same bucket which is picked
+    using a hash of the crash id.
+
+    :arg str crash_id: the crash id
+    :arg list buckets: the list of bucket names in configuration order
+
+    :returns: bucket name
+
+    """
+    if len(buckets) == 1:
+        return buckets[0]
+    index = int(hashlib.sha256(crash_id.encode('utf-8')).hexdigest()[:8], 16) % len(buckets)
+    return buckets[index]
+
+
+def parse_entropy_scheme(val):
+    """Everett parser for entropy scheme names."""
+    if val not in ENTROPY_SCHEMES:
+        raise ValueError(
+            '%r is not a valid entropy scheme; choose from %s' % (val, ', '.join(sorted(ENTROPY_SCHEMES)))
+        )
+    return val
+
+
+class S3KeyLayout(RequiredConfigMixin):
+    """Generates S3 keys for the objects of a crash.
+
+    Keys are generated from templates--one per object type. Templates can use
+    these fields:
+
+    * ``{crash_id}``: the crash id; this is required
+    * ``{date}``: the date from the crash id in ``YYYYMMDD`` format
+    * ``{entropy}``: ``ENTROPY_LENGTH`` characters of entropy generated using
+      ``ENTROPY_SCHEME``
+    * ``{dump_name}``: the dump name; only for dump keys
+
+    Dumps saved by content hash aren't tied to a crash. Their template uses
+    these fields instead:
+
+    * ``{sha256}``: the sha256 of the dump; this is required
+    * ``{entropy}``: the first ``ENTROPY_LENGTH`` characters of the sha256
+
+    S3 partitions the key space by prefix and limits request rates per
+    partition. Putting ``{entropy}`` at the beginning of a key spreads writes
+    across partitions. For example::
+
+        CRASHSTORAGE_DUMP_KEY_TEMPLATE={entropy}/v1/{dump_name}/{crash_id}
+
+    The defaults are the layout Antenna has always used. If you change the
+    layout, readers need to look for objects in both layouts until the old
+    objects expire. Use ``S3KeyLayout.get_read_paths`` and ``read_crash_file``
+    for that.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'raw_crash_key_template',
+        default=DEFAULT_TEMPLATES[RAW_CRASH],
+        doc='Template for raw crash keys.'
+    )
+    required_config.add_option(
+        'dump_names_key_template',
+        default=DEFAULT_TEMPLATES[DUMP_NAMES],
+        doc='Template for dump_names keys.'
+    )
+    required_config.add_option(
+        'dump_key_template',
+        default=DEFAULT_TEMPLATES[DUMP],
+        doc='Template for dump keys.'
+    )
+    required_config.add_option(
+        'dump_hash_key_template',
+        default=DEFAULT_TEMPLATES[DUMP_HASH],
+        doc='Template for keys of dumps saved by content hash.'
+    )
+    required_config.add_option(
+        'entropy_scheme',
+        default='crash_id',
+        parser=parse_entropy_scheme,
+        doc=(
+            'How to generate ``{entropy}``: ``crash_id`` uses the beginning of the '
+            'crash id and ``sha256`` uses the beginning of the sha256 of the crash id.'
+        )
+    )
+    required_config.add_option(
+        'entropy_length',
+        default='3',
+        parser=int,
+        doc='Number of characters of entropy to use for ``{entropy}``.'
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.templates = {
+            RAW_CRASH: self.config('raw_crash_key_template'),
+            DUMP_NAMES: self.config('dump_names_key_template'),
+            DUMP: self.config('dump_key_template'),
+            DUMP_HASH: self.config('dump_hash_key_template'),
+        }
+        self.entropy_fun = ENTROPY_SCHEMES[self.config('entropy_scheme')]
+        self.entropy_length = self.config('entropy_length')
+
+        for kind, template in self.templates.items():
+            self.validate_template(kind, template)
+
+    def validate_template(self, kind, template):
+        """Verify a template generates keys.
+
+        :raises ValueError: if the template is invalid
+
+        """
+        if kind == DUMP_HASH:
+            required_field = 'sha256'
+            fields = {'entropy': '', 'sha256': ''}
+        else:
+            required_field = 'crash_id'
+            fields = {'entropy': '', 'date': '', 'crash_id': '', 'dump_name': ''}
+
+        if '{%s}' % required_field not in template:
+            raise ValueError('%s key template %r must contain {%s}' % (kind, template, required_field))
+        try:
+            template.format(**fields)
+        except (KeyError, IndexError, ValueError) as exc:
+            raise ValueError('%s key template %r is invalid: %r' % (kind, template, exc))
+
+    def _format(self, template, crash_id, dump_name=None):
+        return template.format(
+            entropy=self.entropy_fun(crash_id, self.entropy_length),
+            date=get_date_from_crash_id(crash_id),
+            crash_id=crash_id,
+            dump_name=dump_name,
+        )
+
+    def get_raw_crash_path(self, crash_id):
+        """Return key for the raw crash."""
+        return self._format(self.templates[RAW_CRASH], crash_id)
+
+    def get_dump_names_path(self, crash_id):
+        """Return key for the list of dump names."""
+        return self._format(self.templates[DUMP_NAMES], crash_id)
+
+    def get_dump_name_path(self, crash_id, dump_name):
+        """Return key for a dump."""
+        # NOTE(willkg): This is something that Socorro collector did. I'm not
+        # really sure why, but in order to maintain backwards compatability, we
+        # need to keep doing it.
+        if dump_name in (None, '', 'upload_file_minidump'):
+            dump_name = 'dump'
+
+        return self._format(self.templates[DUMP], crash_id, dump_name=dump_name)
+
+    def get_dump_hash_path(self, sha256):
+        """Return key for a dump saved by content hash."""
+        return self.templates[DUMP_HASH].format(
+            entropy=sha256[:self.entropy_length],
+            sha256=sha256,
+        )
+
+    def get_path(self, kind, crash_id, dump_name=None):
+        """Return key for an object type.
+
+        For ``dump_hash`` objects, pass the sha256 of the dump as ``crash_id``.
+
+        """
+        if kind == DUMP_HASH:
+            return self.get_dump_hash_path(crash_id)
+        if kind == RAW_CRASH:
+            return self.get_raw_crash_path(crash_id)
+        if kind == DUMP_NAMES:
+            return self.get_dump_names_path(crash_id)
+        if kind == DUMP:
+            return self.get_dump_name_path(crash_id, dump_name)
+        raise ValueError('%r is not a valid object type' % kind)
+
+    def get_read_paths(self, kind, crash_id, dump_name=None):
+        """Return keys to look for an object in, most likely first.
+
+        This is the key in this layout followed by the key in the default
+        layout if it's different. Use this when reading crashes while migrating
+        from one layout to another.
+
+        """
+        paths = [self.get_path(kind, crash_id, dump_name)]
+        default_path = DEFAULT_LAYOUT.get_path(kind, crash_id, dump_name)
+        if default_path not in paths:
+            paths.append(default_path)
+        return paths
+
+
+#: The layout Antenna has always used
+DEFAULT_LAYOUT = S3KeyLayout(ConfigManager.from_dict({}))
+
+
+def read_crash_file(conn, layout, kind, crash_id, dump_name=None):
+    """Read an object for a crash trying every key it could be at.
+
+    :arg S3Connection conn: the connection to read with
+    :arg S3KeyLayout layout: the key layout
+    :arg str kind: ``raw_crash``, ``dump_names`` or ``dump``
+    :arg str crash_id: the crash id
+    :arg str dump_name: the dump name for ``dump`` objects
+
+    If the object is a dump pointer, this returns the dump it points to.
+
+    :returns: bytes or None if the object isn't in any of the keys
+
+    :raises botocore.exceptions.ClientError: connection issues, permissions
+        issues, bucket is missing, etc.
+
+    """
+    bucket = get_bucket_for_crash_id(crash_id, conn.buckets)
+    data = _load_first(conn, bucket, crash_id, layout.get_read_paths(kind, crash_id, dump_name))
+    pointer = decode_dump_pointer(data) if kind == DUMP and data is not None else None
+    if pointer is None:
+        return data
+
+    # The pointer has the key the dump was saved at, but if that's gone, the
+    # dump could be at the key for its hash in either layout
+    paths = [pointer['key']]
+    for path in layout.get_read_paths(DUMP_HASH, pointer['sha256']):
+        if path not in paths:
+            paths.append(path)
+    return _load_first(conn, bucket, crash_id, paths)
+
+
+def _load_first(conn, bucket, crash_id, paths):
+    """Return the data at the first key that exists or None."""
+    for path in paths:
+        try:
+            return conn.load_file(path, bucket=bucket)
+        except ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+            logger.debug('%s not found at %s', crash_id, path)
+    return None
@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import logging
+import os
+
+from everett.component import ConfigOptions
+from everett.manager import parse_bool
+from gevent.threadpool import ThreadPool
+import markus
+
+from antenna.ext.crashstorage_base import CrashStorageBase
+from antenna.ext.fs.crashstorage import run_in_threadpool
+from antenna.ext.segmentlog.segment import (
+    INDEX_SUFFIX,
+    SEGMENT_SUFFIX,
+    encode_index_entry,
+    encode_record,
+)
+
+
+logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('segmentlog')
+
+
+class SegmentLogCrashStorage(CrashStorageBase):
+    """Append crashes to segment files on the file system.
+
+    ``FSCrashStorage`` writes three or more small files per crash. At high
+    crash rates, that's millions of inodes a day and directory scans get slow.
+    This instead appends each crash as one record to a segment file and
+    rotates segments when they reach ``SEGMENT_MAX_SIZE`` bytes::
+
+        <FS_ROOT>/
+            <SEGMENT>.log
+            <SEGMENT>.idx
+
+    Each segment has an index file of crash id to offset and length of the
+    record in the segment. Segment names are the time the segment was started,
+    the process id and a sequence number, so processes sharing ``FS_ROOT``
+    never write to the same segment.
+
+    Records are appended in a threadpool with one native thread, so appends
+    don't block other requests and records are appended one at a time in the
+    order crashes were saved.
+
+    Use ``antenna.ext.segmentlog.segment.SegmentLogReader`` to read crashes
+    and ``bin/rebuild_segmentlog_index.py`` to rebuild index files.
+
+    Couple of things to note:
+
+    1. This doesn't ever delete anything. You should run another process to
+       clean things up. Segments other than the one being written to are never
+       written to again.
+
+    2. If the process dies while appending a record, the end of the segment
+       can have a partial record or records that aren't in the index.
+       Readers skip partial records. Rebuild the index to pick up the rest.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'fs_root',
+        default='/tmp/antenna_segments',  # nosec
+        doc='path to where segment files should be stored'
+    )
+    required_config.add_option(
+        'segment_max_size',
+        default=str(256 * 1024 * 1024),
+        parser=int,
+        doc='size in bytes after which a new segment is started'
+    )
+    required_config.add_option(
+        'fsync',
+        default='false',
+        parser=parse_bool,
+        doc='whether to fsync the segment and index after every crash'
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.root = os.path.abspath(self.config('fs_root')).rstrip(os.sep)
+        self.segment_max_size = self.config('segment_max_size')
+        self.fsync = self.config('fsync')
+
+        # One thread so appends happen one at a time; the segment state below
+        # is only used in that thread
+        self.threadpool = ThreadPool(1)
+
+        self.sequence = 0
+        self.segment = None
+        self.segment_fp = None
+        self.index_fp = None
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def _run_in_threadpool(self, fun, *args, **kwargs):
+        """Call a function in the threadpool and wait for it to return."""
+        return run_in_threadpool(self.threadpool, mymetrics, fun, *args, **kwargs)
+
+    def _open_segment(self):
+        """Close the current segment and start a new one."""
+        self._close_segment()
+
+        self.sequence += 1
+        self.segment = '%s-%d-%06d' % (
+            datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+            os.getpid(),
+            self.sequence
+        )
+        self.segment_fp = open(os.path.join(self.root, self.segment + SEGMENT_SUFFIX), 'ab')
+        self.index_fp = open(os.path.join(self.root, self.segment + INDEX_SUFFIX), 'ab')
+
+    def _close_segment(self):
+        if self.segment_fp is not None:
+            self.segment_fp.close()
+            self.index_fp.close()
+        self.segment = None
+        self.segment_fp = None
+        self.index_fp = None
+
+    def close(self):
+        """Close the current segment."""
+        self._run_in_threadpool(self._close_segment)
+
+    def _append(self, crash_id, record):
+        """Append a record to the current segment and index.
+
+        NOTE: This runs in the threadpool, so it shouldn't log, emit metrics or
+        touch anything the hub uses.
+
+        :returns: the name of the new segment if one was started or None
+
+        """
+        new_segment = None
+        if self.segment_fp is None or self.segment_fp.tell() >= self.segment_max_size:
+            self._open_segment()
+            new_segment = self.segment
+
+        offset = self.segment_fp.tell()
+        try:
+            self.segment_fp.write(record)
+            self.segment_fp.flush()
+            if self.fsync:
+                os.fsync(self.segment_fp.fileno())
+
+            self.index_fp.write(encode_index_entry(crash_id, offset, len(record)))
+            self.index_fp.flush()
+            if self.fsync:
+                os.fsync(self.index_fp.fileno())
+        except Exception:
+            # The segment might end in a partial record now, so don't append
+            # anything else to it
+            self._close_segment()
+            raise
+        return new_segment
+
+    def save_crash(self, crash_report):
+        """Append crash to the current segment."""
+        record = encode_record(crash_report.crash_id, crash_report.raw_crash, crash_report.dumps)
+
+        new_segment = self._run_in_threadpool(self._append, crash_report.crash_id, record)
+        if new_segment is not None:
+            logger.info('Started segment %s', new_segment)
+            mymetrics.incr('segment_started.count')
+        mymetrics.histogram('record_size', value=len(record))
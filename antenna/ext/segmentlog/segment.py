@@ -0,0 +1,258 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Segment log file format.
+
+A segment log is a directory of segment files and their index files::
+
+    <ROOT>/
+        <SEGMENT>.log
+        <SEGMENT>.idx
+
+A segment file is a sequence of crash records. Each record is:
+
+* a header: ``ACR1`` magic, the 36 character crash id, the length of the
+  payload and the crc32 of the payload
+* the payload: a 4 byte length and a JSON header with the raw crash and a list
+  of ``[dump_name, length]`` followed by the dumps in that order
+
+An index file is a sequence of fixed size entries of the crash id and the
+offset and length of the record in the segment with the same name. Index
+entries are appended after the record is appended, so a segment can have
+records at the end that aren't in the index if the process died in between.
+Use ``rebuild_index`` to fix that.
+
+All integers are big-endian.
+
+"""
+
+import binascii
+import json
+import logging
+import os
+import struct
+
+from antenna.util import json_ordered_dumps
+
+
+logger = logging.getLogger(__name__)
+
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+RECORD_MAGIC = b'ACR1'
+RECORD_HEADER = struct.Struct('>4s36sII')
+PAYLOAD_HEADER_LENGTH = struct.Struct('>I')
+INDEX_ENTRY = struct.Struct('>36sQI')
+
+
+class CorruptRecordError(Exception):
+    """The record at an offset in a segment is truncated or corrupt."""
+
+
+def encode_record(crash_id, raw_crash, dumps):
+    """Return a crash record as bytes.
+
+    :arg str crash_id: the crash id
+    :arg dict raw_crash: the raw crash
+    :arg dict dumps: dump name -> dump
+
+    """
+    dump_names = sorted(dumps.keys())
+    header = json_ordered_dumps({
+        'raw_crash': raw_crash,
+        'dumps': [[dump_name, len(dumps[dump_name])] for dump_name in dump_names],
+    }).encode('utf-8')
+
+    payload = b''.join(
+        [PAYLOAD_HEADER_LENGTH.pack(len(header)), header] +
+        [dumps[dump_name] for dump_name in dump_names]
+    )
+    return RECORD_HEADER.pack(
+        RECORD_MAGIC,
+        crash_id.encode('ascii'),
+        len(payload),
+        binascii.crc32(payload)
+    ) + payload
+
+
+def decode_payload(payload):
+    """Return ``(raw_crash, dumps)`` for a record payload."""
+    header_length = PAYLOAD_HEADER_LENGTH.unpack_from(payload)[0]
+    start = PAYLOAD_HEADER_LENGTH.size
+    header = json.loads(payload[start:start + header_length].decode('utf-8'))
+
+    dumps = {}
+    offset = start + header_length
+    for dump_name, length in header['dumps']:
+        dumps[dump_name] = payload[offset:offset + length]
+        offset += length
+    return header['raw_crash'], dumps
+
+
+def read_record(fp, offset):
+    """Read the record at an offset in an open segment file.
+
+    :returns: ``(crash_id, payload, record_length)``
+
+    :raises CorruptRecordError: if the record is truncated or corrupt
+
+    """
+    fp.seek(offset)
+    header = fp.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        raise CorruptRecordError('truncated header at %d' % offset)
+
+    magic, crash_id, payload_length, crc = RECORD_HEADER.unpack(header)
+    if magic != RECORD_MAGIC:
+        raise CorruptRecordError('bad magic at %d' % offset)
+
+    payload = fp.read(payload_length)
+    if len(payload) < payload_length:
+        raise CorruptRecordError('truncated payload at %d' % offset)
+    if binascii.crc32(payload) != crc:
+        raise CorruptRecordError('bad crc at %d' % offset)
+
+    return crash_id.rstrip(b'\x00').decode('ascii'), payload, RECORD_HEADER.size + payload_length
+
+
+def iter_records(segment_path):
+    """Yield ``(crash_id, offset, length, payload)`` for records in a segment.
+
+    This stops at the first truncated or corrupt record and logs a warning.
+
+    """
+    with open(segment_path, 'rb') as fp:
+        offset = 0
+        size = os.fstat(fp.fileno()).st_size
+        while offset < size:
+            try:
+                crash_id, payload, length = read_record(fp, offset)
+            except CorruptRecordError as exc:
+                logger.warning('%s: stopped reading: %s', segment_path, exc)
+                return
+            yield crash_id, offset, length, payload
+            offset += length
+
+
+def encode_index_entry(crash_id, offset, length):
+    """Return an index entry as bytes."""
+    return INDEX_ENTRY.pack(crash_id.encode('ascii'), offset, length)
+
+
+def read_index(index_path):
+    """Yield ``(crash_id, offset, length)`` for entries in an index file.
+
+    A partially written entry at the end is ignored.
+
+    """
+    with open(index_path, 'rb') as fp:
+        data = fp.read()
+
+    usable = len(data) - (len(data) % INDEX_ENTRY.size)
+    for crash_id, offset, length in INDEX_ENTRY.iter_unpack(data[:usable]):
+        yield crash_id.rstrip(b'\x00').decode('ascii'), offset, length
+
+
+def list_segments(root):
+    """Return sorted list of segment names in a segment log directory."""
+    return sorted(
+        fn[:-len(SEGMENT_SUFFIX)]
+        for fn in os.listdir(root)
+        if fn.endswith(SEGMENT_SUFFIX) and not fn.startswith('.')
+    )
+
+
+def rebuild_index(root, segment):
+    """Rebuild the index file for a segment by scanning the segment.
+
+    The new index is written to a temp file and renamed into place.
+
+    :arg str root: the segment log directory
+    :arg str segment: the segment name
+
+    :returns: number of records in the index
+
+    """
+    segment_path = os.path.join(root, segment + SEGMENT_SUFFIX)
+    index_path = os.path.join(root, segment + INDEX_SUFFIX)
+    tmp_path = os.path.join(root, '.' + segment + INDEX_SUFFIX)
+
+    count = 0
+    with open(tmp_path, 'wb') as fp:
+        for crash_id, offset, length, payload in iter_records(segment_path):
+            fp.write(encode_index_entry(crash_id, offset, length))
+            count += 1
+    os.rename(tmp_path, index_path)
+    return count
+
+
+class SegmentLogReader:
+    """Reads crashes from a segment log directory.
+
+    Usage::
+
+        reader = SegmentLogReader('/data/antenna_segments')
+        raw_crash, dumps = reader.get_crash(crash_id)
+
+    The index is loaded when the reader is created. Call ``load_index`` to
+    pick up crashes saved since then.
+
+    :arg str root: the segment log directory
+
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index = {}
+        self.load_index()
+
+    def load_index(self):
+        """Load index files for all segments.
+
+        If a crash is in more than one segment, the latest one wins.
+
+        """
+        index = {}
+        for segment in list_segments(self.root):
+            index_path = os.path.join(self.root, segment + INDEX_SUFFIX)
+            if not os.path.exists(index_path):
+                logger.warning('%s has no index; use rebuild_index', segment)
+                continue
+            for crash_id, offset, length in read_index(index_path):
+                index[crash_id] = (segment, offset, length)
+        self.index = index
+
+    def __contains__(self, crash_id):
+        return crash_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_crash(self, crash_id):
+        """Return ``(raw_crash, dumps)`` for a crash.
+
+        :raises KeyError: if the crash isn't in the index
+        :raises CorruptRecordError: if the record is corrupt
+
+        """
+        segment, offset, length = self.index[crash_id]
+        with open(os.path.join(self.root, segment + SEGMENT_SUFFIX), 'rb') as fp:
+            record_crash_id, payload, record_length = read_record(fp, offset)
+        if record_crash_id != crash_id or record_length != length:
+            raise CorruptRecordError('index for %s points at wrong record' % crash_id)
+        return decode_payload(payload)
+
+    def iter_crashes(self):
+        """Yield ``(crash_id, raw_crash, dumps)`` for every record in order.
+
+        This scans segments and doesn't use the index.
+
+        """
+        for segment in list_segments(self.root):
+            segment_path = os.path.join(self.root, segment + SEGMENT_SUFFIX)
+            for crash_id, offset, length, payload in iter_records(segment_path):
+                raw_crash, dumps = decode_payload(payload)
+                yield crash_id, raw_crash, dumps
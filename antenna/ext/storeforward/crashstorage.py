@@ -0,0 +1,430 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+from everett.component import ConfigOptions
+from everett.manager import parse_bool, parse_class
+import gevent
+from gevent.pool import Pool
+from gevent.threadpool import ThreadPool
+import markus
+
+from antenna.breakpad_resource import CrashReport
+from antenna.ext.crashstorage_base import CrashStorageBase
+from antenna.ext.fs.crashstorage import (
+    GroupCommitter,
+    PendingFile,
+    commit_files,
+    run_in_threadpool,
+)
+from antenna.ext.segmentlog.segment import decode_payload, encode_record, read_record
+from antenna.heartbeat import register_for_heartbeat
+
+
+logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('storeforward')
+
+
+SPOOL_SUFFIX = '.crash'
+
+#: Name of the lock file in each process's spool directory
+SPOOL_LOCK = 'lock'
+
+
+class StoreAndForwardCrashStorage(CrashStorageBase):
+    """Save crashes to a local spool and forward them to other crash storage.
+
+    When remote crash storage like S3 is slow, crashes pile up in memory in
+    the crashmover queue. This saves each crash to one file in ``SPOOL_DIR``
+    and counts that as saved. Forwarders running in the background then save
+    spooled crashes to the remote crash storage, publish them and remove the
+    spool files.
+
+    The spool directory is the forwarder's progress: crashes in it haven't been
+    forwarded yet. Each process spools to its own directory in ``SPOOL_DIR``
+    named after its pid and holds an exclusive ``flock`` on a lock file in it
+    for as long as it runs. At startup, a process claims the directories of
+    processes that died: it locks the directory, moves the spooled crashes
+    into its own directory and queues them for forwarding. Directories that
+    are locked belong to live processes and are left alone, so nothing is lost
+    if a process is restarted and no crash is forwarded twice.
+
+    Spool files are written, fsynced, read and removed in a threadpool of
+    ``THREADPOOL_SIZE`` native threads so they don't block other requests.
+    Spooled crashes are fsynced together in batches like ``FSCrashStorage``
+    does in ``group`` fsync mode.
+
+    Failed forwards are retried forever with exponential backoff starting at
+    ``RETRY_DELAY`` seconds up to ``MAX_RETRY_DELAY`` seconds.
+
+    The remote crash storage is configured in the ``REMOTE`` namespace and the
+    crash publisher in the ``PUBLISH`` namespace. For example::
+
+        CRASHSTORAGE_CLASS=antenna.ext.storeforward.crashstorage.StoreAndForwardCrashStorage
+        CRASHSTORAGE_SPOOL_DIR=/data/antenna_spool
+
+        CRASHSTORAGE_REMOTE_CLASS=antenna.ext.s3.crashstorage.S3CrashStorage
+        CRASHSTORAGE_REMOTE_BUCKET_NAME=crashes
+
+        CRASHSTORAGE_PUBLISH_CLASS=antenna.ext.pubsub.crashpublish.PubSubCrashPublish
+        CRASHSTORAGE_PUBLISH_PROJECT_ID=...
+
+    .. Note::
+
+       Crashes have to be published after they're in the remote crash storage,
+       so set ``CRASHPUBLISH_CLASS`` to
+       ``antenna.ext.crashpublish_base.NoOpCrashPublish`` and configure the
+       publisher here instead.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'spool_dir',
+        default='/tmp/antenna_spool',  # nosec
+        doc=(
+            'path to where crashes are spooled until they are forwarded; each '
+            'process uses a directory in it'
+        )
+    )
+    required_config.add_option(
+        'remote_class',
+        default='antenna.ext.s3.crashstorage.S3CrashStorage',
+        parser=parse_class,
+        doc='the crash storage class to forward crashes to'
+    )
+    required_config.add_option(
+        'publish_class',
+        default='antenna.ext.crashpublish_base.NoOpCrashPublish',
+        parser=parse_class,
+        doc='the crash publish class to publish forwarded crashes with'
+    )
+    required_config.add_option(
+        'forward_concurrency',
+        default='2',
+        parser=int,
+        doc='number of crashes to forward at the same time'
+    )
+    required_config.add_option(
+        'retry_delay',
+        default='1',
+        parser=float,
+        doc='seconds to wait before retrying a failed forward the first time'
+    )
+    required_config.add_option(
+        'max_retry_delay',
+        default='300',
+        parser=float,
+        doc='maximum seconds to wait before retrying a failed forward'
+    )
+    required_config.add_option(
+        'fsync',
+        default='true',
+        parser=parse_bool,
+        doc='whether to fsync spooled crashes before they count as saved'
+    )
+    required_config.add_option(
+        'group_commit_window',
+        default='0.01',
+        parser=float,
+        doc='Seconds to batch spooled crashes for before fsyncing them'
+    )
+    required_config.add_option(
+        'threadpool_size',
+        default='4',
+        parser=int,
+        doc=(
+            'Number of native threads for blocking file system calls; 0 makes '
+            'them in the calling greenlet'
+        )
+    )
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.remote = self.config('remote_class')(config.with_namespace('remote'))
+        self.publish = self.config('publish_class')(config.with_namespace('publish'))
+        self.spool_root = os.path.abspath(self.config('spool_dir'))
+        self.fsync = self.config('fsync')
+        threadpool_size = self.config('threadpool_size')
+        self.threadpool = ThreadPool(threadpool_size) if threadpool_size > 0 else None
+        self.group_committer = GroupCommitter(
+            self.config('group_commit_window'),
+            run=self._run_in_threadpool
+        )
+
+        # Gevent pool for forwarders
+        self.forwarder_pool = Pool(size=self.config('forward_concurrency'))
+
+        # Crash ids to forward
+        self.forward_queue = deque()
+
+        # Crash id -> number of failed forwards
+        self.failures = {}
+
+        # Number of crashes waiting to be retried
+        self.retry_pending = 0
+
+        # This process's spool directory and the fd of its locked lock file
+        self.spool_dir, self.lock_fd = self._create_spool_dir()
+        self.load_spool()
+
+        register_for_heartbeat(self.hb_report_health_stats)
+        register_for_heartbeat(self.hb_run_forwarder)
+
+    def get_runtime_config(self, namespace=None):
+        """Return generator for items in runtime configuration."""
+        for item in super().get_runtime_config(namespace):
+            yield item
+
+        namespace = namespace or []
+        for item in self.remote.get_runtime_config(namespace + ['remote']):
+            yield item
+
+        for item in self.publish.get_runtime_config(namespace + ['publish']):
+            yield item
+
+    def check_health(self, state):
+        """Report spool size.
+
+        The remote crash storage being unhealthy doesn't make this unhealthy.
+        That's the point of spooling.
+
+        """
+        state.add_statsd(self, 'spool_size', self.get_spool_size())
+
+    def get_spool_size(self):
+        """Return number of crashes that haven't been forwarded yet."""
+        return len(self.forward_queue) + len(self.forwarder_pool) + self.retry_pending
+
+    def hb_report_health_stats(self):
+        """Heartbeat function to report spool size."""
+        mymetrics.gauge('spool_size', value=self.get_spool_size())
+
+    def _run_in_threadpool(self, fun, *args, **kwargs):
+        """Call a function in the threadpool and wait for it to return."""
+        return run_in_threadpool(self.threadpool, mymetrics, fun, *args, **kwargs)
+
+    def _get_spool_path(self, crash_id):
+        return os.path.join(self.spool_dir, crash_id + SPOOL_SUFFIX)
+
+    def _lock_spool_dir(self, path):
+        """Lock a spool directory.
+
+        :returns: the fd of the locked lock file or None if another process
+            holds the lock
+
+        :raises FileNotFoundError: if the directory was claimed and removed by
+            another process
+
+        """
+        lock_path = os.path.join(path, SPOOL_LOCK)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The process that held the lock could have claimed the directory
+            # and removed the lock file before we got the lock
+            if not os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                raise FileNotFoundError(lock_path)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def _create_spool_dir(self):
+        """Create and lock the spool directory for this process.
+
+        :returns: ``(path, lock fd)``
+
+        """
+        pid = os.getpid()
+        attempt = 0
+        while True:
+            # A directory with our pid could be locked by another instance in
+            # this process, so we try other names after that
+            name = str(pid) if attempt == 0 else '%d-%d' % (pid, attempt)
+            path = os.path.join(self.spool_root, name)
+            os.makedirs(path, exist_ok=True)
+            try:
+                fd = self._lock_spool_dir(path)
+            except FileNotFoundError:
+                continue
+            if fd is not None:
+                return path, fd
+            attempt += 1
+
+    def _claim_spool_dir(self, path):
+        """Move crashes from a dead process's spool directory into ours.
+
+        :returns: number of crashes claimed or None if the directory belongs to
+            a live process
+
+        """
+        try:
+            fd = self._lock_spool_dir(path)
+        except FileNotFoundError:
+            # Another process claimed it
+            return 0
+        if fd is None:
+            return None
+
+        claimed = 0
+        try:
+            for fn in os.listdir(path):
+                if fn.endswith(SPOOL_SUFFIX):
+                    os.rename(os.path.join(path, fn), os.path.join(self.spool_dir, fn))
+                    claimed += 1
+                elif fn != SPOOL_LOCK:
+                    # Temp files of the dead process
+                    os.remove(os.path.join(path, fn))
+            os.remove(os.path.join(path, SPOOL_LOCK))
+            os.rmdir(path)
+        finally:
+            os.close(fd)
+        return claimed
+
+    def load_spool(self):
+        """Queue crashes that are in the spool for forwarding.
+
+        This claims the spool directories of processes that died. Crashes are
+        queued oldest first. Leftover temp files in this process's spool
+        directory are removed.
+
+        """
+        for fn in os.listdir(self.spool_root):
+            path = os.path.join(self.spool_root, fn)
+            if path == self.spool_dir or not os.path.isdir(path):
+                continue
+            claimed = self._claim_spool_dir(path)
+            if claimed:
+                logger.info('Claimed %d spooled crashes from %r', claimed, path)
+
+        spooled = []
+        for fn in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, fn)
+            if fn.startswith('.'):
+                # A process with the same pid died before renaming this
+                logger.info('Removing partially spooled crash %r', path)
+                os.remove(path)
+            elif fn.endswith(SPOOL_SUFFIX):
+                spooled.append((os.path.getmtime(path), fn[:-len(SPOOL_SUFFIX)]))
+
+        for mtime, crash_id in sorted(spooled):
+            self.forward_queue.append(crash_id)
+        if spooled:
+            logger.info('Resuming forwarding of %d spooled crashes', len(spooled))
+
+    def _write_spool_file(self, crash_id, record):
+        """Write a record to a temp file in the spool and return a PendingFile.
+
+        NOTE: This runs in the threadpool, so it shouldn't log, emit metrics or
+        touch anything the hub uses.
+
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.spool_dir, prefix='.' + crash_id)
+        fp = os.fdopen(fd, 'wb')
+        pending_file = PendingFile(fp, tmp_path, self._get_spool_path(crash_id))
+        try:
+            fp.write(record)
+            fp.flush()
+        except Exception:
+            pending_file.abort()
+            raise
+        return pending_file
+
+    def save_crash(self, crash_report):
+        """Save crash to the spool and queue it for forwarding."""
+        crash_id = crash_report.crash_id
+        record = encode_record(crash_id, crash_report.raw_crash, crash_report.dumps)
+
+        pending_file = self._run_in_threadpool(self._write_spool_file, crash_id, record)
+        if self.fsync:
+            self.group_committer.commit([pending_file])
+        else:
+            self._run_in_threadpool(commit_files, [pending_file], fsync=False)
+
+        self.forward_queue.append(crash_id)
+        self.hb_run_forwarder()
+
+    def hb_run_forwarder(self):
+        """Spawn forwarders if there's work to do."""
+        while self.forward_queue and self.forwarder_pool.free_count() > 0:
+            self.forwarder_pool.spawn(self.forward, self.forward_queue.popleft())
+
+    def _read_spool_file(self, crash_id):
+        with open(self._get_spool_path(crash_id), 'rb') as fp:
+            record_crash_id, payload, length = read_record(fp, 0)
+        return payload
+
+    def load_crash(self, crash_id):
+        """Return spooled crash as a CrashReport or None if it's not spooled."""
+        try:
+            payload = self._run_in_threadpool(self._read_spool_file, crash_id)
+        except FileNotFoundError:
+            return None
+        raw_crash, dumps = decode_payload(payload)
+        return CrashReport(raw_crash, dumps, crash_id)
+
+    def forward(self, crash_id):
+        """Forward a spooled crash and remove it from the spool.
+
+        If anything fails, this schedules a retry.
+
+        """
+        start_time = time.time()
+        try:
+            crash_report = self.load_crash(crash_id)
+            if crash_report is None:
+                # The crash was saved more than once and already forwarded
+                logger.debug('%s: not in spool', crash_id)
+                return
+
+            self.remote.save_crash(crash_report)
+            self.publish.publish_crash(crash_report)
+            try:
+                self._run_in_threadpool(os.remove, self._get_spool_path(crash_id))
+            except FileNotFoundError:
+                # Another forwarder forwarded it at the same time
+                pass
+
+        except Exception:
+            failures = self.failures.get(crash_id, 0) + 1
+            self.failures[crash_id] = failures
+            delay = min(
+                self.config('retry_delay') * (2 ** (failures - 1)),
+                self.config('max_retry_delay')
+            )
+            logger.exception('%s: forward failed %d times; retrying in %ss', crash_id, failures, delay)
+            mymetrics.incr('forward_failed.count')
+            self.retry_pending += 1
+            gevent.spawn_later(delay, self._retry, crash_id)
+            return
+
+        self.failures.pop(crash_id, None)
+        mymetrics.incr('forwarded.count')
+        # NOTE: time.time returns seconds, but .timing() wants
+        # milliseconds, so we multiply!
+        mymetrics.timing('forward.time', value=(time.time() - start_time) * 1000)
+        logger.info('%s forwarded', crash_id)
+
+    def _retry(self, crash_id):
+        self.retry_pending -= 1
+        self.forward_queue.append(crash_id)
+        self.hb_run_forwarder()
+
+    def join_pool(self):
+        """Join the forwarder pool.
+
+        NOTE: Only use this in tests!
+
+        """
+        self.forwarder_pool.join()
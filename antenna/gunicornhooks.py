@@ -13,6 +13,19 @@ monkey.patch_all()  # noqa
 timeout = 60
 
 
+def on_starting(server):
+    """Gunicorn on_starting hook handler.
+
+    This creates the shared counters in the master before it forks the workers
+    so the workers all share them.
+
+    """
+    from antenna.app import build_config_manager
+    from antenna.sharedcounters import create_shared_counters
+
+    create_shared_counters(build_config_manager())
+
+
 def post_worker_init(worker):
     """Gunicorn post_worker_init hook handler.
 
@@ -0,0 +1,448 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Throttle rule sets defined in JSON or YAML files.
+
+A rule file has a list of rules. Each rule has a name, a condition and a
+result. For example::
+
+    {
+        "rules": [
+            {
+                "name": "has_hangid_and_browser",
+                "all": [
+                    {"key": "HangID", "op": "exists"},
+                    {
+                        "any": [
+                            {"key": "ProcessType", "op": "missing"},
+                            {"key": "ProcessType", "op": "eq", "value": "browser"}
+                        ]
+                    }
+                ],
+                "result": "REJECT"
+            },
+            {
+                "name": "is_nightly",
+                "key": "ReleaseChannel",
+                "op": "prefix",
+                "value": "nightly",
+                "result": "ACCEPT"
+            },
+            {
+                "name": "is_firefox_desktop",
+                "key": "ProductName",
+                "op": "eq",
+                "value": "Firefox",
+                "result": [10, "ACCEPT", "REJECT"]
+            }
+        ]
+    }
+
+Conditions look at the value of ``key`` in the raw crash. If the crash doesn't
+have ``key``, the condition doesn't match (except for ``missing``). These are
+the operators:
+
+``exists``
+    The crash has the key.
+
+``missing``
+    The crash doesn't have the key.
+
+``eq``
+    The value equals ``value``.
+
+``in``
+    The value is one of the items in ``value`` which is a list.
+
+``prefix``
+    The value is a string that starts with ``value`` which is a string or a
+    list of strings.
+
+``regex``
+    The value is a string that ``value`` matches somewhere in. Use ``^`` and
+    ``$`` to match the whole string.
+
+``version``
+    The value is a version like ``68.0.1`` that's at least ``min`` and less
+    than ``max``. Either can be left out.
+
+``function``
+    Calls the condition function at the Python dotted path ``value``. For
+    example, ``antenna.throttler.match_infobar_true``. The key defaults to
+    ``*``.
+
+Conditions can be combined with ``all`` (all conditions in the list match),
+``any`` (at least one condition in the list matches) and ``not`` (the
+condition doesn't match).
+
+The result is ``ACCEPT``, ``DEFER``, ``REJECT`` or ``FAKEACCEPT``. To sample,
+use a list of ``[PERCENTAGE, RESULT, RESULT]``. Crashes that match get the
+first result ``PERCENTAGE`` percent of the time and the second result
+otherwise.
+
+To cap the crashes per second for each group of crashes, use a
+``rate_limit`` result. For example, this accepts up to 10 crashes a second
+for each build of each product and defers the rest::
+
+    "result": {
+        "rate_limit": {
+            "rate": 10,
+            "burst": 20,
+            "keys": ["ProductName", "Version", "BuildID"],
+            "result": "ACCEPT",
+            "overflow": "DEFER"
+        }
+    }
+
+``burst``, ``result``, ``overflow`` and ``max_buckets`` are optional. See
+``antenna.throttler.RateLimit``.
+
+To sample crashes at a percentage that's adjusted to hold a target rate of
+sampled crashes a second, use an ``adaptive_sample`` result::
+
+    "result": {
+        "adaptive_sample": {
+            "target_rate": 5,
+            "floor": 1,
+            "ceiling": 50,
+            "result": "ACCEPT",
+            "unsampled": "REJECT"
+        }
+    }
+
+Everything but ``target_rate`` is optional. See
+``antenna.throttler.AdaptiveSample``.
+
+Rules are compiled into ``Rule`` instances with conditions specialized for
+each operator. ``eq``, ``in`` and ``exists`` are indexed by the throttler, so
+they're the fastest ones.
+
+Use ``bin/validate_throttle_rules.py`` to check rule files.
+
+"""
+
+import json
+import os
+
+from antenna.throttler import (
+    ACCEPT,
+    DEFER,
+    FAKEACCEPT,
+    REJECT,
+    AdaptiveSample,
+    AllOf,
+    AnyOf,
+    Equals,
+    Matches,
+    Not,
+    OneOf,
+    RateLimit,
+    Rule,
+    StartsWith,
+    VersionRange,
+    always_match,
+    parse_attribute,
+    validate_rule_set,
+)
+
+
+#: File extensions for rule files and the format for each
+RULE_FILE_FORMATS = {
+    '.json': 'json',
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+}
+
+RESULT_NAMES = {
+    'ACCEPT': ACCEPT,
+    'DEFER': DEFER,
+    'REJECT': REJECT,
+    'FAKEACCEPT': FAKEACCEPT,
+}
+
+
+class RuleFileError(ValueError):
+    """Raised when a rule file is not valid."""
+
+
+def is_rule_file(path):
+    """Return whether a THROTTLE_RULES value is a path to a rule file."""
+    return os.path.splitext(path)[1] in RULE_FILE_FORMATS
+
+
+def load_rule_file(path):
+    """Load and compile the rule set in a rule file.
+
+    :arg str path: path to a ``.json``, ``.yaml`` or ``.yml`` file
+
+    :returns: list of ``Rule`` instances
+
+    :raises RuleFileError: if the file is not a valid rule file
+
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    return parse_rule_file(data, path)
+
+
+def parse_rule_file(data, path):
+    """Parse and compile the contents of a rule file.
+
+    :arg bytes data: the contents of the file
+    :arg str path: the path of the file which determines its format
+
+    :returns: list of ``Rule`` instances
+
+    :raises RuleFileError: if the contents are not a valid rule file
+
+    """
+    fmt = RULE_FILE_FORMATS.get(os.path.splitext(path)[1])
+    try:
+        if fmt == 'json':
+            spec = json.loads(data.decode('utf-8'))
+        elif fmt == 'yaml':
+            # NOTE: PyYAML isn't a requirement, so only import it if
+            # someone is using a YAML rule file
+            import yaml
+            spec = yaml.safe_load(data)
+        else:
+            raise RuleFileError('%s is not a .json, .yaml or .yml file' % path)
+    except RuleFileError:
+        raise
+    except Exception as exc:
+        raise RuleFileError('%s cannot be parsed: %s' % (path, exc))
+
+    return compile_rule_file(spec)
+
+
+def compile_rule_file(spec):
+    """Compile a parsed rule file into a rule set.
+
+    :arg dict spec: the parsed rule file
+
+    :returns: list of ``Rule`` instances
+
+    :raises RuleFileError: if the rule file is not valid
+
+    """
+    if not isinstance(spec, dict) or not isinstance(spec.get('rules'), list):
+        raise RuleFileError('rule file must be a mapping with a list of "rules"')
+
+    rules = []
+    for i, rule_spec in enumerate(spec['rules']):
+        name = rule_spec.get('name') if isinstance(rule_spec, dict) else None
+        try:
+            rules.append(compile_rule(rule_spec))
+        except ValueError as exc:
+            raise RuleFileError('rule %s (%s): %s' % (i, name or 'no name', exc))
+
+    try:
+        validate_rule_set(rules)
+    except ValueError as exc:
+        raise RuleFileError(str(exc))
+    return rules
+
+
+def compile_rule(rule_spec):
+    """Compile one rule.
+
+    :arg dict rule_spec: the rule from the rule file
+
+    :returns: a ``Rule``
+
+    :raises ValueError: if the rule is not valid
+
+    """
+    if not isinstance(rule_spec, dict):
+        raise ValueError('rule must be a mapping')
+
+    rule_spec = dict(rule_spec)
+    name = rule_spec.pop('name', None)
+    if not isinstance(name, str):
+        raise ValueError('rule must have a "name"')
+    if 'result' not in rule_spec:
+        raise ValueError('rule must have a "result"')
+    result = compile_result(rule_spec.pop('result'))
+
+    key, condition = compile_condition(rule_spec)
+    return Rule(name, key, condition, result)
+
+
+def compile_result(result_spec):
+    """Compile a rule result into a result or (percentage, result, result) tuple."""
+    if isinstance(result_spec, str) and result_spec in RESULT_NAMES:
+        return RESULT_NAMES[result_spec]
+
+    if isinstance(result_spec, list) and len(result_spec) == 3:
+        percentage, le_result, gt_result = result_spec
+        if (
+                isinstance(percentage, (int, float)) and
+                not isinstance(percentage, bool) and
+                le_result in RESULT_NAMES and
+                gt_result in RESULT_NAMES
+        ):
+            return (percentage, RESULT_NAMES[le_result], RESULT_NAMES[gt_result])
+
+    if isinstance(result_spec, dict) and set(result_spec) == {'rate_limit'}:
+        return compile_rate_limit(result_spec['rate_limit'])
+
+    if isinstance(result_spec, dict) and set(result_spec) == {'adaptive_sample'}:
+        return compile_adaptive_sample(result_spec['adaptive_sample'])
+
+    raise ValueError(
+        'result %r must be one of %s, [PERCENTAGE, RESULT, RESULT], a rate_limit or an '
+        'adaptive_sample' % (
+            result_spec, ', '.join(sorted(RESULT_NAMES))
+        )
+    )
+
+
+def compile_rate_limit(spec):
+    """Compile a rate_limit result into a ``RateLimit``."""
+    if not isinstance(spec, dict):
+        raise ValueError('rate_limit %r must be a mapping' % (spec,))
+    check_fields(spec, {'rate', 'burst', 'keys', 'result', 'overflow', 'max_buckets'})
+
+    kwargs = {
+        'rate': spec.get('rate'),
+        'keys': spec.get('keys'),
+    }
+    if 'burst' in spec:
+        kwargs['burst'] = spec['burst']
+    for name in ('result', 'overflow'):
+        if name in spec:
+            if spec[name] not in RESULT_NAMES:
+                raise ValueError('rate_limit %s %r is not a valid result' % (name, spec[name]))
+            kwargs[name] = RESULT_NAMES[spec[name]]
+    if 'max_buckets' in spec:
+        if not isinstance(spec['max_buckets'], int) or spec['max_buckets'] < 1:
+            raise ValueError('max_buckets %r must be at least 1' % (spec['max_buckets'],))
+        kwargs['max_buckets'] = spec['max_buckets']
+
+    return RateLimit(**kwargs)
+
+
+def compile_adaptive_sample(spec):
+    """Compile an adaptive_sample result into an ``AdaptiveSample``."""
+    if not isinstance(spec, dict):
+        raise ValueError('adaptive_sample %r must be a mapping' % (spec,))
+    check_fields(spec, {'target_rate', 'floor', 'ceiling', 'result', 'unsampled', 'initial'})
+
+    kwargs = {'target_rate': spec.get('target_rate')}
+    for name in ('floor', 'ceiling', 'initial'):
+        if name in spec:
+            if not isinstance(spec[name], (int, float)) or isinstance(spec[name], bool):
+                raise ValueError('adaptive_sample %s %r must be a number' % (name, spec[name]))
+            kwargs[name] = spec[name]
+    for name in ('result', 'unsampled'):
+        if name in spec:
+            if spec[name] not in RESULT_NAMES:
+                raise ValueError('adaptive_sample %s %r is not a valid result' % (name, spec[name]))
+            kwargs[name] = RESULT_NAMES[spec[name]]
+
+    return AdaptiveSample(**kwargs)
+
+
+def compile_condition(spec):
+    """Compile a condition into a ``(key, condition)`` pair for a ``Rule``.
+
+    :arg dict spec: the condition
+
+    :returns: ``(key, condition)``
+
+    :raises ValueError: if the condition is not valid
+
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('condition %r must be a mapping' % (spec,))
+
+    if 'all' in spec or 'any' in spec:
+        op = 'all' if 'all' in spec else 'any'
+        check_fields(spec, {op})
+        if not isinstance(spec[op], list) or not spec[op]:
+            raise ValueError('"%s" must be a list of conditions' % op)
+        conditions = [compile_condition(item) for item in spec[op]]
+        return '*', AllOf(conditions) if op == 'all' else AnyOf(conditions)
+
+    if 'not' in spec:
+        check_fields(spec, {'not'})
+        return '*', Not(compile_condition(spec['not']))
+
+    op = spec.get('op')
+    if op == 'function':
+        check_fields(spec, {'key', 'op', 'value'})
+        key = spec.get('key', '*')
+        value = spec.get('value')
+        if not isinstance(value, str) or '.' not in value:
+            raise ValueError('function value %r must be a Python dotted path' % (value,))
+        condition = parse_attribute(value)
+        if not callable(condition):
+            raise ValueError('function %s is not callable' % value)
+        return check_key(key), condition
+
+    key = check_key(spec.get('key'))
+    if key == '*':
+        raise ValueError('%s condition needs a key' % op)
+
+    if op == 'exists':
+        check_fields(spec, {'key', 'op'})
+        return key, always_match
+
+    if op == 'missing':
+        check_fields(spec, {'key', 'op'})
+        return '*', Not((key, always_match))
+
+    if op == 'eq':
+        check_fields(spec, {'key', 'op', 'value'})
+        return key, Equals(check_scalar(spec.get('value')))
+
+    if op == 'in':
+        check_fields(spec, {'key', 'op', 'value'})
+        values = spec.get('value')
+        if not isinstance(values, list) or not values:
+            raise ValueError('in value %r must be a list' % (values,))
+        return key, OneOf([check_scalar(value) for value in values])
+
+    if op == 'prefix':
+        check_fields(spec, {'key', 'op', 'value'})
+        prefixes = spec.get('value')
+        if isinstance(prefixes, str):
+            prefixes = [prefixes]
+        if not isinstance(prefixes, list) or not all(isinstance(item, str) for item in prefixes):
+            raise ValueError('prefix value %r must be a string or list of strings' % (prefixes,))
+        return key, StartsWith(prefixes)
+
+    if op == 'regex':
+        check_fields(spec, {'key', 'op', 'value'})
+        pattern = spec.get('value')
+        if not isinstance(pattern, str):
+            raise ValueError('regex value %r must be a string' % (pattern,))
+        return key, Matches(pattern)
+
+    if op == 'version':
+        check_fields(spec, {'key', 'op', 'min', 'max'})
+        return key, VersionRange(min_version=spec.get('min'), max_version=spec.get('max'))
+
+    raise ValueError('unknown op %r' % (op,))
+
+
+def check_fields(spec, fields):
+    """Raise ValueError if the condition has fields it shouldn't."""
+    extra = set(spec) - fields
+    if extra:
+        raise ValueError('unknown fields %s' % ', '.join(sorted(extra)))
+
+
+def check_key(key):
+    """Raise ValueError if the key is not a string."""
+    if not isinstance(key, str) or not key:
+        raise ValueError('key %r must be a string' % (key,))
+    return key
+
+
+def check_scalar(value):
+    """Raise ValueError if the value can't be compared with annotation values."""
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise ValueError('value %r must be a string or number' % (value,))
+    return value
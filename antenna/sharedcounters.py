@@ -0,0 +1,257 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Counters and token buckets shared by all the processes on a node.
+
+Gunicorn runs several worker processes on a node and each one has its own
+throttler. To enforce limits per node rather than per process, the gunicorn
+master creates a shared memory segment before it forks the workers (see
+``antenna/gunicornhooks.py``). All the workers inherit it.
+
+The segment is a fixed-size hash table of slots. Each slot has a
+fingerprint of its name, a kind and two values. Updates take a lock that's
+shared by all the processes, so they're atomic.
+
+The lock is a semaphore, not a gevent lock, so waiting for it blocks the
+whole process. Waits are capped at ``SHARED_COUNTERS_LOCK_TIMEOUT``
+seconds. When that runs out, callers fall back to state in the process and
+``sharedcounters.lock_timeout`` is incremented. If a worker is killed while it
+holds the lock, the lock is never released. Then every call times out until
+the processes are restarted.
+
+"""
+
+import contextlib
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import struct
+
+from everett.component import ConfigOptions, RequiredConfigMixin
+import markus
+
+
+logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('sharedcounters')
+
+
+#: Slot format: fingerprint, kind, value, value
+SLOT = struct.Struct('<QQdd')
+
+KIND_COUNTER = 1
+KIND_TOKEN_BUCKET = 2
+
+
+class SharedCountersError(Exception):
+    """Base class for shared counter errors."""
+
+
+class SharedCountersFullError(SharedCountersError):
+    """Raised when there's no slot for a new name."""
+
+
+class SharedCountersLockTimeoutError(SharedCountersError):
+    """Raised when the lock isn't acquired in time."""
+
+
+def get_fingerprint(name):
+    """Return the fingerprint for a name; 0 means an empty slot."""
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class SharedCounters(RequiredConfigMixin):
+    """Counters and token buckets in shared memory.
+
+    Create this before forking. Processes forked after it's created share the
+    counters.
+
+    Counters are never removed. A token bucket slot can be reused for another
+    token bucket once it would be full again, so the number of token buckets
+    in use at once is what matters.
+
+    """
+
+    required_config = ConfigOptions()
+    required_config.add_option(
+        'shared_counters_slots',
+        default='4096',
+        parser=int,
+        doc=(
+            'Number of slots in the shared memory segment for counters and token '
+            'buckets shared by the processes on a node. Set to 0 to not share them.'
+        )
+    )
+    required_config.add_option(
+        'shared_counters_lock_timeout',
+        default='0.01',
+        parser=float,
+        doc=(
+            'Seconds to wait for the shared counters lock before falling back to '
+            'counters in the process.'
+        )
+    )
+
+    #: Number of slots to look at when finding a slot for a name
+    max_probes = 32
+
+    def __init__(self, config):
+        self.config = config.with_options(self)
+        self.num_slots = self.config('shared_counters_slots')
+        if self.num_slots < 1:
+            raise ValueError('shared_counters_slots must be at least 1')
+        self.lock_timeout = self.config('shared_counters_lock_timeout')
+
+        # Anonymous mmaps are MAP_SHARED, so forked processes see each other's
+        # changes
+        self.mm = mmap.mmap(-1, self.num_slots * SLOT.size)
+        self.lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return sum(1 for i in range(self.num_slots) if self._read(i)[0] != 0)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the lock.
+
+        :raises SharedCountersLockTimeoutError: if the lock isn't acquired in
+            ``lock_timeout`` seconds
+
+        """
+        if not self.lock.acquire(timeout=self.lock_timeout):
+            logger.warning('timed out waiting %ss for shared counters lock', self.lock_timeout)
+            mymetrics.incr('lock_timeout')
+            raise SharedCountersLockTimeoutError(
+                'timed out waiting %ss for lock' % self.lock_timeout
+            )
+        try:
+            yield
+        finally:
+            self.lock.release()
+
+    def _read(self, index):
+        return SLOT.unpack_from(self.mm, index * SLOT.size)
+
+    def _write(self, index, fingerprint, kind, value_a, value_b):
+        SLOT.pack_into(self.mm, index * SLOT.size, fingerprint, kind, value_a, value_b)
+
+    def _find(self, fingerprint, is_reusable=None):
+        """Return ``(index, slot)`` for the fingerprint.
+
+        If the fingerprint isn't in the table, this returns the first reusable
+        slot or empty slot with a slot of None.
+
+        Call this with the lock held.
+
+        :raises SharedCountersFullError: if there's no slot for the fingerprint
+
+        """
+        start = fingerprint % self.num_slots
+        reusable = None
+        for probe in range(min(self.max_probes, self.num_slots)):
+            index = (start + probe) % self.num_slots
+            slot = self._read(index)
+            if slot[0] == fingerprint:
+                return index, slot
+            if slot[0] == 0:
+                return (index if reusable is None else reusable), None
+            if reusable is None and is_reusable is not None and is_reusable(slot):
+                reusable = index
+
+        if reusable is not None:
+            return reusable, None
+        raise SharedCountersFullError('no slot for fingerprint %s' % fingerprint)
+
+    def get(self, name):
+        """Return the value of a counter; 0 if it doesn't exist.
+
+        :raises SharedCountersLockTimeoutError: if the lock isn't acquired in
+            time
+
+        """
+        with self.locked():
+            index, slot = self._find(get_fingerprint(name))
+        if slot is None:
+            return 0
+        return slot[2]
+
+    def incr(self, name, value=1):
+        """Add to a counter and return the new value.
+
+        :raises SharedCountersFullError: if there's no slot for the counter
+        :raises SharedCountersLockTimeoutError: if the lock isn't acquired in
+            time
+
+        """
+        fingerprint = get_fingerprint(name)
+        with self.locked():
+            index, slot = self._find(fingerprint)
+            new_value = (0 if slot is None else slot[2]) + value
+            self._write(index, fingerprint, KIND_COUNTER, new_value, 0.0)
+        return new_value
+
+    def take_token(self, name, rate, burst, now):
+        """Take a token from a token bucket.
+
+        :arg str name: the name of the bucket
+        :arg float rate: tokens added per second
+        :arg float burst: the most tokens the bucket holds
+        :arg float now: the current ``time.monotonic()`` which is the same
+            for all processes
+
+        :returns: True if there was a token and False if the bucket is empty
+
+        :raises SharedCountersFullError: if there's no slot for the bucket
+        :raises SharedCountersLockTimeoutError: if the lock isn't acquired in
+            time
+
+        """
+        fingerprint = get_fingerprint(name)
+
+        # A bucket that hasn't been used for this long is full, which is the
+        # same as not having a bucket
+        idle = burst / rate
+
+        def is_reusable(slot):
+            return slot[1] == KIND_TOKEN_BUCKET and now - slot[3] >= idle
+
+        with self.locked():
+            index, slot = self._find(fingerprint, is_reusable=is_reusable)
+            if slot is None:
+                tokens = burst
+            else:
+                tokens = min(burst, slot[2] + max(0, now - slot[3]) * rate)
+
+            has_token = tokens >= 1
+            if has_token:
+                tokens -= 1
+            self._write(index, fingerprint, KIND_TOKEN_BUCKET, tokens, now)
+        return has_token
+
+
+_shared_counters = None
+
+
+def create_shared_counters(config):
+    """Create the shared counters for this process and processes forked from it.
+
+    :arg config: the config manager
+
+    :returns: the ``SharedCounters`` or None if they're turned off
+
+    """
+    global _shared_counters
+    num_slots = config.with_options(SharedCounters)('shared_counters_slots')
+    if num_slots < 1:
+        _shared_counters = None
+    else:
+        _shared_counters = SharedCounters(config)
+        logger.info('created shared counters with %s slots', num_slots)
+    return _shared_counters
+
+
+def get_shared_counters():
+    """Return the shared counters or None if they weren't created."""
+    return _shared_counters
@@ -9,15 +9,29 @@ process), defer (save, but not process), and reject.
 
 """
 
+from collections import Counter
+import hashlib
 import importlib
+import importlib.util
 import logging
+import os
 import random
 import re
+import time
+import types
+import zlib
 
 from everett.component import ConfigOptions, RequiredConfigMixin
+from everett.manager import ListOf, parse_bool
+import markus
+
+from antenna.heartbeat import register_for_heartbeat
+from antenna.sharedcounters import SharedCountersError, get_shared_counters
+from antenna.util import LRUCache
 
 
 logger = logging.getLogger(__name__)
+mymetrics = markus.get_metrics('throttler')
 
 
 ACCEPT = 0      # save and process
@@ -45,6 +59,21 @@ def parse_attribute(val):
         )
 
 
+def parse_rule_set(val):
+    """Everett parser for rule sets.
+
+    This is either the path to a JSON or YAML rule file or the Python dotted
+    path to a rule set.
+
+    """
+    # NOTE: antenna.rulefile imports from this module
+    from antenna.rulefile import is_rule_file, load_rule_file
+
+    if is_rule_file(val):
+        return load_rule_file(val)
+    return parse_attribute(val)
+
+
 class Throttler(RequiredConfigMixin):
     """Accept or reject incoming crashes based on specified rule set.
 
@@ -75,6 +104,45 @@ class Throttler(RequiredConfigMixin):
 
         THROTTLE_RULES=myruleset.rules
 
+    Rule sets can also be defined in JSON or YAML files. Set
+    ``THROTTLE_RULES`` to the path of the file. See ``antenna.rulefile`` for
+    the format.
+
+    Rule sets are compiled when they're loaded. Rules that use ``Equals`` or
+    ``OneOf`` conditions or ``always_match`` on a key are turned into
+    dict lookups, so it's faster to use those than functions that do the same
+    thing. See ``CompiledRuleSet``.
+
+    The throttler keeps counts of how many times each rule was evaluated and
+    matched and how long evaluating conditions took. Conditions are timed for
+    one in every ``THROTTLE_PROFILE_INTERVAL`` crashes. Counts are sent to
+    statsd every heartbeat and show up in the ``/__heartbeat__`` info. Use
+    them to put cheap rules that match often first.
+
+    If ``THROTTLE_RULES_RELOAD`` is true, the rule file or the file for the
+    module the rule set is in is checked for changes every heartbeat. When it changes, the module
+    is loaded again and the new rule set is validated, compiled and swapped
+    in. If that fails, the throttler logs an error and keeps using the rule
+    set it has. Since the module gets executed again, rule sets that are
+    reloaded should be in their own module and not in ``antenna.throttler``.
+
+    Rules with a ``(percentage, result, result)`` result use a random number
+    to decide which result a crash gets. If ``THROTTLE_SAMPLE_KEYS`` is set,
+    they use a hash of the values of those keys in the raw crash instead, so
+    the same crash or client gets the same result every time and on every
+    node. For example, ``uuid`` for resubmitted crashes or
+    ``InstallTime,BuildID`` to sample by installation. The same hash is used
+    for all rules, so the crashes sampled at 10% are a subset of the ones
+    sampled at 20%. Crashes that have none of the keys use a random number.
+
+    When Antenna runs in gunicorn, the gunicorn master creates shared counters
+    before it forks the workers (see ``antenna.sharedcounters``).
+    ``RateLimit`` and ``AdaptiveSample`` rules use them so their limits are
+    per node rather than per process.
+
+    The rule set version is the crc32 of the file. It's sent to
+    statsd every heartbeat and shows up in the ``/__heartbeat__`` info, so
+    you can tell which rule set each process is using.
 
     FIXME(willkg): Flesh this out.
 
@@ -84,8 +152,8 @@ class Throttler(RequiredConfigMixin):
     required_config.add_option(
         'throttle_rules',
         default='antenna.throttler.MOZILLA_RULES',
-        doc='Python dotted path to ruleset',
-        parser=parse_attribute
+        doc='Python dotted path to ruleset or path to JSON or YAML rule file',
+        parser=parse_rule_set
     )
     required_config.add_option(
         'products',
@@ -93,10 +161,211 @@ class Throttler(RequiredConfigMixin):
         doc='Python dotted path to list of supported products',
         parser=parse_attribute
     )
+    required_config.add_option(
+        'throttle_profile_interval',
+        default='100',
+        doc=(
+            'Time rule conditions for one in this many crashes. Set to 0 to '
+            'not time rule conditions.'
+        ),
+        parser=int
+    )
+    required_config.add_option(
+        'throttle_sample_keys',
+        default='',
+        doc=(
+            'Comma-separated list of raw crash keys to hash to decide sampled rules. '
+            'If empty, sampled rules use a random number.'
+        ),
+        parser=ListOf(str)
+    )
+    required_config.add_option(
+        'throttle_rules_reload',
+        default='false',
+        doc='Whether to reload the rule set when the file it is in changes.',
+        parser=parse_bool
+    )
 
     def __init__(self, config):
         self.config = config.with_options(self)
-        self.rule_set = self.config('throttle_rules')
+        self.products = self.config('products')
+        self.product_set = frozenset(self.products)
+        self.profile_interval = self.config('throttle_profile_interval')
+        self.sample_keys = self.config('throttle_sample_keys')
+        self.shared_counters = get_shared_counters()
+
+        self.rule_set_watcher = RuleSetWatcher(self.config('throttle_rules', raw_value=True))
+        rules = self.config('throttle_rules')
+        validate_rule_set(rules)
+        self.set_rule_set(rules, self.rule_set_watcher.version)
+
+        register_for_heartbeat(self.hb_report_rule_stats)
+        register_for_heartbeat(self.hb_adjust_sampling)
+        if self.config('throttle_rules_reload'):
+            register_for_heartbeat(self.hb_reload_rule_set)
+
+    def set_rule_set(self, rules, version):
+        """Compile a rule set and swap it in.
+
+        :arg list rules: list of ``Rule`` instances
+        :arg int version: the version of the rule set
+
+        """
+        old_results = {}
+        if hasattr(self, 'active_rule_set'):
+            old_results = {rule.rule_name: rule.result for rule in self.rule_set}
+
+        for rule in rules:
+            if not isinstance(rule.result, (RateLimit, AdaptiveSample)):
+                continue
+            if self.shared_counters is not None:
+                rule.result.share(self.shared_counters, rule.rule_name)
+
+            # Keep token buckets and sampling percentages for rules that
+            # didn't change so reloading doesn't let a burst through
+            old_result = old_results.get(rule.rule_name)
+            if old_result is not rule.result:
+                rule.result.take_state(old_result)
+
+        compiled_rule_set = CompiledRuleSet(rules)
+        rule_stats = RuleStats(compiled_rule_set.rules, self.profile_interval)
+
+        # NOTE: This is one assignment so throttle() never sees a
+        # compiled rule set with the stats or version of a different one
+        self.active_rule_set = (compiled_rule_set, rule_stats, version)
+
+    @property
+    def rule_set(self):
+        """The list of rules; setting it compiles the rules."""
+        return self.active_rule_set[0].rules
+
+    @rule_set.setter
+    def rule_set(self, rules):
+        self.set_rule_set(rules, self.rule_set_version)
+
+    @property
+    def compiled_rule_set(self):
+        """The active ``CompiledRuleSet``."""
+        return self.active_rule_set[0]
+
+    @property
+    def rule_stats(self):
+        """The ``RuleStats`` for the active rule set."""
+        return self.active_rule_set[1]
+
+    @property
+    def rule_set_version(self):
+        """The version of the active rule set."""
+        return self.active_rule_set[2]
+
+    def hb_reload_rule_set(self):
+        """Heartbeat function to reload the rule set if its file changed.
+
+        ``RateLimit`` and ``AdaptiveSample`` results keep their state across
+        a reload if the rule has the same name and the result has the same
+        parameters. Otherwise, they start fresh.
+
+        """
+        if not self.rule_set_watcher.has_changed():
+            return
+
+        old_version = self.rule_set_version
+        try:
+            rules, version = self.rule_set_watcher.load()
+            if version == old_version:
+                return
+
+            validate_rule_set(rules)
+
+            # Send stats for the old rule set before they go away
+            self.hb_report_rule_stats()
+            self.set_rule_set(rules, version)
+        except Exception:
+            logger.exception(
+                'Error reloading throttle rules from %s; keeping version %s',
+                self.rule_set_watcher.path, old_version
+            )
+            mymetrics.incr('rule_set.reload', tags=['result:error'])
+            return
+
+        logger.info(
+            'Reloaded throttle rules from %s; version %s -> %s',
+            self.rule_set_watcher.path, old_version, version
+        )
+        mymetrics.incr('rule_set.reload', tags=['result:success'])
+
+    def check_health(self, state):
+        """Add rule set version and rule stats to the health state."""
+        state.add_statsd(self, 'rule_set.version', self.rule_set_version)
+        for item in self.rule_stats.get_stats():
+            for key in ('evaluations', 'matches', 'time_ms'):
+                if item[key] is not None:
+                    state.add_statsd(self, 'rule.%s.%s' % (item['rule'], key), item[key])
+
+        for rule in self.rule_set:
+            if isinstance(rule.result, RateLimit):
+                state.add_statsd(self, 'rate_limit.%s.buckets' % rule.rule_name, len(rule.result.buckets))
+                state.add_statsd(self, 'rate_limit.%s.limited' % rule.rule_name, rule.result.limited_total)
+            elif isinstance(rule.result, AdaptiveSample):
+                state.add_statsd(self, 'adaptive_sample.%s.percentage' % rule.rule_name, rule.result.percentage)
+
+    def hb_report_rule_stats(self):
+        """Heartbeat function to send rule stats since the last heartbeat."""
+        mymetrics.gauge('rule_set.version', value=self.rule_set_version)
+        for item in self.rule_stats.flush():
+            tags = ['rule:%s' % item['rule']]
+            mymetrics.incr('rule.evaluations', value=item['evaluations'], tags=tags)
+            mymetrics.incr('rule.matches', value=item['matches'], tags=tags)
+            if item['time_ms'] is not None:
+                mymetrics.timing('rule.evaluation_time', value=item['time_ms'], tags=tags)
+
+        for rule in self.rule_set:
+            if isinstance(rule.result, RateLimit):
+                tags = ['rule:%s' % rule.rule_name]
+                mymetrics.gauge('rate_limit.buckets', value=len(rule.result.buckets), tags=tags)
+                for bucket, count in rule.result.flush_limited():
+                    mymetrics.incr(
+                        'rate_limit.limited', value=count, tags=tags + ['bucket:%s' % bucket]
+                    )
+
+    def hb_adjust_sampling(self):
+        """Heartbeat function to adjust the percentages of adaptive sampling rules."""
+        for rule in self.rule_set:
+            if isinstance(rule.result, AdaptiveSample):
+                rule.result.adjust()
+                tags = ['rule:%s' % rule.rule_name]
+                mymetrics.gauge('adaptive_sample.percentage', value=rule.result.percentage, tags=tags)
+                mymetrics.gauge('adaptive_sample.incoming_rate', value=rule.result.incoming_rate, tags=tags)
+
+    def is_supported_product(self, product_name):
+        """Return whether a product is in the list of supported products.
+
+        If the list of supported products is empty, all products are supported.
+
+        """
+        if not self.product_set:
+            return True
+        try:
+            return product_name in self.product_set
+        except TypeError:
+            # Unhashable values aren't products
+            return False
+
+    def get_sample_value(self, raw_crash):
+        """Return the number in [0, 100) that decides sampled rules for a crash.
+
+        This is a hash of the values of the sample keys if the crash has any of
+        them and a random number otherwise.
+
+        """
+        if self.sample_keys:
+            values = [raw_crash.get(key) for key in self.sample_keys]
+            if any(value is not None for value in values):
+                data = '\x00'.join('' if value is None else str(value) for value in values)
+                digest = hashlib.sha256(data.encode('utf-8')).digest()
+                return int.from_bytes(digest[:8], 'big') * 100.0 / 2 ** 64
+
+        return random.random() * 100.0  # nosec
 
     def throttle(self, raw_crash):
         """Throttle an incoming crash report.
@@ -109,23 +378,511 @@ class Throttler(RequiredConfigMixin):
         :returns tuple: ``(result, rule_name, percentage)``
 
         """
-        for rule in self.rule_set:
-            match = rule.match(self, raw_crash)
+        compiled_rule_set, rule_stats = self.active_rule_set[:2]
+
+        if rule_stats.should_time():
+            index = compiled_rule_set.match_index(self, raw_crash, timings=rule_stats.timings)
+            rule_stats.add(index, timed=True)
+        else:
+            index = compiled_rule_set.match_index(self, raw_crash)
+            rule_stats.add(index)
+
+        if index < len(compiled_rule_set.rules):
+            rule = compiled_rule_set.rules[index]
+            if rule.result in RESULTS:
+                return rule.result, rule.rule_name, 100
+
+            if isinstance(rule.result, RateLimit):
+                return rule.result.throttle(raw_crash), rule.rule_name, 100
 
-            if match:
-                if rule.result in (ACCEPT, DEFER, REJECT, FAKEACCEPT):
-                    return rule.result, rule.rule_name, 100
+            if isinstance(rule.result, AdaptiveSample):
+                response, percentage = rule.result.throttle(self.get_sample_value(raw_crash))
+                return response, rule.rule_name, percentage
 
-                if (random.random() * 100.0) <= rule.result[0]:  # nosec
-                    response = rule.result[1]
-                else:
-                    response = rule.result[2]
-                return response, rule.rule_name, rule.result[0]
+            if self.get_sample_value(raw_crash) <= rule.result[0]:
+                response = rule.result[1]
+            else:
+                response = rule.result[2]
+            return response, rule.rule_name, rule.result[0]
 
         # None of the rules matched, so we defer
         return REJECT, 'NO_MATCH', 0
 
 
+RESULTS = (ACCEPT, DEFER, REJECT, FAKEACCEPT)
+
+
+class RateLimit:
+    """Rule result that caps the crashes per second for each group of crashes.
+
+    Crashes that match the rule are grouped by the values of ``keys`` in the
+    raw crash. Each group has a token bucket that holds up to ``burst``
+    tokens and gets ``rate`` tokens a second. A crash takes a token and gets
+    ``result``. When the bucket is empty, the crash gets ``overflow``.
+
+    For example, this accepts up to 10 crashes a second for each build of each
+    product and defers the rest::
+
+        Rule(
+            rule_name='limit_per_build',
+            key='*',
+            condition=always_match,
+            result=RateLimit(rate=10, keys=['ProductName', 'Version', 'BuildID'], overflow=DEFER)
+        )
+
+    Buckets are kept in an LRU cache of at most ``max_buckets`` buckets so
+    memory doesn't grow with the number of groups. A group whose bucket was
+    evicted starts again with a full bucket.
+
+    If the throttler has shared counters, buckets are kept in them instead,
+    so all the processes on a node share one bucket for each group. If there's
+    no slot for a bucket or the shared counters lock times out, the bucket in
+    the LRU cache is used.
+
+    Every heartbeat, the throttler sends the number of limited crashes for
+    the groups that were limited the most since the last heartbeat.
+
+    :arg float rate: tokens added to each bucket per second
+    :arg list keys: the raw crash keys to group crashes by
+    :arg float burst: the most tokens a bucket can hold; defaults to ``rate``
+    :arg result: the result when there is a token; defaults to ``ACCEPT``
+    :arg overflow: the result when the bucket is empty; ``REJECT`` or ``DEFER``
+    :arg int max_buckets: the most buckets to keep
+
+    """
+
+    #: Number of groups to send limited counts for every heartbeat
+    max_reported_buckets = 10
+
+    def __init__(self, rate, keys, burst=None, result=ACCEPT, overflow=REJECT,
+                 max_buckets=10000):
+        if not isinstance(rate, (int, float)) or rate <= 0:
+            raise ValueError('rate %r must be a number greater than 0' % (rate,))
+        burst = rate if burst is None else burst
+        if not isinstance(burst, (int, float)) or burst < 1:
+            raise ValueError('burst %r must be a number at least 1' % (burst,))
+        if (
+                not isinstance(keys, (list, tuple)) or
+                not keys or
+                not all(isinstance(key, str) for key in keys)
+        ):
+            raise ValueError('keys %r must be a list of strings' % (keys,))
+        if result not in RESULTS:
+            raise ValueError('result %r is not a valid result' % (result,))
+        if overflow not in (REJECT, DEFER):
+            raise ValueError('overflow %r must be REJECT or DEFER' % (overflow,))
+
+        self.rate = rate
+        self.burst = burst
+        self.keys = tuple(keys)
+        self.result = result
+        self.overflow = overflow
+
+        # bucket key -> [tokens, time tokens were last added]
+        self.buckets = LRUCache(max_buckets)
+
+        # bucket key -> number of limited crashes since the last flush
+        self.limited = Counter()
+        self.limited_total = 0
+
+        self.clock = time.monotonic
+
+        self.shared_counters = None
+        self.shared_prefix = None
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'RateLimit(rate=%r, keys=%r, burst=%r, result=%r, overflow=%r)' % (
+            self.rate, list(self.keys), self.burst, self.result, self.overflow
+        )
+
+    def get_bucket_key(self, raw_crash):
+        """Return the bucket key for a crash."""
+        return '/'.join(str(raw_crash.get(key, '')) for key in self.keys)
+
+    def share(self, shared_counters, rule_name):
+        """Keep buckets in shared counters.
+
+        :arg shared_counters: the ``SharedCounters``
+        :arg str rule_name: the name of the rule, which keeps buckets for
+            different rules apart
+
+        """
+        self.shared_counters = shared_counters
+        self.shared_prefix = 'rate_limit:%s:' % rule_name
+
+    def params(self):
+        """Return the parameters that decide how crashes are limited."""
+        return (self.rate, self.burst, self.keys, self.result, self.overflow)
+
+    def take_state(self, old):
+        """Take the buckets and limited counts of a ``RateLimit`` being replaced.
+
+        :arg old: the ``RateLimit`` this replaces; nothing happens if it's
+            not a ``RateLimit`` with the same parameters
+
+        :returns: whether the state was taken
+
+        """
+        if not isinstance(old, RateLimit) or old.params() != self.params():
+            return False
+        self.buckets = old.buckets
+        self.limited = old.limited
+        self.limited_total = old.limited_total
+        return True
+
+    def take_token(self, bucket_key, now):
+        """Take a token from the bucket in the LRU cache."""
+        bucket = self.buckets.get(bucket_key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self.buckets[bucket_key] = bucket
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+    def throttle(self, raw_crash):
+        """Take a token for the crash and return the result."""
+        bucket_key = self.get_bucket_key(raw_crash)
+        now = self.clock()
+
+        if self.shared_counters is not None:
+            try:
+                has_token = self.shared_counters.take_token(
+                    self.shared_prefix + bucket_key, self.rate, self.burst, now
+                )
+            except SharedCountersError:
+                has_token = self.take_token(bucket_key, now)
+        else:
+            has_token = self.take_token(bucket_key, now)
+
+        if has_token:
+            return self.result
+
+        self.limited[bucket_key] += 1
+        self.limited_total += 1
+        return self.overflow
+
+    def flush_limited(self):
+        """Return limited counts since the last flush for the most limited groups.
+
+        :returns: list of ``(bucket key, count)``; counts for groups that
+            didn't make the list are added up as ``other``
+
+        """
+        if not self.limited:
+            return []
+
+        counts = self.limited.most_common(self.max_reported_buckets)
+        other = sum(self.limited.values()) - sum(count for bucket_key, count in counts)
+        if other:
+            counts.append(('other', other))
+        self.limited = Counter()
+        return counts
+
+
+class AdaptiveSample:
+    """Rule result that samples crashes to hold a target rate of sampled crashes.
+
+    This works like a ``(percentage, result, unsampled)`` result, but the
+    percentage is adjusted every heartbeat so that about ``target_rate``
+    crashes a second get ``result``. The percentage stays between ``floor``
+    and ``ceiling``.
+
+    The incoming rate of crashes that match the rule is smoothed with an
+    exponentially weighted moving average, so the percentage follows changes
+    in volume over a few heartbeats without jumping around.
+
+    The percentage a crash was sampled at is returned as the throttle rate,
+    so it ends up in ``throttle_rate`` in the raw crash like it does for other
+    sampled rules.
+
+    For example, this accepts about 5 Firefox crashes a second and rejects
+    the rest, but always accepts at least 1% and at most 50%::
+
+        Rule(
+            rule_name='is_firefox_desktop',
+            key='ProductName',
+            condition=Equals('Firefox'),
+            result=AdaptiveSample(target_rate=5, floor=1, ceiling=50)
+        )
+
+    .. Note::
+
+       The target rate is per process unless the throttler has shared
+       counters. Then each process adds its count of matched crashes to a
+       shared counter every heartbeat and computes the rate from the shared
+       count, so the target rate is per node.
+
+    :arg float target_rate: crashes per second that should get ``result``
+    :arg float floor: lowest percentage
+    :arg float ceiling: highest percentage
+    :arg result: the result for sampled crashes; defaults to ``ACCEPT``
+    :arg unsampled: the result for other crashes; defaults to ``REJECT``
+    :arg float initial: percentage to start at; defaults to ``floor``
+    :arg float smoothing: weight of the latest rate in the moving average
+
+    """
+
+    def __init__(self, target_rate, floor=1, ceiling=100, result=ACCEPT, unsampled=REJECT,
+                 initial=None, smoothing=0.5):
+        if not isinstance(target_rate, (int, float)) or target_rate <= 0:
+            raise ValueError('target_rate %r must be a number greater than 0' % (target_rate,))
+        if not (
+                isinstance(floor, (int, float)) and
+                isinstance(ceiling, (int, float)) and
+                0 <= floor <= ceiling <= 100
+        ):
+            raise ValueError('floor %r and ceiling %r must be 0 <= floor <= ceiling <= 100' % (
+                floor, ceiling
+            ))
+        if result not in RESULTS or unsampled not in RESULTS:
+            raise ValueError('results %r and %r must be valid results' % (result, unsampled))
+        if not 0 < smoothing <= 1:
+            raise ValueError('smoothing %r must be greater than 0 and at most 1' % (smoothing,))
+
+        self.target_rate = target_rate
+        self.floor = floor
+        self.ceiling = ceiling
+        self.result = result
+        self.unsampled = unsampled
+        self.smoothing = smoothing
+
+        self.percentage = floor if initial is None else min(ceiling, max(floor, initial))
+
+        # Crashes per second that matched the rule, smoothed
+        self.incoming_rate = 0.0
+        self.has_rate = False
+
+        self.clock = time.monotonic
+        self.matched = 0
+        self.last_adjusted = self.clock()
+
+        self.shared_counters = None
+        self.shared_name = None
+        self.shared_matched = 0
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'AdaptiveSample(target_rate=%r, floor=%r, ceiling=%r, result=%r, unsampled=%r)' % (
+            self.target_rate, self.floor, self.ceiling, self.result, self.unsampled
+        )
+
+    def share(self, shared_counters, rule_name):
+        """Count matched crashes in shared counters.
+
+        :arg shared_counters: the ``SharedCounters``
+        :arg str rule_name: the name of the rule, which keeps counts for
+            different rules apart
+
+        """
+        self.shared_counters = shared_counters
+        self.shared_name = 'adaptive_sample:%s' % rule_name
+        try:
+            self.shared_matched = shared_counters.get(self.shared_name)
+        except SharedCountersError:
+            self.shared_matched = 0
+
+    def params(self):
+        """Return the parameters that decide how the percentage is adjusted."""
+        return (self.target_rate, self.floor, self.ceiling, self.result, self.unsampled,
+                self.smoothing)
+
+    def take_state(self, old):
+        """Take the percentage and rate of an ``AdaptiveSample`` being replaced.
+
+        :arg old: the ``AdaptiveSample`` this replaces; nothing happens if
+            it's not an ``AdaptiveSample`` with the same parameters
+
+        :returns: whether the state was taken
+
+        """
+        if not isinstance(old, AdaptiveSample) or old.params() != self.params():
+            return False
+        self.percentage = old.percentage
+        self.incoming_rate = old.incoming_rate
+        self.has_rate = old.has_rate
+        self.matched = old.matched
+        self.last_adjusted = old.last_adjusted
+        self.shared_matched = old.shared_matched
+        return True
+
+    def throttle(self, sample_value):
+        """Return ``(result, percentage)`` for a crash.
+
+        :arg float sample_value: the number in [0, 100) that decides whether
+            the crash is sampled
+
+        """
+        self.matched += 1
+        percentage = self.percentage
+        if sample_value <= percentage:
+            return self.result, percentage
+        return self.unsampled, percentage
+
+    def adjust(self):
+        """Adjust the percentage for the rate of crashes since the last adjustment."""
+        now = self.clock()
+        elapsed = now - self.last_adjusted
+        if elapsed <= 0:
+            return
+
+        matched = self.matched
+        self.matched = 0
+        self.last_adjusted = now
+
+        if self.shared_counters is not None:
+            # NOTE: Adding the count once a heartbeat means processes
+            # don't take the lock for every crash
+            try:
+                shared_matched = self.shared_counters.incr(self.shared_name, matched)
+                matched = shared_matched - self.shared_matched
+                self.shared_matched = shared_matched
+            except SharedCountersError:
+                pass
+
+        rate = matched / elapsed
+
+        if self.has_rate:
+            self.incoming_rate = self.smoothing * rate + (1 - self.smoothing) * self.incoming_rate
+        else:
+            self.incoming_rate = rate
+            self.has_rate = True
+
+        if self.incoming_rate > 0:
+            percentage = self.target_rate * 100.0 / self.incoming_rate
+        else:
+            percentage = self.ceiling
+        self.percentage = round(min(self.ceiling, max(self.floor, percentage)), 2)
+
+
+def validate_rule_set(rules):
+    """Validate a rule set.
+
+    :arg list rules: the rule set
+
+    :raises ValueError: if the rule set is not valid
+
+    """
+    if not isinstance(rules, (list, tuple)):
+        raise ValueError('rule set %r is not a list' % (rules,))
+
+    for rule in rules:
+        if not isinstance(rule, Rule):
+            raise ValueError('%r is not a Rule' % (rule,))
+
+        if rule.result in RESULTS or isinstance(rule.result, (RateLimit, AdaptiveSample)):
+            continue
+
+        if not (isinstance(rule.result, tuple) and len(rule.result) == 3):
+            raise ValueError('rule %s has invalid result %r' % (rule.rule_name, rule.result))
+
+        percentage, le_result, gt_result = rule.result
+        if (
+                not isinstance(percentage, (int, float)) or
+                not 0 <= percentage <= 100 or
+                le_result not in RESULTS or
+                gt_result not in RESULTS
+        ):
+            raise ValueError('rule %s has invalid result %r' % (rule.rule_name, rule.result))
+
+
+class RuleSetWatcher:
+    """Watches a rule file or the file of the module a rule set is in.
+
+    :arg str path: path to a rule file or Python dotted path to the rule set
+
+    """
+
+    def __init__(self, path):
+        # NOTE: antenna.rulefile imports from this module
+        from antenna.rulefile import is_rule_file
+
+        self.path = path
+        if is_rule_file(path):
+            self.module_name = self.attribute_name = None
+            self.filename = path
+
+        else:
+            self.module_name, self.attribute_name = path.rsplit('.', 1)
+            spec = importlib.util.find_spec(self.module_name)
+            if spec is not None and spec.has_location:
+                self.filename = spec.origin
+            else:
+                self.filename = None
+
+        self.last_stat = self.stat()
+        self.version = get_version(self.read()) if self.filename else 0
+
+    def stat(self):
+        """Return (mtime, size) for the file or None if it's not there."""
+        if not self.filename:
+            return None
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self):
+        """Return the contents of the file."""
+        with open(self.filename, 'rb') as fp:
+            return fp.read()
+
+    def has_changed(self):
+        """Return whether the file changed since the last time this was called."""
+        stat = self.stat()
+        if stat is None or stat == self.last_stat:
+            return False
+        self.last_stat = stat
+        return True
+
+    def load(self):
+        """Load the rule file or the module from the file again.
+
+        Modules are executed again without importing them.
+
+        :returns: ``(rules, version)``
+
+        :raises Exception: anything the module raises when it's executed and
+            ``ValueError`` if the rule set isn't in it or the rule file is not
+            valid
+
+        """
+        # NOTE: antenna.rulefile imports from this module
+        from antenna.rulefile import parse_rule_file
+
+        data = self.read()
+        if self.module_name is None:
+            rules = parse_rule_file(data, self.filename)
+            self.version = get_version(data)
+            return rules, self.version
+
+        module = types.ModuleType(self.module_name)
+        module.__file__ = self.filename
+        module.__package__ = self.module_name.rpartition('.')[0]
+        exec(compile(data, self.filename, 'exec'), module.__dict__)  # nosec
+
+        try:
+            rules = getattr(module, self.attribute_name)
+        except AttributeError:
+            raise ValueError(
+                '%s is not a valid attribute of %s' % (self.attribute_name, self.module_name)
+            )
+        self.version = get_version(data)
+        return rules, self.version
+
+
+def get_version(data):
+    """Return the version for a rule set file's contents."""
+    return zlib.crc32(data)
+
+
 class Rule:
     """Defines a single rule."""
 
@@ -198,6 +955,436 @@ class Rule:
         return False
 
 
+class CompiledRuleSet:
+    """A rule set compiled for fast matching.
+
+    Matching a compiled rule set returns the same rule as trying each rule in
+    order and returning the first that matches.
+
+    Rules with a key other than ``*`` are compiled into lookup tables of key
+    to the index of the first rule that could match:
+
+    * ``Equals`` and ``OneOf`` conditions go in a table of key -> value ->
+      index
+    * ``always_match`` conditions go in a table of key -> index since they
+      match whenever the key is in the crash
+
+    Matching a crash looks up the crash's values in the tables to get the
+    earliest matching table rule and then only calls conditions of rules
+    before that one.
+
+    Rules after a ``*`` rule with ``always_match`` can never match, so
+    they're dropped.
+
+    :arg list rules: list of ``Rule`` instances in order
+
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        # key -> {value -> index of first rule matching that value}
+        self.value_tables = {}
+
+        # key -> index of first rule matching whenever the key is there
+        self.presence_table = {}
+
+        # (index, rule) for rules that need their condition called
+        self.conditional_rules = []
+
+        # Index of the first rule that always matches or None
+        self.catch_all = None
+
+        for i, rule in enumerate(self.rules):
+            if rule.key != '*' and isinstance(rule.condition, (Equals, OneOf)):
+                table = self.value_tables.setdefault(rule.key, {})
+                for value in rule.condition.values:
+                    table.setdefault(value, i)
+
+            elif rule.key != '*' and rule.condition is always_match:
+                self.presence_table.setdefault(rule.key, i)
+
+            elif rule.key == '*' and rule.condition is always_match:
+                self.catch_all = i
+                break
+
+            else:
+                self.conditional_rules.append((i, rule))
+
+        self.value_tables = list(self.value_tables.items())
+        self.presence_table = list(self.presence_table.items())
+
+    def match(self, throttler, crash):
+        """Return the first rule that matches the crash or None."""
+        index = self.match_index(throttler, crash)
+        if index < len(self.rules):
+            return self.rules[index]
+        return None
+
+    def match_index(self, throttler, crash, timings=None):
+        """Return the index of the first rule that matches the crash.
+
+        :arg throttler: the throttler
+        :arg dict crash: the crash to match
+        :arg list timings: if not None, the time in seconds it takes to
+            evaluate each condition that gets called is added to
+            ``timings[rule index]``
+
+        :returns: the index of the rule or ``len(rules)`` if no rule matches
+
+        """
+        best = len(self.rules) if self.catch_all is None else self.catch_all
+
+        for key, i in self.presence_table:
+            if i < best and key in crash:
+                best = i
+
+        for key, table in self.value_tables:
+            if key in crash:
+                try:
+                    i = table.get(crash[key], best)
+                except TypeError:
+                    # Unhashable values aren't equal to any of the values
+                    continue
+                if i < best:
+                    best = i
+
+        if timings is None:
+            for i, rule in self.conditional_rules:
+                if i >= best:
+                    break
+                if rule.match(throttler, crash):
+                    return i
+
+        else:
+            for i, rule in self.conditional_rules:
+                if i >= best:
+                    break
+                start_time = time.perf_counter()
+                matched = rule.match(throttler, crash)
+                timings[i] += time.perf_counter() - start_time
+                if matched:
+                    return i
+
+        return best
+
+
+class RuleStats:
+    """Counts of rule evaluations and matches and condition timings.
+
+    Evaluating a rule set in order evaluates every rule up to and including
+    the one that matches. So for each crash, this only increments the count
+    for the index of the rule that matched and works out the per-rule counts
+    when asked for them. That's cheap enough to do for every crash.
+
+    Timing rule conditions is not as cheap, so that's done for one in every
+    ``profile_interval`` crashes. The total time for a rule is estimated from
+    the average time of its timed evaluations.
+
+    :arg list rules: list of ``Rule`` instances in order
+    :arg int profile_interval: time one in this many crashes; 0 to never
+        time crashes
+
+    """
+
+    def __init__(self, rules, profile_interval):
+        self.rule_names = [rule.rule_name for rule in rules]
+        self.profile_interval = profile_interval
+        self.countdown = profile_interval
+
+        # Number of crashes that matched each rule; the last item is crashes
+        # that matched no rule
+        self.counts = [0] * (len(rules) + 1)
+        self.timed_counts = [0] * (len(rules) + 1)
+
+        # Seconds spent evaluating each rule's condition in timed crashes
+        self.timings = [0.0] * len(rules)
+
+        self.last_flush = self.get_stats()
+        self.last_timed = self._get_timed()
+
+    def should_time(self):
+        """Return whether to time the next crash."""
+        if not self.profile_interval:
+            return False
+        self.countdown -= 1
+        if self.countdown <= 0:
+            self.countdown = self.profile_interval
+            return True
+        return False
+
+    def add(self, index, timed=False):
+        """Count a crash that matched the rule at index."""
+        self.counts[index] += 1
+        if timed:
+            self.timed_counts[index] += 1
+
+    def get_stats(self):
+        """Return list of cumulative stats for each rule in order.
+
+        Each item is a dict with ``rule``, ``evaluations``, ``matches`` and
+        ``time_ms`` which is the estimated total time spent evaluating the
+        rule's condition or None if it was never timed.
+
+        """
+        stats = []
+        evaluations = sum(self.counts)
+        timed_evaluations = sum(self.timed_counts)
+        for i, rule_name in enumerate(self.rule_names):
+            if timed_evaluations:
+                time_ms = self.timings[i] * 1000.0 * evaluations / timed_evaluations
+            else:
+                time_ms = None
+            stats.append({
+                'rule': rule_name,
+                'evaluations': evaluations,
+                'matches': self.counts[i],
+                'time_ms': time_ms,
+            })
+            evaluations -= self.counts[i]
+            timed_evaluations -= self.timed_counts[i]
+        return stats
+
+    def flush(self):
+        """Return list of stats for each rule since the last flush.
+
+        ``time_ms`` is the average time in ms to evaluate the rule's condition
+        since the last flush or None if it wasn't timed since then.
+
+        """
+        stats = self.get_stats()
+        timed = self._get_timed()
+        deltas = []
+        for item, last_item, timed_item, last_timed_item in zip(
+                stats, self.last_flush, timed, self.last_timed):
+            timed_evaluations = timed_item[0] - last_timed_item[0]
+            if timed_evaluations:
+                time_ms = (timed_item[1] - last_timed_item[1]) * 1000.0 / timed_evaluations
+            else:
+                time_ms = None
+            deltas.append({
+                'rule': item['rule'],
+                'evaluations': item['evaluations'] - last_item['evaluations'],
+                'matches': item['matches'] - last_item['matches'],
+                'time_ms': time_ms,
+            })
+        self.last_flush = stats
+        self.last_timed = timed
+        return deltas
+
+    def _get_timed(self):
+        """Return list of (timed evaluations, seconds) for each rule."""
+        timed = []
+        timed_evaluations = sum(self.timed_counts)
+        for i, seconds in enumerate(self.timings):
+            timed.append((timed_evaluations, seconds))
+            timed_evaluations -= self.timed_counts[i]
+        return timed
+
+
+class Equals:
+    """Rule condition that matches values equal to ``value``.
+
+    Rule sets compile these into dict lookups.
+
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.values = frozenset([value])
+
+    def __call__(self, throttler, x):
+        return x == self.value
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'Equals(%r)' % (self.value,)
+
+
+class OneOf:
+    """Rule condition that matches values in ``values``.
+
+    Rule sets compile these into dict lookups.
+
+    """
+
+    def __init__(self, values):
+        self.values = frozenset(values)
+
+    def __call__(self, throttler, x):
+        try:
+            return x in self.values
+        except TypeError:
+            # Unhashable values aren't equal to any of the values
+            return False
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'OneOf(%r)' % (sorted(self.values),)
+
+
+class StartsWith:
+    """Rule condition that matches strings that start with one of ``prefixes``."""
+
+    def __init__(self, prefixes):
+        self.prefixes = tuple(prefixes)
+
+    def __call__(self, throttler, x):
+        return isinstance(x, str) and x.startswith(self.prefixes)
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'StartsWith(%r)' % (list(self.prefixes),)
+
+
+class Matches:
+    """Rule condition that matches strings that regex ``pattern`` matches in."""
+
+    def __init__(self, pattern):
+        try:
+            self.regex = re.compile(pattern)
+        except re.error as exc:
+            raise ValueError('%r is not a valid regex: %s' % (pattern, exc))
+
+    def __call__(self, throttler, x):
+        return isinstance(x, str) and self.regex.search(x) is not None
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'Matches(%r)' % (self.regex.pattern,)
+
+
+VERSION_RE = re.compile(r'^(\d+(?:\.\d+)*)')
+
+
+def parse_version(version):
+    """Return a version string as a tuple of ints for comparing.
+
+    Anything after the dotted numbers is ignored and trailing zeros are
+    dropped, so ``68.0a1`` and ``68`` are both ``(68,)``.
+
+    :returns: tuple of ints or None if it's not a version
+
+    """
+    if not isinstance(version, str):
+        return None
+    match = VERSION_RE.match(version)
+    if not match:
+        return None
+    parts = [int(part) for part in match.group(1).split('.')]
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+
+class VersionRange:
+    """Rule condition that matches versions in a range.
+
+    Versions match if they're at least ``min_version`` and less than
+    ``max_version``. Either can be None.
+
+    """
+
+    def __init__(self, min_version=None, max_version=None):
+        if min_version is None and max_version is None:
+            raise ValueError('version range needs a min or max version')
+        self.min_version = min_version
+        self.max_version = max_version
+        self.min = self._parse(min_version)
+        self.max = self._parse(max_version)
+
+    def _parse(self, version):
+        if version is None:
+            return None
+        parsed = parse_version(version)
+        if parsed is None:
+            raise ValueError('%r is not a valid version' % (version,))
+        return parsed
+
+    def __call__(self, throttler, x):
+        version = parse_version(x)
+        if version is None:
+            return False
+        if self.min is not None and version < self.min:
+            return False
+        if self.max is not None and version >= self.max:
+            return False
+        return True
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'VersionRange(%r, %r)' % (self.min_version, self.max_version)
+
+
+def match_condition(throttler, crash, key, condition):
+    """Return whether a condition matches the crash like ``Rule.match`` does."""
+    if key == '*':
+        return condition(throttler, crash)
+    if key in crash:
+        return condition(throttler, crash[key])
+    return False
+
+
+class AllOf:
+    """Rule condition for the whole crash that matches if all conditions match.
+
+    :arg list conditions: list of ``(key, condition)`` pairs
+
+    """
+
+    def __init__(self, conditions):
+        self.conditions = list(conditions)
+
+    def __call__(self, throttler, crash):
+        for key, condition in self.conditions:
+            if not match_condition(throttler, crash, key, condition):
+                return False
+        return True
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'AllOf(%r)' % (self.conditions,)
+
+
+class AnyOf:
+    """Rule condition for the whole crash that matches if any condition matches.
+
+    :arg list conditions: list of ``(key, condition)`` pairs
+
+    """
+
+    def __init__(self, conditions):
+        self.conditions = list(conditions)
+
+    def __call__(self, throttler, crash):
+        for key, condition in self.conditions:
+            if match_condition(throttler, crash, key, condition):
+                return True
+        return False
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'AnyOf(%r)' % (self.conditions,)
+
+
+class Not:
+    """Rule condition for the whole crash that matches if a condition doesn't.
+
+    :arg tuple condition: ``(key, condition)`` pair
+
+    """
+
+    def __init__(self, condition):
+        self.key, self.condition = condition
+
+    def __call__(self, throttler, crash):
+        return not match_condition(throttler, crash, self.key, self.condition)
+
+    def __repr__(self):
+        """Return programmer-friendly representation."""
+        return 'Not(%r)' % ((self.key, self.condition),)
+
+
 def always_match(throttler, crash):
     """Rule condition that always returns true."""
     return True
@@ -228,7 +1415,7 @@ def match_infobar_true(throttler, data):
 def match_b2g(throttler, data):
     """Match crash reports for B2G."""
     is_b2g = (
-        'B2G' not in throttler.config('products') and
+        'B2G' not in throttler.product_set and
         data.get('ProductName', '').lower() == 'b2g'
     )
     if is_b2g:
@@ -239,10 +1426,7 @@ def match_b2g(throttler, data):
 
 def match_unsupported_product(throttler, data):
     """Match unsupported products."""
-    is_not_supported = (
-        throttler.config('products') and
-        data.get('ProductName') not in throttler.config('products')
-    )
+    is_not_supported = not throttler.is_supported_product(data.get('ProductName'))
 
     if is_not_supported:
         logger.info('ProductName rejected: %r' % data.get('ProductName'))
@@ -318,7 +1502,7 @@ MOZILLA_RULES = [
     Rule(
         rule_name='throttleable_0',
         key='Throttleable',
-        condition=lambda throttler, x: x == '0',
+        condition=Equals('0'),
         result=ACCEPT
     ),
 
@@ -342,7 +1526,7 @@ MOZILLA_RULES = [
     Rule(
         rule_name='is_alpha_beta_esr',
         key='ReleaseChannel',
-        condition=lambda throttler, x: x in ('aurora', 'beta', 'esr'),
+        condition=OneOf(('aurora', 'beta', 'esr')),
         result=ACCEPT
     ),
 
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from collections import OrderedDict
 import datetime
 from functools import wraps
 import json
@@ -182,6 +183,46 @@ def sanitize_dump_name(val):
     return val
 
 
+class LRUCache:
+    """Mapping that holds at most ``maxsize`` items.
+
+    When it's full, adding an item evicts the least recently used one. Getting
+    and setting items count as using them.
+
+    :arg int maxsize: maximum number of items
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def get(self, key, default=None):
+        """Return value for key or default if it's not in the cache."""
+        if key not in self.data:
+            return default
+        return self[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+
 class MaxAttemptsError(Exception):
     """Maximum attempts error.
 
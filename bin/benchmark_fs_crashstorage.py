@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Counts file system calls and time per crash saved with FSCrashStorage.
+
+This saves a bunch of crashes to a temp directory twice: once clearing the
+directory cache before every crash like there was no cache and once with
+the cache. For each, it prints the number of calls per crash to the ``os``
+functions that hit the file system.
+
+Usage::
+
+    python bin/benchmark_fs_crashstorage.py [NUMBER_OF_CRASHES]
+
+"""
+
+import functools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from everett.manager import ConfigManager
+
+sys.path.insert(0, os.getcwd())  # noqa
+
+from antenna.breakpad_resource import CrashReport
+from antenna.ext.fs.crashstorage import FSCrashStorage
+from antenna.util import create_crash_id
+
+
+COUNTED_FUNCTIONS = ['stat', 'lstat', 'mkdir', 'open', 'rename', 'fchmod', 'fsync']
+
+
+def count_calls(counts):
+    """Wrap os functions so calls to them are counted."""
+    originals = {}
+    for name in COUNTED_FUNCTIONS:
+        fun = getattr(os, name)
+        originals[name] = fun
+
+        def wrapper(*args, _name=name, _fun=fun, **kwargs):
+            counts[_name] = counts.get(_name, 0) + 1
+            return _fun(*args, **kwargs)
+
+        setattr(os, name, functools.wraps(fun)(wrapper))
+    return originals
+
+
+def run(crashstorage, crash_reports, use_cache):
+    counts = {}
+    originals = count_calls(counts)
+    start_time = time.time()
+    try:
+        for crash_report in crash_reports:
+            if not use_cache:
+                crashstorage.dir_cache.clear()
+            crashstorage.save_crash(crash_report)
+    finally:
+        for name, fun in originals.items():
+            setattr(os, name, fun)
+    return counts, time.time() - start_time
+
+
+def main(argv):
+    num_crashes = int(argv[0]) if argv else 1000
+    crash_reports = [
+        CrashReport(
+            raw_crash={'ProductName': 'Firefox'},
+            dumps={'upload_file_minidump': b'abcd1234'},
+            crash_id=create_crash_id(),
+        )
+        for i in range(num_crashes)
+    ]
+
+    for use_cache in (False, True):
+        root = tempfile.mkdtemp()
+        try:
+            crashstorage = FSCrashStorage(ConfigManager.from_dict({'FS_ROOT': root}))
+            counts, elapsed = run(crashstorage, crash_reports, use_cache)
+        finally:
+            shutil.rmtree(root)
+
+        print('%s directory cache:' % ('with' if use_cache else 'without'))
+        for name in COUNTED_FUNCTIONS:
+            print('    %-8s %6.2f calls/crash' % (name, counts.get(name, 0) / num_crashes))
+        print('    total    %6.2f calls/crash' % (sum(counts.values()) / num_crashes))
+        print('    time     %6.1f us/crash' % (elapsed / num_crashes * 1000000))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Measures file create latency in FSCrashStorage trees by partitioning scheme.
+
+For each partitioning scheme, this creates NUMBER_OF_FILES empty raw crash
+files for one day in a temp directory like FSCrashStorage would and prints
+create latency for the first and last 10% of files. Hourly partitions spread
+files evenly across the hours of the day.
+
+Usage::
+
+    python bin/benchmark_fs_partitioning.py [NUMBER_OF_FILES] [TMPDIR]
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.getcwd())  # noqa
+
+from antenna.ext.fs.layout import FSLayout
+
+
+SCHEMES = [
+    ('none', {}),
+    ('hourly', {'partition_hourly': 'true'}),
+    ('fanout=2', {'partition_fanout': '2'}),
+    ('hourly+fanout=2', {'partition_hourly': 'true', 'partition_fanout': '2'}),
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(layout, crash_ids):
+    latencies = []
+    dirs = set()
+    num_files = len(crash_ids)
+    for i, crash_id in enumerate(crash_ids):
+        hour = '%02d' % (i * 24 // num_files)
+        path = layout.get_raw_crash_path(crash_id, hour)
+        directory = os.path.dirname(path)
+        if directory not in dirs:
+            os.makedirs(directory, exist_ok=True)
+            dirs.add(directory)
+
+        start_time = time.perf_counter()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        os.close(fd)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def main(argv):
+    num_files = int(argv[0]) if argv else 1000000
+    tmp_root = argv[1] if len(argv) > 1 else None
+    crash_ids = [str(uuid.uuid4())[:-6] + '160918' for i in range(num_files)]
+    tenth = max(1, num_files // 10)
+
+    print('%d files' % num_files)
+    print('%-16s %22s %22s' % ('scheme', 'first 10% mean/p99 us', 'last 10% mean/p99 us'))
+    for name, config in SCHEMES:
+        root = tempfile.mkdtemp(dir=tmp_root)
+        try:
+            latencies = run(FSLayout.from_root(root, **config), crash_ids)
+        finally:
+            shutil.rmtree(root)
+
+        first, last = latencies[:tenth], latencies[-tenth:]
+        print('%-16s %10.1f / %9.1f %10.1f / %9.1f' % (
+            name,
+            sum(first) / len(first) * 1000000, percentile(first, 99) * 1000000,
+            sum(last) / len(last) * 1000000, percentile(last, 99) * 1000000,
+        ))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
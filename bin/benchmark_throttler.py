@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Times throttling crashes with a compiled rule set and with a rule loop.
+
+This generates a mix of crashes roughly like what Mozilla's collector sees
+and throttles them with ``MOZILLA_RULES`` twice: once trying each rule in
+order like the throttler used to and once with the compiled rule set. It
+prints the time per crash for each and checks that both pick the same rule
+for every crash.
+
+Usage::
+
+    python bin/benchmark_throttler.py [NUMBER_OF_CRASHES]
+
+"""
+
+import logging
+import os
+import random
+import sys
+import time
+
+from everett.manager import ConfigManager
+
+sys.path.insert(0, os.getcwd())  # noqa
+
+from antenna.throttler import MOZILLA_RULES, Throttler
+
+
+# (weight, value) for each annotation; None means the annotation is missing
+PRODUCTS = [
+    (70, 'Firefox'), (12, 'Fenix'), (5, 'Thunderbird'), (4, 'Focus'),
+    (3, 'Fennec'), (1, 'SeaMonkey'), (4, 'Unknown'), (1, 'B2G'),
+]
+CHANNELS = [
+    (65, 'release'), (15, 'beta'), (12, 'nightly'), (4, 'esr'), (2, 'aurora'),
+    (1, 'default'), (1, None),
+]
+THROTTLEABLE = [(97, None), (3, '0')]
+COMMENTS = [(97, None), (3, 'it crashed')]
+EMAIL = [(99, None), (1, 'foo@example.com')]
+HANGID = [(99, None), (1, 'abcd')]
+
+
+def pick(choices):
+    total = sum(weight for weight, value in choices)
+    n = random.random() * total
+    for weight, value in choices:
+        n -= weight
+        if n < 0:
+            break
+    return value
+
+
+def generate_crash():
+    crash = {
+        'ProductName': pick(PRODUCTS),
+        'Version': '68.0',
+        'BuildID': '20190701000000',
+        'ReleaseChannel': pick(CHANNELS),
+        'Throttleable': pick(THROTTLEABLE),
+        'Comments': pick(COMMENTS),
+        'Email': pick(EMAIL),
+        'HangID': pick(HANGID),
+    }
+    return {key: val for key, val in crash.items() if val is not None}
+
+
+def first_match(throttler, crash):
+    for rule in MOZILLA_RULES:
+        if rule.match(throttler, crash):
+            return rule
+    return None
+
+
+def run(name, fun, throttler, crashes):
+    start_time = time.perf_counter()
+    matches = [fun(throttler, crash) for crash in crashes]
+    delta = time.perf_counter() - start_time
+    print('%-10s %8.2f us per crash' % (name, delta * 1000000 / len(crashes)))
+    return matches
+
+
+def main(argv):
+    num_crashes = int(argv[0]) if argv else 100000
+
+    # Matching rules logs for some rules and we don't want to time that
+    logging.disable(logging.CRITICAL)
+
+    random.seed(0)
+    crashes = [generate_crash() for i in range(num_crashes)]
+
+    throttler = Throttler(ConfigManager.from_dict({}))
+    throttler.rule_set = MOZILLA_RULES
+
+    print('crashes: %s' % num_crashes)
+    loop_matches = run('loop', first_match, throttler, crashes)
+    compiled_matches = run('compiled', throttler.compiled_rule_set.match, throttler, crashes)
+
+    if loop_matches != compiled_matches:
+        print('ERROR: compiled rule set matched different rules')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -56,20 +56,21 @@ def main(args):
     # uses it. This makes it easier to use existing configuration.
     conn = S3Connection(config.with_namespace('crashstorage'))
 
-    # First, check to see if the bucket is already created.
-    try:
-        print('Checking to see if bucket "%s" exists...' % conn.bucket)
-        conn.verify_write_to_bucket()
-        print('Bucket exists.')
-
-    except ClientError as exc:
-        print(str(exc))
-        if '(NoSuchBucket)' in str(exc):
-            print('Bucket not found. Creating %s ...' % conn.bucket)
-            conn.client.create_bucket(Bucket=conn.bucket)
-            print('Bucket created.')
-        else:
-            raise
+    for bucket in conn.buckets:
+        # First, check to see if the bucket is already created.
+        try:
+            print('Checking to see if bucket "%s" exists...' % bucket)
+            conn.verify_write_to_bucket(bucket)
+            print('Bucket exists.')
+
+        except ClientError as exc:
+            print(str(exc))
+            if '(NoSuchBucket)' in str(exc):
+                print('Bucket not found. Creating %s ...' % bucket)
+                conn.client.create_bucket(Bucket=bucket)
+                print('Bucket created.')
+            else:
+                raise
 
 
 if __name__ == '__main__':
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Removes or archives old date directories in an FSCrashStorage tree.
+
+This uses the same configuration as Antenna in the ``CRASHSTORAGE``
+namespace. For example::
+
+    CRASHSTORAGE_FS_ROOT=/data/antenna_crashes
+    CRASHSTORAGE_RETENTION_MAX_AGE_DAYS=14
+
+Usage::
+
+    python bin/fs_retention.py
+
+"""
+
+import logging
+import os
+import sys
+
+from everett.manager import ConfigManager, ConfigOSEnv
+
+sys.path.insert(0, os.getcwd())  # noqa
+
+from antenna.ext.fs.retention import FSRetention
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+
+    config = ConfigManager([
+        # Pull configuration from environment variables
+        ConfigOSEnv()
+    ])
+
+    # We create it in the crashstorage namespace because that's how Antenna
+    # uses it. This makes it easier to use existing configuration.
+    retention = FSRetention(config.with_namespace('crashstorage'))
+    if not retention.is_enabled():
+        print('No retention limits are set.')
+        return 1
+
+    for day in retention.run():
+        print('Removed %s' % day)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Rebuilds index files for segments saved by SegmentLogCrashStorage.
+
+Use this when index files are missing or don't have the last records in a
+segment because the process died while saving a crash.
+
+Don't run this on the segment that's being written to.
+
+Usage::
+
+    python bin/rebuild_segmentlog_index.py ROOT [SEGMENT ...]
+
+If no segments are given, this rebuilds index files for all segments in ROOT.
+
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())  # noqa
+
+from antenna.ext.segmentlog.segment import list_segments, rebuild_index
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Rebuild segment log index files.')
+    parser.add_argument('root', help='segment log directory')
+    parser.add_argument('segments', nargs='*', help='segment names; defaults to all segments')
+    args = parser.parse_args(argv)
+
+    segments = args.segments or list_segments(args.root)
+    for segment in segments:
+        count = rebuild_index(args.root, segment)
+        print('%s: %d records' % (segment, count))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Simulates throttling a corpus of raw crashes with a rule set.
+
+Use this to see what changing a rule set would do before deploying it. It
+loads a rule set and a corpus of raw crashes and prints how many crashes
+each rule matches, how many crashes get each result and how many a second
+that is. It also times the throttler on some of the crashes to estimate the
+time throttling takes.
+
+The corpus can be directories of raw crash files like the ones
+``FSCrashStorage`` saves (every ``raw_crash/*.json`` file under the
+directory), JSONL files with one raw crash per line or JSON files with one
+raw crash.
+
+.. Note::
+
+   Crashes Antenna saved were already throttled, so a corpus of saved crashes
+   is missing the crashes that were rejected. For projections for all
+   incoming crashes, collect a corpus with ``antenna.throttler.ACCEPT_ALL``.
+
+Rules are evaluated a column at a time rather than a crash at a time. Each
+annotation a rule looks at is turned into an index of value -> crashes with
+that value:
+
+* ``Equals``, ``OneOf`` and ``always_match`` rules on a key are lookups in
+  the index
+* other conditions on a key are called once for each distinct value
+* conditions on ``*`` are called for each crash that no earlier rule matched
+
+Sampled rules use the throttler's sample value for each crash, so results
+match the throttler's. ``RateLimit`` and ``AdaptiveSample`` rules depend on
+crash rates, so they're projected from the duration of the corpus: either
+``--duration`` or the span of ``submitted_timestamp`` values.
+
+Usage::
+
+    python bin/simulate_throttle_rules.py [--rules RULES] CORPUS [CORPUS ...]
+
+"""
+
+import argparse
+from array import array
+import json
+import logging
+import os
+import sys
+import time
+
+from everett.manager import ConfigManager
+import isodate
+
+sys.path.insert(0, os.getcwd())  # noqa
+
+from antenna.throttler import (
+    RESULT_TO_TEXT,
+    RESULTS,
+    REJECT,
+    AdaptiveSample,
+    Equals,
+    OneOf,
+    RateLimit,
+    Throttler,
+    always_match,
+)
+
+
+def iter_raw_crashes(path):
+    """Yield raw crashes from a directory, JSONL file or JSON file."""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            if os.path.basename(root) != 'raw_crash':
+                continue
+            for fn in sorted(files):
+                if fn.endswith('.json'):
+                    with open(os.path.join(root, fn), 'r') as fp:
+                        yield json.load(fp)
+
+    elif path.endswith('.jsonl'):
+        with open(path, 'r') as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    else:
+        with open(path, 'r') as fp:
+            yield json.load(fp)
+
+
+class Column:
+    """Index of value -> rows for one annotation in the corpus.
+
+    :arg list crashes: the raw crashes
+    :arg str key: the annotation
+
+    """
+
+    def __init__(self, crashes, key):
+        # value -> array of rows with that value
+        self.rows_by_value = {}
+
+        # Rows with values that can't be dict keys
+        self.unhashable_rows = []
+
+        for row, crash in enumerate(crashes):
+            if key not in crash:
+                continue
+            value = crash[key]
+            try:
+                rows = self.rows_by_value.get(value)
+            except TypeError:
+                self.unhashable_rows.append(row)
+                continue
+            if rows is None:
+                rows = self.rows_by_value[value] = array('l')
+            rows.append(row)
+
+    def match(self, throttler, crashes, key, condition):
+        """Yield arrays of rows whose value matches the condition."""
+        if isinstance(condition, (Equals, OneOf)):
+            # Unhashable values aren't equal to any of the values
+            for value in condition.values:
+                if value in self.rows_by_value:
+                    yield self.rows_by_value[value]
+
+        elif condition is always_match:
+            yield from self.rows_by_value.values()
+            yield self.unhashable_rows
+
+        else:
+            for value, rows in self.rows_by_value.items():
+                if condition(throttler, value):
+                    yield rows
+            yield [row for row in self.unhashable_rows if condition(throttler, crashes[row][key])]
+
+
+def match_rules(throttler, crashes):
+    """Return the index of the first rule that matches each crash.
+
+    :returns: array of rule indexes; ``len(rules)`` means no rule matched
+
+    """
+    rules = throttler.rule_set
+    no_match = len(rules)
+    matches = array('l', [no_match]) * len(crashes)
+    remaining = set(range(len(crashes)))
+    columns = {}
+
+    for i, rule in enumerate(rules):
+        if not remaining:
+            break
+
+        if rule.key == '*':
+            if rule.condition is always_match:
+                matched = list(remaining)
+            else:
+                matched = [row for row in remaining if rule.condition(throttler, crashes[row])]
+
+        else:
+            column = columns.get(rule.key)
+            if column is None:
+                column = columns[rule.key] = Column(crashes, rule.key)
+            matched = [
+                row
+                for rows in column.match(throttler, crashes, rule.key, rule.condition)
+                for row in rows
+                if matches[row] == no_match
+            ]
+
+        for row in matched:
+            matches[row] = i
+        remaining.difference_update(matched)
+
+    return matches
+
+
+def get_duration(crashes):
+    """Return seconds between the first and last submitted_timestamp or None."""
+    timestamps = []
+    for crash in crashes:
+        try:
+            timestamps.append(isodate.parse_datetime(crash['submitted_timestamp']))
+        except (KeyError, TypeError, ValueError, isodate.ISO8601Error):
+            continue
+    if len(timestamps) < 2:
+        return None
+    return (max(timestamps) - min(timestamps)).total_seconds() or None
+
+
+def count_results(*pairs):
+    """Return ``{result: count}`` for ``(result, count)`` pairs."""
+    counts = {}
+    for result, count in pairs:
+        counts[result] = counts.get(result, 0) + count
+    return counts
+
+
+def project_rate_limit(rate_limit, crashes, rows, duration):
+    """Return ``{result: count}`` for crashes matching a RateLimit rule."""
+    counts = {}
+    for row in rows:
+        bucket_key = rate_limit.get_bucket_key(crashes[row])
+        counts[bucket_key] = counts.get(bucket_key, 0) + 1
+
+    allowed = sum(
+        min(count, int(rate_limit.burst + rate_limit.rate * duration))
+        for count in counts.values()
+    )
+    return count_results((rate_limit.result, allowed), (rate_limit.overflow, len(rows) - allowed))
+
+
+def project_adaptive_sample(adaptive_sample, rows, duration):
+    """Return ``{result: count}`` for crashes matching an AdaptiveSample rule."""
+    count = len(rows)
+    sampled = min(
+        count * adaptive_sample.ceiling / 100,
+        max(count * adaptive_sample.floor / 100, adaptive_sample.target_rate * duration)
+    )
+    sampled = int(round(sampled))
+    return count_results(
+        (adaptive_sample.result, sampled), (adaptive_sample.unsampled, count - sampled)
+    )
+
+
+def get_results(throttler, crashes, matches, duration):
+    """Return ``{rule index: {result: count}}``."""
+    rules = throttler.rule_set
+    rows_by_rule = {}
+    for row, i in enumerate(matches):
+        rows_by_rule.setdefault(i, []).append(row)
+
+    results = {}
+    for i, rows in rows_by_rule.items():
+        if i == len(rules):
+            # The throttler rejects crashes that match no rule
+            results[i] = {REJECT: len(rows)}
+            continue
+
+        result = rules[i].result
+        if result in RESULTS:
+            results[i] = {result: len(rows)}
+
+        elif isinstance(result, RateLimit):
+            results[i] = project_rate_limit(result, crashes, rows, duration or 0)
+
+        elif isinstance(result, AdaptiveSample):
+            results[i] = project_adaptive_sample(result, rows, duration or 0)
+
+        else:
+            percentage, le_result, gt_result = result
+            sampled = sum(
+                1 for row in rows if throttler.get_sample_value(crashes[row]) <= percentage
+            )
+            results[i] = count_results((le_result, sampled), (gt_result, len(rows) - sampled))
+
+    return results
+
+
+def time_throttler(throttler, crashes, matches, num_crashes):
+    """Time the throttler and check it matches the same rules.
+
+    :returns: ``(seconds per crash, number of mismatched crashes)``
+
+    """
+    step = max(1, len(crashes) // num_crashes)
+    rows = range(0, len(crashes), step)[:num_crashes]
+
+    match_index = throttler.compiled_rule_set.match_index
+    mismatched = sum(1 for row in rows if match_index(throttler, crashes[row]) != matches[row])
+
+    start_time = time.perf_counter()
+    for row in rows:
+        throttler.throttle(crashes[row])
+    delta = time.perf_counter() - start_time
+    return delta / len(rows), mismatched
+
+
+def format_rate(count, duration):
+    if not duration:
+        return ''
+    return '%10.2f/s' % (count / duration)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Simulate throttling a corpus of raw crashes.')
+    parser.add_argument(
+        '--rules', default='antenna.throttler.MOZILLA_RULES',
+        help='Python dotted path to rule set or path to JSON or YAML rule file'
+    )
+    parser.add_argument(
+        '--products', default='antenna.throttler.MOZILLA_PRODUCTS',
+        help='Python dotted path to list of supported products'
+    )
+    parser.add_argument(
+        '--sample-keys', default='',
+        help='comma-separated raw crash keys to hash to decide sampled rules'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=None,
+        help='seconds the corpus covers; defaults to the span of submitted_timestamp values'
+    )
+    parser.add_argument(
+        '--time', type=int, default=10000,
+        help='number of crashes to time the throttler with'
+    )
+    parser.add_argument('corpus', nargs='+', help='directories, JSONL files or JSON files')
+    args = parser.parse_args(argv)
+
+    # Matching rules logs for some rules and we don't want that in the output
+    logging.disable(logging.CRITICAL)
+
+    throttler = Throttler(ConfigManager.from_dict({
+        'THROTTLE_RULES': args.rules,
+        'PRODUCTS': args.products,
+        'THROTTLE_SAMPLE_KEYS': args.sample_keys,
+    }))
+
+    start_time = time.perf_counter()
+    crashes = [crash for path in args.corpus for crash in iter_raw_crashes(path)]
+    load_time = time.perf_counter() - start_time
+    if not crashes:
+        print('ERROR: no crashes in corpus')
+        return 1
+
+    duration = args.duration or get_duration(crashes)
+
+    start_time = time.perf_counter()
+    matches = match_rules(throttler, crashes)
+    results = get_results(throttler, crashes, matches, duration)
+    simulate_time = time.perf_counter() - start_time
+
+    print('crashes: %s (loaded in %.2fs, simulated in %.2fs)' % (
+        len(crashes), load_time, simulate_time
+    ))
+    print('duration: %s' % ('%.2fs' % duration if duration else 'unknown'))
+    if not duration and any(
+            isinstance(rule.result, (RateLimit, AdaptiveSample)) for rule in throttler.rule_set
+    ):
+        print('WARNING: duration is unknown, so rate limited and adaptive rules accept their burst or floor')
+    print()
+
+    rule_names = [rule.rule_name for rule in throttler.rule_set] + ['NO_MATCH']
+    totals = {}
+    print('%-30s %10s %8s  %s' % ('rule', 'matches', 'rate', 'results'))
+    for i, rule_name in enumerate(rule_names):
+        counts = results.get(i, {})
+        num_matches = sum(counts.values())
+        for result, count in counts.items():
+            totals[result] = totals.get(result, 0) + count
+        print('%-30s %10d %7.2f%%  %s' % (
+            rule_name, num_matches, num_matches * 100.0 / len(crashes),
+            ', '.join(
+                '%s=%d' % (RESULT_TO_TEXT[result], count)
+                for result, count in sorted(counts.items())
+                if count
+            )
+        ))
+    print()
+
+    print('%-10s %10s %8s %12s' % ('result', 'crashes', 'rate', 'throughput'))
+    for result in RESULTS:
+        count = totals.get(result, 0)
+        print('%-10s %10d %7.2f%% %12s' % (
+            RESULT_TO_TEXT[result], count, count * 100.0 / len(crashes), format_rate(count, duration)
+        ))
+    print()
+
+    seconds_per_crash, mismatched = time_throttler(throttler, crashes, matches, args.time)
+    print('throttler: %.2f us per crash' % (seconds_per_crash * 1000000))
+    if duration:
+        print('throttler: %.2f ms per second at %.2f crashes/s' % (
+            seconds_per_crash * len(crashes) / duration * 1000, len(crashes) / duration
+        ))
+
+    if mismatched:
+        print('ERROR: simulation matched different rules than the throttler for %d crashes' % mismatched)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
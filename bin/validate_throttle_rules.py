@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Validates throttle rule files.
+
+This loads and compiles each rule file and prints the rules or the first
+error. If crash files are given, it also throttles each raw crash with each
+rule set and prints the result.
+
+Usage::
+
+    python bin/validate_throttle_rules.py RULEFILE [RULEFILE ...] [--crash RAWCRASHFILE ...]
+
+Exits with 1 if any rule file is not valid.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from everett.manager import ConfigManager
+
+sys.path.insert(0, os.getcwd())  # noqa
+
+from antenna.rulefile import RuleFileError, load_rule_file
+from antenna.throttler import RESULT_TO_TEXT, AdaptiveSample, RateLimit, Throttler
+
+
+def format_result(result):
+    if isinstance(result, (AdaptiveSample, RateLimit)):
+        return repr(result)
+    if isinstance(result, tuple):
+        return '[%s, %s, %s]' % (result[0], RESULT_TO_TEXT[result[1]], RESULT_TO_TEXT[result[2]])
+    return RESULT_TO_TEXT[result]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Validate throttle rule files.')
+    parser.add_argument('rulefiles', nargs='+', help='JSON or YAML rule files')
+    parser.add_argument(
+        '--crash', action='append', default=[],
+        help='JSON raw crash file to throttle with each rule set'
+    )
+    args = parser.parse_args(argv)
+
+    crashes = []
+    for path in args.crash:
+        with open(path, 'r') as fp:
+            crashes.append((path, json.load(fp)))
+
+    ret = 0
+    for path in args.rulefiles:
+        try:
+            rules = load_rule_file(path)
+        except (OSError, RuleFileError) as exc:
+            print('%s: ERROR: %s' % (path, exc))
+            ret = 1
+            continue
+
+        print('%s: %d rules' % (path, len(rules)))
+        for rule in rules:
+            print('    %s: %s %r -> %s' % (
+                rule.rule_name, rule.key, rule.condition, format_result(rule.result)
+            ))
+
+        if crashes:
+            throttler = Throttler(ConfigManager.from_dict({
+                'THROTTLE_RULES': path,
+                'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS',
+            }))
+            for crash_path, raw_crash in crashes:
+                result, rule_name, percentage = throttler.throttle(raw_crash)
+                print('    %s: %s %s %s' % (
+                    crash_path, RESULT_TO_TEXT[result], rule_name, percentage
+                ))
+
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
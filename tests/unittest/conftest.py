@@ -22,6 +22,7 @@ REPO_ROOT = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(REPO_ROOT))
 
 from antenna.app import get_app, setup_logging  # noqa
+from antenna.breakpad_resource import CrashReport  # noqa
 from antenna.heartbeat import reset_hb_funs  # noqa
 from testlib.loggingmock import LoggingMock  # noqa
 from testlib.s3mock import S3Mock  # noqa
@@ -135,6 +136,35 @@ def s3mock():
         yield s3
 
 
+@pytest.fixture
+def crash_report():
+    """Returns a function that builds a CrashReport
+
+    By default, the raw crash is a Firefox crash with the crash id in ``uuid``
+    and there's one dump.
+
+    Usage::
+
+        def test_something(crash_report):
+            report = crash_report()
+            other_report = crash_report(
+                'de1bb258-cbbf-4589-a673-34f800160919',
+                raw_crash={'ProductName': 'Fenix'},
+                dumps={},
+            )
+
+    """
+    def _crash_report(crash_id='de1bb258-cbbf-4589-a673-34f800160918', raw_crash=None,
+                      dumps=None):
+        if raw_crash is None:
+            raw_crash = {'ProductName': 'Firefox', 'uuid': crash_id}
+        if dumps is None:
+            dumps = {'upload_file_minidump': b'abcd1234'}
+        return CrashReport(raw_crash=raw_crash, dumps=dumps, crash_id=crash_id)
+
+    return _crash_report
+
+
 @pytest.fixture
 def loggingmock():
     """Returns a loggingmock that builds a logging mock context to record logged records
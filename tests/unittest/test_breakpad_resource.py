@@ -22,6 +22,20 @@ class BadCrashStorage(CrashStorageBase):
         raise Exception
 
 
+class PausedCrashStorage(CrashStorageBase):
+    paused = True
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.saved_things = []
+
+    def is_paused(self):
+        return self.paused
+
+    def save_crash(self, crash_report):
+        self.saved_things.append(crash_report.crash_id)
+
+
 class BadCrashPublish(CrashPublishBase):
     def publish_crash(self, crash_id):
         raise Exception
@@ -321,3 +335,32 @@ class TestBreakpadSubmitterResource:
                         )
                     )
                 )
+
+    def test_paused_storage(self, client):
+        data, headers = multipart_encode({
+            'uuid': 'de1bb258-cbbf-4589-a673-34f800160918',
+            'ProductName': 'Firefox',
+            'Version': '60.0a1',
+            'ReleaseChannel': 'nightly',
+            'upload_file_minidump': ('fakecrash.dump', io.BytesIO(b'abcd1234'))
+        })
+
+        client.rebuild_app({
+            'CRASHSTORAGE_CLASS': PausedCrashStorage.__module__ + '.' + PausedCrashStorage.__name__,
+        })
+        bpr = client.get_resource_by_name('breakpad')
+
+        result = client.simulate_post('/submit', headers=headers, body=data)
+        assert result.status_code == 200
+        client.join_app()
+
+        # Crash storage is paused, so the crash waits in the queue
+        assert len(bpr.crashmover_queue) == 1
+        assert bpr.crashstorage.saved_things == []
+
+        # Once it's unpaused, the heartbeat starts a crashmover
+        bpr.crashstorage.paused = False
+        bpr.hb_run_crashmover()
+        client.join_app()
+        assert len(bpr.crashmover_queue) == 0
+        assert bpr.crashstorage.saved_things == ['de1bb258-cbbf-4589-a673-34f800160918']
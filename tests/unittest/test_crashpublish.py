@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+
+from everett.manager import ConfigManager
+import pytest
+
+from antenna.ext.crashpublish_base import NoOpCrashPublish, parse_routes
+from antenna.throttler import ACCEPT, DEFER
+from testlib.mini_poster import multipart_encode
+
+
+class Test_parse_routes:
+    def test_empty(self):
+        assert parse_routes('') == []
+
+    def test_routes(self):
+        assert parse_routes('DEFER:deferred, ACCEPT & ProductName=Fenix:fenix,Version=1.0:ones') == [
+            ((('legacy_processing', DEFER),), 'deferred'),
+            ((('legacy_processing', ACCEPT), ('ProductName', 'Fenix')), 'fenix'),
+            ((('Version', '1.0'),), 'ones'),
+        ]
+
+    @pytest.mark.parametrize('val', [
+        'deferred',
+        'DEFER:',
+        ':deferred',
+        'REJECT:rejected',
+        'ProductName:fenix',
+        '=Fenix:fenix',
+    ])
+    def test_invalid(self, val):
+        with pytest.raises(ValueError):
+            parse_routes(val)
+
+
+class TestRouting:
+    def build_publish(self, **config):
+        return NoOpCrashPublish(ConfigManager.from_dict(config))
+
+    def test_default(self, crash_report):
+        publish = self.build_publish()
+        publish.publish_crash(crash_report('1', raw_crash={'legacy_processing': DEFER}))
+        assert publish.published_things == [{'crash_id': '1'}]
+
+    def test_routes(self, crash_report):
+        publish = self.build_publish(
+            ROUTES='DEFER:deferred,ACCEPT&ProductName=Fenix:fenix'
+        )
+        assert publish.get_destinations() == {'deferred', 'fenix'}
+
+        publish.publish_crash(crash_report(
+            '1', raw_crash={'legacy_processing': DEFER, 'ProductName': 'Fenix'}
+        ))
+        publish.publish_crash(crash_report(
+            '2', raw_crash={'legacy_processing': ACCEPT, 'ProductName': 'Fenix'}
+        ))
+        publish.publish_crash(crash_report(
+            '3', raw_crash={'legacy_processing': ACCEPT, 'ProductName': 'Firefox'}
+        ))
+        assert publish.published_things == [
+            {'crash_id': '1', 'destination': 'deferred'},
+            {'crash_id': '2', 'destination': 'fenix'},
+            {'crash_id': '3'},
+        ]
+
+    def test_skip_defer(self, metricsmock, crash_report):
+        publish = self.build_publish(PUBLISH_DEFER='false')
+        with metricsmock as mm:
+            publish.publish_crash(crash_report('1', raw_crash={'legacy_processing': DEFER}))
+            publish.publish_crash(crash_report('2', raw_crash={'legacy_processing': ACCEPT}))
+            assert mm.has_record(
+                fun_name='incr', stat='crashpublish.skipped', value=1, tags=['result:defer']
+            )
+        assert publish.published_things == [{'crash_id': '2'}]
+
+    def test_flow(self, client, tmpdir):
+        path = tmpdir.join('rules.json')
+        path.write(json.dumps({'rules': [
+            {'name': 'is_beta', 'key': 'ReleaseChannel', 'op': 'eq', 'value': 'beta', 'result': 'DEFER'},
+            {'name': 'accept_everything', 'key': 'ProductName', 'op': 'exists', 'result': 'ACCEPT'},
+        ]}))
+        client.rebuild_app({
+            'THROTTLE_RULES': str(path),
+            'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS',
+            'CRASHPUBLISH_PUBLISH_DEFER': 'false',
+            'CRASHPUBLISH_ROUTES': 'ProductName=Fenix:fenix',
+        })
+
+        for crash_id, product, channel in [
+                ('de1bb258-cbbf-4589-a673-34f800160918', 'Firefox', 'beta'),
+                ('de1bb258-cbbf-4589-a673-34f800160919', 'Fenix', 'release'),
+                ('de1bb258-cbbf-4589-a673-34f800160920', 'Firefox', 'release'),
+        ]:
+            data, headers = multipart_encode({
+                'uuid': crash_id,
+                'ProductName': product,
+                'ReleaseChannel': channel,
+                'Version': '1.0',
+                'upload_file_minidump': ('fakecrash.dump', io.BytesIO(b'abcd1234'))
+            })
+            result = client.simulate_post('/submit', headers=headers, body=data)
+            assert result.status_code == 200
+        client.join_app()
+
+        # All three were saved, but the deferred one wasn't published
+        bsr = client.get_resource_by_name('breakpad')
+        assert len(bsr.crashstorage.saved_things) == 3
+        assert bsr.crashpublish.published_things == [
+            {'crash_id': 'de1bb258-cbbf-4589-a673-34f800160919', 'destination': 'fenix'},
+            {'crash_id': 'de1bb258-cbbf-4589-a673-34f800160920'},
+        ]
@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+from unittest.mock import patch
+
+from everett.manager import ConfigManager
+import pytest
+
+from antenna.dedupe import DuplicateDetector, MemoryDuplicateStore, parse_dedupe_action
+from testlib.mini_poster import multipart_encode
+
+
+CRASH_ID = 'de1bb258-cbbf-4589-a673-34f800160918'
+
+
+def test_parse_dedupe_action():
+    assert parse_dedupe_action(' Original ') == 'original'
+    with pytest.raises(ValueError):
+        parse_dedupe_action('foo')
+
+
+class TestMemoryDuplicateStore:
+    def test_expires(self):
+        store = MemoryDuplicateStore(ConfigManager.from_dict({}))
+        with patch('antenna.dedupe.time.monotonic') as mock_monotonic:
+            mock_monotonic.return_value = 1000
+            store.set('key', CRASH_ID, 60)
+            assert store.get('key') == CRASH_ID
+            assert store.get('otherkey') is None
+
+            mock_monotonic.return_value = 1060
+            assert store.get('key') is None
+            assert len(store) == 0
+
+    def test_max_entries(self):
+        store = MemoryDuplicateStore(ConfigManager.from_dict({'DEDUPE_MAX_ENTRIES': '2'}))
+        for key in ['a', 'b', 'c']:
+            store.set(key, CRASH_ID, 60)
+        assert len(store) == 2
+        assert store.get('a') is None
+
+
+class TestDuplicateDetector:
+    def test_off(self):
+        detector = DuplicateDetector(ConfigManager.from_dict({}))
+        raw_crash = {'uuid': CRASH_ID}
+        detector.add(raw_crash, CRASH_ID)
+        assert detector.find_original(raw_crash) is None
+
+    def test_keys(self, metricsmock):
+        detector = DuplicateDetector(ConfigManager.from_dict({'DEDUPE_ACTION': 'count'}))
+        with metricsmock as mm:
+            assert detector.find_original({'MinidumpSha256Hash': 'abcd'}) is None
+            assert mm.has_record(stat='dedupe.unique')
+
+        detector.add({'uuid': CRASH_ID, 'MinidumpSha256Hash': 'abcd'}, CRASH_ID)
+
+        with metricsmock as mm:
+            # Resubmitted with the uuid
+            assert detector.find_original({'uuid': CRASH_ID}) == CRASH_ID
+            assert mm.has_record(stat='dedupe.duplicate', tags=['key:uuid', 'action:count'])
+
+            # Retried with the same minidump
+            assert detector.find_original({'MinidumpSha256Hash': 'abcd'}) == CRASH_ID
+            assert mm.has_record(stat='dedupe.duplicate', tags=['key:minidump_hash', 'action:count'])
+
+        # Crashes with no minidump aren't duplicates of each other
+        detector.add({'MinidumpSha256Hash': ''}, CRASH_ID)
+        assert detector.find_original({'MinidumpSha256Hash': ''}) is None
+
+
+class TestDedupeSubmissions:
+    def post_crash(self, client):
+        data, headers = multipart_encode({
+            'ProductName': 'Firefox',
+            'Version': '60.0a1',
+            'ReleaseChannel': 'nightly',
+            'upload_file_minidump': ('fakecrash.dump', io.BytesIO(b'abcd1234'))
+        })
+        result = client.simulate_post('/submit', headers=headers, body=data)
+        assert result.status_code == 200
+        return result.content.decode('utf-8')
+
+    @pytest.mark.parametrize('action, num_saved', [
+        ('off', 2),
+        ('count', 2),
+        ('original', 1),
+        ('fakeaccept', 1),
+    ])
+    def test_actions(self, client, action, num_saved):
+        client.rebuild_app({'DEDUPE_ACTION': action})
+        bpr = client.get_resource_by_name('breakpad')
+
+        first = self.post_crash(client)
+        second = self.post_crash(client)
+        client.join_app()
+
+        assert len(bpr.crashstorage.saved_things) == num_saved
+        if action == 'original':
+            assert second == first
+        else:
+            assert second != first
+            assert second.startswith('CrashID=bp-')
@@ -4,9 +4,17 @@
 
 import io
 import os
+import threading
+import time
+from unittest.mock import Mock, patch
 
+from everett.manager import ConfigManager
 from freezegun import freeze_time
+import gevent
+import pytest
 
+from antenna.ext.fs.crashstorage import DirectoryCache, FSCrashStorage, fsync_dir
+from antenna.health_resource import HealthState
 from testlib.mini_poster import multipart_encode
 
 
@@ -96,3 +104,248 @@ class TestFSCrashStorage:
             contents['/antenna_crashes/20160918/upload_file_minidump/de1bb258-cbbf-4589-a673-34f800160918'] ==
             b'abcd1234'
         )
+
+    @pytest.mark.parametrize('fsync_mode', ['none', 'always', 'group'])
+    def test_fsync_modes(self, tmpdir, fsync_mode, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'FSYNC_MODE': fsync_mode,
+        }))
+        crashstorage.save_crash(crash_report())
+
+        # No temp files are left behind
+        assert (
+            sorted([fn[len(root):] for fn in get_tree(root)]) ==
+            sorted([
+                '/20160918/raw_crash/de1bb258-cbbf-4589-a673-34f800160918.json',
+                '/20160918/dump_names/de1bb258-cbbf-4589-a673-34f800160918.json',
+                '/20160918/upload_file_minidump/de1bb258-cbbf-4589-a673-34f800160918',
+            ])
+        )
+
+    def test_failed_write_leaves_no_files(self, tmpdir, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+        }))
+
+        # Writing the third file fails, so none of the files should be in the
+        # tree and there shouldn't be any temp files left over
+        with patch('antenna.ext.fs.crashstorage.os.fchmod') as mock_fchmod:
+            mock_fchmod.side_effect = [None, None, OSError('disk on fire')]
+            with pytest.raises(OSError):
+                crashstorage.save_crash(crash_report())
+
+        assert get_tree(root) == []
+
+    def test_group_commit(self, tmpdir, metricsmock, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'FSYNC_MODE': 'group',
+            'GROUP_COMMIT_WINDOW': '0.05',
+        }))
+
+        crash_reports = [
+            crash_report('de1bb258-cbbf-4589-a673-34f80016091%d' % i)
+            for i in range(3)
+        ]
+        with metricsmock as mm:
+            gevent.joinall([
+                gevent.spawn(crashstorage.save_crash, report)
+                for report in crash_reports
+            ])
+
+            # All three crashes were committed in one batch
+            records = mm.filter_records(stat='fscrashstorage.group_commit.batch_size')
+            assert len(records) == 1
+            assert records[0][2] == 9
+
+        assert len(get_tree(root)) == 9
+
+    def test_partitioned(self, tmpdir, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'PARTITION_HOURLY': 'true',
+            'PARTITION_FANOUT': '2',
+        }))
+        report = crash_report()
+        report.raw_crash['submitted_timestamp'] = '2016-09-18T07:12:34+00:00'
+        crashstorage.save_crash(report)
+
+        crash_dir = os.path.join(root, '20160918', '07', 'de')
+        assert sorted(get_tree(root)) == [
+            os.path.join(crash_dir, 'dump_names', report.crash_id + '.json'),
+            os.path.join(crash_dir, 'raw_crash', report.crash_id + '.json'),
+            os.path.join(crash_dir, 'upload_file_minidump', report.crash_id),
+        ]
+        assert crashstorage.layout.find_crash_dir(report.crash_id) == crash_dir
+
+    @freeze_time('2016-09-18 13:00:00', tz_offset=0)
+    def test_partitioned_save_separately(self, tmpdir, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'PARTITION_HOURLY': 'true',
+        }))
+        report = crash_report()
+        report.raw_crash['submitted_timestamp'] = '2016-09-18T07:12:34+00:00'
+
+        # Dumps go in the raw crash's hour, not the current hour
+        crashstorage.save_dumps(report.crash_id, report.dumps, raw_crash=report.raw_crash)
+        crashstorage.save_raw_crash(report.crash_id, report.raw_crash)
+        assert len(get_tree(os.path.join(root, '20160918', '07'))) == 3
+
+    def test_directory_cache(self, tmpdir, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({'FS_ROOT': root}))
+        crashstorage.save_crash(crash_report())
+
+        # Directories for the second crash are all cached, so it doesn't make
+        # any
+        with patch('antenna.ext.fs.crashstorage.make_dirs') as mock_make_dirs:
+            crashstorage.save_crash(crash_report('ee1bb258-cbbf-4589-a673-34f800160918'))
+            assert mock_make_dirs.call_count == 0
+
+        assert len(get_tree(root)) == 6
+
+    def test_new_directories_fsynced(self, tmpdir, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'FSYNC_MODE': 'always',
+        }))
+        date_dir = os.path.join(root, '20160918')
+
+        with patch('antenna.ext.fs.crashstorage.fsync_dir', side_effect=fsync_dir) as mock_fsync_dir:
+            crashstorage.save_crash(crash_report())
+            fsynced = [call[0][0] for call in mock_fsync_dir.call_args_list]
+
+            # The parents of the new directories are fsynced so the new
+            # directories are durable
+            assert fsynced.count(root) == 1
+            assert fsynced.count(date_dir) == 3
+
+            # Directories that already exist aren't fsynced again
+            mock_fsync_dir.reset_mock()
+            crashstorage.save_crash(crash_report('ee1bb258-cbbf-4589-a673-34f800160918'))
+            fsynced = [call[0][0] for call in mock_fsync_dir.call_args_list]
+            assert root not in fsynced
+            assert date_dir not in fsynced
+
+    def test_directory_removed(self, tmpdir, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({'FS_ROOT': root}))
+        crashstorage.save_crash(crash_report())
+
+        # Something cleaning up the tree removes the cached directories
+        for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+            for fn in filenames:
+                os.remove(os.path.join(dirpath, fn))
+            if dirpath != root:
+                os.rmdir(dirpath)
+
+        # The cache is cleared by the greenlet saving the crash and not in the
+        # threadpool
+        clear_threads = []
+        clear = crashstorage.dir_cache.clear
+
+        def record_clear():
+            clear_threads.append(threading.get_ident())
+            clear()
+
+        with patch.object(crashstorage.dir_cache, 'clear', side_effect=record_clear):
+            crashstorage.save_crash(crash_report('ee1bb258-cbbf-4589-a673-34f800160918'))
+        assert clear_threads == [threading.get_ident()]
+        assert len(get_tree(root)) == 3
+
+    def test_threadpool(self, tmpdir, metricsmock, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'THREADPOOL_SIZE': '2',
+        }))
+
+        # Make writes block for a while
+        fchmod = os.fchmod
+
+        def slow_fchmod(fd, mode):
+            time.sleep(0.05)
+            fchmod(fd, mode)
+
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(1)
+                gevent.sleep(0.01)
+
+        ticker = gevent.spawn(tick)
+        with metricsmock as mm:
+            with patch('antenna.ext.fs.crashstorage.os.fchmod', side_effect=slow_fchmod):
+                crashstorage.save_crash(crash_report())
+            assert mm.has_record(stat='fscrashstorage.threadpool.queue_wait')
+        ticker.kill()
+
+        # Other greenlets kept running while files were being written
+        assert len(ticks) > 5
+        assert len(get_tree(root)) == 3
+
+    def test_no_threadpool(self, tmpdir, metricsmock, crash_report):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'THREADPOOL_SIZE': '0',
+        }))
+        assert crashstorage.threadpool is None
+
+        with metricsmock as mm:
+            crashstorage.save_crash(crash_report())
+            assert not mm.has_record(stat='fscrashstorage.threadpool.queue_wait')
+        assert len(get_tree(root)) == 3
+
+    @pytest.mark.parametrize('blocks_free, files_free, healthy, paused', [
+        # Plenty of space
+        (50, 50, True, False),
+        # Below the soft watermark for space or inodes
+        (5, 50, False, False),
+        (50, 5, False, False),
+        # Below the hard watermark
+        (1, 50, False, True),
+        (50, 1, False, True),
+    ])
+    def test_watermarks(self, tmpdir, metricsmock, blocks_free, files_free, healthy, paused):
+        root = str(tmpdir.join('antenna_crashes'))
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'SOFT_WATERMARK': '10',
+            'HARD_WATERMARK': '2',
+        }))
+
+        statvfs = Mock(f_blocks=100, f_bavail=blocks_free, f_files=100, f_favail=files_free)
+        with metricsmock as mm:
+            with patch('antenna.ext.fs.crashstorage.os.statvfs', return_value=statvfs):
+                crashstorage.hb_check_free_space()
+            assert mm.has_record(stat='fscrashstorage.free_space_percent', value=blocks_free)
+            assert mm.has_record(stat='fscrashstorage.free_inodes_percent', value=files_free)
+
+        state = HealthState()
+        crashstorage.check_health(state)
+        assert state.is_healthy() is healthy
+        assert state.statsd['FSCrashStorage.free_space_percent'] == blocks_free
+        assert crashstorage.is_paused() is paused
+
+
+class TestDirectoryCache:
+    def test_evicts_oldest_dates(self):
+        cache = DirectoryCache(max_dates=2)
+        cache.add('20160918', '/tmp/20160918/raw_crash')
+        cache.add('20160919', '/tmp/20160919/raw_crash')
+        assert ('20160918', '/tmp/20160918/raw_crash') in cache
+
+        cache.add('20160920', '/tmp/20160920/raw_crash')
+        assert ('20160918', '/tmp/20160918/raw_crash') not in cache
+        assert ('20160919', '/tmp/20160919/raw_crash') in cache
+        assert ('20160920', '/tmp/20160920/raw_crash') in cache
@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+
+from freezegun import freeze_time
+import pytest
+
+from antenna.ext.fs.layout import FSLayout, get_crash_hour
+
+
+CRASH_ID = 'de1bb258-cbbf-4589-a673-34f800160918'
+
+
+class Test_get_crash_hour:
+    def test_submitted_timestamp(self):
+        assert get_crash_hour({'submitted_timestamp': '2016-09-18T07:12:34.123456+00:00'}) == '07'
+
+    @freeze_time('2016-09-18 13:00:00')
+    @pytest.mark.parametrize('raw_crash', [None, {}, {'submitted_timestamp': 'foo'}])
+    def test_falls_back_to_now(self, raw_crash):
+        assert get_crash_hour(raw_crash) == '13'
+
+
+class TestFSLayout:
+    def test_default(self):
+        layout = FSLayout.from_root('/data')
+        assert layout.get_raw_crash_path(CRASH_ID) == '/data/20160918/raw_crash/' + CRASH_ID + '.json'
+        assert layout.get_dump_names_path(CRASH_ID) == '/data/20160918/dump_names/' + CRASH_ID + '.json'
+        assert (
+            layout.get_dump_path(CRASH_ID, 'upload_file_minidump') ==
+            '/data/20160918/upload_file_minidump/' + CRASH_ID
+        )
+
+    def test_partitioned(self):
+        layout = FSLayout.from_root('/data', partition_hourly='true', partition_fanout='2')
+        assert (
+            layout.get_raw_crash_path(CRASH_ID, hour='07') ==
+            '/data/20160918/07/de/raw_crash/' + CRASH_ID + '.json'
+        )
+
+        with pytest.raises(ValueError):
+            layout.get_crash_dir(CRASH_ID)
+
+    def test_iter_and_find_crash_dirs(self, tmpdir):
+        root = str(tmpdir)
+        layout = FSLayout.from_root(root, partition_hourly='true', partition_fanout='2')
+        for hour, crash_id in [('07', CRASH_ID), ('07', 'ab' + CRASH_ID[2:]), ('23', 'cd' + CRASH_ID[2:])]:
+            path = layout.get_raw_crash_path(crash_id, hour)
+            os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+        assert [os.path.relpath(path, root) for path in layout.iter_crash_dirs('20160918')] == [
+            '20160918/07/ab', '20160918/07/de', '20160918/23/cd'
+        ]
+        assert layout.find_crash_dir('cd' + CRASH_ID[2:]) == os.path.join(root, '20160918/23/cd')
+        assert layout.find_crash_dir('ef' + CRASH_ID[2:]) is None
@@ -0,0 +1,241 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import tarfile
+import threading
+import time
+from unittest.mock import patch
+
+from everett.manager import ConfigManager
+from freezegun import freeze_time
+import pytest
+
+from antenna.breakpad_resource import CrashReport
+from antenna.ext.fs.crashstorage import FSCrashStorage
+from antenna.ext.fs.retention import FSRetention, RateLimiter
+from antenna.ext.segmentlog.segment import SegmentLogReader
+
+
+# Crash ids for 20160915 through 20160918
+CRASH_IDS = ['de1bb258-cbbf-4589-a673-34f80016091%d' % i for i in range(5, 9)]
+
+
+def build_tree(root, **extra):
+    config = {'FS_ROOT': root}
+    config.update(extra)
+    crashstorage = FSCrashStorage(ConfigManager.from_dict(config))
+    for crash_id in CRASH_IDS:
+        crashstorage.save_crash(CrashReport(
+            raw_crash={'uuid': crash_id},
+            dumps={'upload_file_minidump': b'x' * 1000},
+            crash_id=crash_id
+        ))
+
+
+def build_retention(root, **extra):
+    config = {'FS_ROOT': root}
+    config.update(extra)
+    return FSRetention(ConfigManager.from_dict(config))
+
+
+def get_days(root):
+    return sorted(name for name in os.listdir(root) if not name.startswith('.'))
+
+
+@freeze_time('2016-09-18 12:00:00')
+class TestFSRetention:
+    def test_disabled(self, tmpdir):
+        assert not build_retention(str(tmpdir)).is_enabled()
+
+    def test_max_age(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+
+        retention = build_retention(root, RETENTION_MAX_AGE_DAYS='2')
+        assert retention.run() == ['20160915']
+        assert get_days(root) == ['20160916', '20160917', '20160918']
+
+    def test_max_size(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+
+        # Each day is a little over 1000 bytes, so this keeps two days
+        retention = build_retention(root, RETENTION_MAX_SIZE='2500')
+        assert retention.run() == ['20160915', '20160916']
+        assert get_days(root) == ['20160917', '20160918']
+
+    def test_sizes_cached(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+
+        retention = build_retention(root, RETENTION_MAX_SIZE='100000')
+        assert retention.run() == []
+
+        # Only today and yesterday are walked again
+        with patch.object(retention, 'get_size', return_value=0) as mock_get_size:
+            assert retention.run() == []
+        assert [call[0][0] for call in mock_get_size.call_args_list] == ['20160917', '20160918']
+
+    def test_threadpool(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+        crashstorage = FSCrashStorage(ConfigManager.from_dict({
+            'FS_ROOT': root,
+            'THREADPOOL_SIZE': '2',
+            'RETENTION_MAX_AGE_DAYS': '2',
+        }))
+        retention = crashstorage.retention
+
+        # Files are removed in the threadpool and not in the hub's thread
+        remove_threads = []
+        remove_files = retention._remove_files
+
+        def record_remove_files(files):
+            remove_threads.append(threading.get_ident())
+            remove_files(files)
+
+        with patch.object(retention, '_remove_files', side_effect=record_remove_files):
+            assert retention.run() == ['20160915']
+        assert remove_threads and threading.get_ident() not in remove_threads
+
+    def test_new_files_while_removing(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+        retention = build_retention(root, RETENTION_MAX_AGE_DAYS='2')
+
+        # A crash with an old date is saved while the day is being removed
+        new_file = os.path.join(root, '20160915', 'raw_crash', 'new.json')
+        remove_files = retention._remove_files
+
+        def remove_files_and_add_one(files):
+            remove_files(files)
+            if not os.path.exists(new_file):
+                with open(new_file, 'w') as fp:
+                    fp.write('{}')
+
+        with patch.object(retention, '_remove_files', side_effect=remove_files_and_add_one):
+            assert retention.run() == ['20160915']
+        assert os.path.exists(new_file)
+
+        # The next run removes it
+        assert retention.run() == ['20160915']
+        assert get_days(root) == ['20160916', '20160917', '20160918']
+
+    def test_errors_are_logged(self, tmpdir, metricsmock):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+        retention = build_retention(root, RETENTION_MAX_AGE_DAYS='2')
+
+        with metricsmock as mm:
+            with patch.object(retention, 'remove_day', side_effect=OSError('boom')):
+                assert retention.run() == []
+            assert mm.has_record(stat='fsretention.run_failed.count')
+
+        # The lock was released, so the next run works
+        assert retention.run() == ['20160915']
+
+    def test_never_removes_today(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+
+        retention = build_retention(root, RETENTION_MAX_SIZE='1')
+        retention.run()
+        assert get_days(root) == ['20160918']
+
+    def test_archive_tar(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        archive_dir = str(tmpdir.join('archive'))
+        build_tree(root)
+
+        retention = build_retention(
+            root,
+            RETENTION_MAX_AGE_DAYS='2',
+            RETENTION_ACTION='archive',
+            RETENTION_ARCHIVE_DIR=archive_dir,
+        )
+        assert retention.run() == ['20160915']
+        assert os.listdir(archive_dir) == ['20160915.tar']
+
+        with tarfile.open(os.path.join(archive_dir, '20160915.tar')) as tar:
+            assert sorted(tar.getnames()) == [
+                '20160915/dump_names/' + CRASH_IDS[0] + '.json',
+                '20160915/raw_crash/' + CRASH_IDS[0] + '.json',
+                '20160915/upload_file_minidump/' + CRASH_IDS[0],
+            ]
+
+    def test_archive_segmentlog(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        archive_dir = str(tmpdir.join('archive'))
+        build_tree(root)
+
+        retention = build_retention(
+            root,
+            RETENTION_MAX_AGE_DAYS='2',
+            RETENTION_ACTION='archive',
+            RETENTION_ARCHIVE_DIR=archive_dir,
+            RETENTION_ARCHIVE_FORMAT='segmentlog',
+        )
+        retention.run()
+
+        # A day that comes back after being archived goes in a new archive
+        build_tree(root)
+        retention.run()
+
+        assert sorted(os.listdir(archive_dir)) == [
+            '20160915-1.idx', '20160915-1.log', '20160915.idx', '20160915.log'
+        ]
+        reader = SegmentLogReader(archive_dir)
+        raw_crash, dumps = reader.get_crash(CRASH_IDS[0])
+        assert raw_crash == {'uuid': CRASH_IDS[0]}
+        assert dumps == {'upload_file_minidump': b'x' * 1000}
+
+    def test_archive_segmentlog_partitioned(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        archive_dir = str(tmpdir.join('archive'))
+        build_tree(root, PARTITION_HOURLY='true', PARTITION_FANOUT='2')
+
+        retention = build_retention(
+            root,
+            RETENTION_MAX_AGE_DAYS='2',
+            RETENTION_ACTION='archive',
+            RETENTION_ARCHIVE_DIR=archive_dir,
+            RETENTION_ARCHIVE_FORMAT='segmentlog',
+            PARTITION_HOURLY='true',
+            PARTITION_FANOUT='2',
+        )
+        assert retention.run() == ['20160915']
+
+        reader = SegmentLogReader(archive_dir)
+        assert sorted(reader.index) == [CRASH_IDS[0]]
+        assert reader.get_crash(CRASH_IDS[0])[1] == {'upload_file_minidump': b'x' * 1000}
+
+    def test_archive_requires_dir(self, tmpdir):
+        with pytest.raises(ValueError):
+            build_retention(str(tmpdir), RETENTION_ACTION='archive')
+
+    def test_locked(self, tmpdir):
+        root = str(tmpdir.join('antenna_crashes'))
+        build_tree(root)
+
+        retention = build_retention(root, RETENTION_MAX_AGE_DAYS='1')
+        lock_fp = retention._lock()
+        assert retention.run() == []
+        lock_fp.close()
+        assert retention.run() == ['20160915', '20160916']
+
+
+class TestRateLimiter:
+    def test_limits(self):
+        limiter = RateLimiter(1000)
+        start_time = time.time()
+        for i in range(5):
+            limiter.consume(50)
+        assert time.time() - start_time >= 0.2
+
+    def test_unlimited(self):
+        limiter = RateLimiter(0)
+        start_time = time.time()
+        limiter.consume(1000000)
+        assert time.time() - start_time < 0.1
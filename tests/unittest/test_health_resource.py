@@ -2,6 +2,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from antenna import throttler
+from antenna.throttler import MOZILLA_RULES, get_version
+
 
 class TestHealthChecks:
     def test_no_version(self, client, tmpdir):
@@ -37,14 +40,17 @@ class TestHealthChecks:
         assert resp.status_code == 200
         # NOTE(willkg): This isn't mocked out, so it's entirely likely that
         # this expected result will change over time.
-        assert (
-            resp.json ==
-            {
-                'errors': [],
-                'info': {
-                }
-            }
-        )
+        assert resp.json['errors'] == []
+
+        # Throttle rule set version and rule stats; rules haven't been timed
+        # yet
+        with open(throttler.__file__, 'rb') as fp:
+            version = get_version(fp.read())
+        expected_info = {'Throttler.rule_set.version': version}
+        for rule in MOZILLA_RULES:
+            expected_info['Throttler.rule.%s.evaluations' % rule.rule_name] = 0
+            expected_info['Throttler.rule.%s.matches' % rule.rule_name] = 0
+        assert resp.json['info'] == expected_info
 
     def test_broken(self, client):
         resp = client.simulate_get('/__broken__')
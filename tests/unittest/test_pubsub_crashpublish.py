@@ -159,3 +159,48 @@ class TestPubSubCrashPublishIntegration:
         assert crashids == [
             b'de1bb258-cbbf-4589-a673-34f800160918'
         ]
+
+    def test_crash_publish_routes(self, client, pubsub):
+        PROJECT = 'test_socorro'
+        TOPIC = 'test_socorro_normal'
+        FENNEC_TOPIC = 'test_socorro_fennec'
+
+        pubsub.create_topic(PROJECT, TOPIC)
+        pubsub.create_topic(PROJECT, FENNEC_TOPIC)
+        subscription_path = pubsub.create_subscription(PROJECT, TOPIC, 'test_subscription')
+        fennec_subscription_path = pubsub.create_subscription(
+            PROJECT, FENNEC_TOPIC, 'test_fennec_subscription'
+        )
+
+        data, headers = multipart_encode({
+            'uuid': 'de1bb258-cbbf-4589-a673-34f800160918',
+            'ProductName': 'Fennec',
+            'Version': '1.0',
+            'upload_file_minidump': ('fakecrash.dump', io.BytesIO(b'abcd1234'))
+        })
+
+        client.rebuild_app({
+            'LOCAL_DEV_ENV': 'True',
+            'CRASHPUBLISH_CLASS': 'antenna.ext.pubsub.crashpublish.PubSubCrashPublish',
+            'CRASHPUBLISH_PROJECT_ID': PROJECT,
+            'CRASHPUBLISH_TOPIC_NAME': TOPIC,
+            'CRASHPUBLISH_ROUTES': 'ProductName=Fennec:%s' % FENNEC_TOPIC,
+        })
+
+        # Both topics got the "test" crash id from verification
+        assert pubsub.get_published_crashids(subscription_path) == [b'test']
+        assert pubsub.get_published_crashids(fennec_subscription_path) == [b'test']
+
+        result = client.simulate_post(
+            '/submit',
+            headers=headers,
+            body=data
+        )
+        client.join_app()
+        assert result.status_code == 200
+
+        # Assert crash id was published to the route's topic
+        assert pubsub.get_published_crashids(subscription_path) == []
+        assert pubsub.get_published_crashids(fennec_subscription_path) == [
+            b'de1bb258-cbbf-4589-a673-34f800160918'
+        ]
@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+from everett.manager import ConfigManager
+import pytest
+
+from antenna.rulefile import (
+    RuleFileError,
+    compile_rule_file,
+    is_rule_file,
+    parse_rule_file,
+)
+from antenna.throttler import (
+    ACCEPT,
+    DEFER,
+    REJECT,
+    AdaptiveSample,
+    Equals,
+    OneOf,
+    RateLimit,
+    Throttler,
+    always_match,
+    match_infobar_true,
+)
+
+
+def compile_condition(**condition):
+    rule = dict(name='test', result='ACCEPT', **condition)
+    return compile_rule_file({'rules': [rule]})[0]
+
+
+def matches(rule, crash):
+    return bool(rule.match(None, crash))
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('rules.json', True),
+    ('rules.yaml', True),
+    ('rules.yml', True),
+    ('antenna.throttler.MOZILLA_RULES', False),
+])
+def test_is_rule_file(path, expected):
+    assert is_rule_file(path) == expected
+
+
+class TestOperators:
+    def test_exists(self):
+        rule = compile_condition(key='HangID', op='exists')
+        assert rule.key == 'HangID' and rule.condition is always_match
+        assert matches(rule, {'HangID': ''})
+        assert not matches(rule, {})
+
+    def test_missing(self):
+        rule = compile_condition(key='HangID', op='missing')
+        assert matches(rule, {})
+        assert not matches(rule, {'HangID': ''})
+
+    def test_eq(self):
+        rule = compile_condition(key='ProductName', op='eq', value='Firefox')
+        assert isinstance(rule.condition, Equals)
+        assert matches(rule, {'ProductName': 'Firefox'})
+        assert not matches(rule, {'ProductName': 'Fenix'})
+        assert not matches(rule, {})
+
+    def test_in(self):
+        rule = compile_condition(key='ReleaseChannel', op='in', value=['beta', 'esr'])
+        assert isinstance(rule.condition, OneOf)
+        assert matches(rule, {'ReleaseChannel': 'esr'})
+        assert not matches(rule, {'ReleaseChannel': 'release'})
+
+    def test_prefix(self):
+        rule = compile_condition(key='ReleaseChannel', op='prefix', value=['nightly', 'aurora'])
+        assert matches(rule, {'ReleaseChannel': 'nightly-cck'})
+        assert matches(rule, {'ReleaseChannel': 'aurora'})
+        assert not matches(rule, {'ReleaseChannel': 'release'})
+        assert not matches(rule, {'ReleaseChannel': ['nightly']})
+
+    def test_regex(self):
+        rule = compile_condition(key='Email', op='regex', value='@example\\.com$')
+        assert matches(rule, {'Email': 'foo@example.com'})
+        assert not matches(rule, {'Email': 'foo@example.com.au'})
+
+    @pytest.mark.parametrize('version, expected', [
+        ('51.0', False),
+        ('52.0', True),
+        ('52', True),
+        ('52.0.1', True),
+        ('59.0b3', True),
+        ('60.0a1', False),
+        ('foo', False),
+    ])
+    def test_version(self, version, expected):
+        rule = compile_condition(key='Version', op='version', min='52.0', max='60')
+        assert matches(rule, {'Version': version}) == expected
+
+    def test_function(self):
+        rule = compile_condition(op='function', value='antenna.throttler.match_infobar_true')
+        assert rule.key == '*'
+        assert rule.condition is match_infobar_true
+
+    def test_all_any_not(self):
+        rule = compile_condition(all=[
+            {'key': 'HangID', 'op': 'exists'},
+            {'any': [
+                {'key': 'ProcessType', 'op': 'missing'},
+                {'key': 'ProcessType', 'op': 'eq', 'value': 'browser'},
+            ]},
+            {'not': {'key': 'ProductName', 'op': 'eq', 'value': 'Fenix'}},
+        ])
+        assert matches(rule, {'HangID': 'a'})
+        assert matches(rule, {'HangID': 'a', 'ProcessType': 'browser'})
+        assert not matches(rule, {'HangID': 'a', 'ProcessType': 'content'})
+        assert not matches(rule, {'HangID': 'a', 'ProductName': 'Fenix'})
+        assert not matches(rule, {'ProcessType': 'browser'})
+
+
+class TestResults:
+    @pytest.mark.parametrize('result, expected', [
+        ('ACCEPT', ACCEPT),
+        ('DEFER', DEFER),
+        ([10, 'ACCEPT', 'REJECT'], (10, ACCEPT, REJECT)),
+    ])
+    def test_result(self, result, expected):
+        rules = compile_rule_file({'rules': [
+            {'name': 'test', 'key': 'HangID', 'op': 'exists', 'result': result}
+        ]})
+        assert rules[0].result == expected
+
+    def test_rate_limit(self):
+        rules = compile_rule_file({'rules': [
+            {
+                'name': 'test',
+                'key': 'HangID',
+                'op': 'exists',
+                'result': {
+                    'rate_limit': {'rate': 10, 'keys': ['BuildID'], 'overflow': 'DEFER'}
+                }
+            }
+        ]})
+        rate_limit = rules[0].result
+        assert isinstance(rate_limit, RateLimit)
+        assert (rate_limit.rate, rate_limit.burst, rate_limit.keys) == (10, 10, ('BuildID',))
+        assert (rate_limit.result, rate_limit.overflow) == (ACCEPT, DEFER)
+
+    def test_adaptive_sample(self):
+        rules = compile_rule_file({'rules': [
+            {
+                'name': 'test',
+                'key': 'HangID',
+                'op': 'exists',
+                'result': {
+                    'adaptive_sample': {'target_rate': 5, 'floor': 2, 'unsampled': 'DEFER'}
+                }
+            }
+        ]})
+        adaptive_sample = rules[0].result
+        assert isinstance(adaptive_sample, AdaptiveSample)
+        assert (adaptive_sample.target_rate, adaptive_sample.floor, adaptive_sample.ceiling) == (5, 2, 100)
+        assert (adaptive_sample.result, adaptive_sample.unsampled) == (ACCEPT, DEFER)
+
+
+@pytest.mark.parametrize('spec', [
+    [],
+    {'rules': {}},
+    {'rules': ['foo']},
+    # Missing name and result
+    {'rules': [{'key': 'HangID', 'op': 'exists', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'exists'}]},
+    # Bad names and results
+    {'rules': [{'name': 'o m g', 'key': 'HangID', 'op': 'exists', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'exists', 'result': 'accept'}]},
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'exists', 'result': [200, 'ACCEPT', 'REJECT']}]},
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'exists', 'result': [10, 'ACCEPT']}]},
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'exists', 'result': {'rate_limit': {}}}]},
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'exists', 'result': {'adaptive_sample': {}}}]},
+    {'rules': [{
+        'name': 'test', 'key': 'HangID', 'op': 'exists',
+        'result': {'rate_limit': {'rate': 1, 'keys': ['BuildID'], 'overflow': 'ACCEPT'}}
+    }]},
+    # Bad conditions
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'foo', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'op': 'exists', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'HangID', 'op': 'exists', 'value': 1, 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'A', 'op': 'in', 'value': 'b', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'A', 'op': 'eq', 'value': [1], 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'A', 'op': 'regex', 'value': '(', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'A', 'op': 'version', 'min': 'abc', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'key': 'A', 'op': 'version', 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'all': [], 'result': 'ACCEPT'}]},
+    {'rules': [{'name': 'test', 'op': 'function', 'value': 'antenna.foo', 'result': 'ACCEPT'}]},
+])
+def test_invalid(spec):
+    with pytest.raises(RuleFileError):
+        compile_rule_file(spec)
+
+
+def test_parse_json_and_yaml():
+    json_data = json.dumps({'rules': [
+        {'name': 'is_beta', 'key': 'ReleaseChannel', 'op': 'eq', 'value': 'beta', 'result': 'DEFER'}
+    ]}).encode('utf-8')
+    yaml_data = (
+        b'rules:\n'
+        b'  - name: is_beta\n'
+        b'    key: ReleaseChannel\n'
+        b'    op: eq\n'
+        b'    value: beta\n'
+        b'    result: DEFER\n'
+    )
+    for data, path in [(json_data, 'rules.json'), (yaml_data, 'rules.yaml')]:
+        rules = parse_rule_file(data, path)
+        assert [(rule.rule_name, rule.key, rule.result) for rule in rules] == [
+            ('is_beta', 'ReleaseChannel', DEFER)
+        ]
+
+    with pytest.raises(RuleFileError):
+        parse_rule_file(b'{', 'rules.json')
+
+
+def test_throttler_rule_file(tmpdir):
+    path = tmpdir.join('rules.json')
+    path.write(json.dumps({'rules': [
+        {'name': 'is_beta', 'key': 'ReleaseChannel', 'op': 'eq', 'value': 'beta', 'result': 'DEFER'},
+        {'name': 'accept_everything', 'key': 'ProductName', 'op': 'exists', 'result': 'ACCEPT'},
+    ]}))
+
+    throttler = Throttler(ConfigManager.from_dict({
+        'THROTTLE_RULES': str(path),
+        'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS',
+    }))
+    assert throttler.rule_set_version != 0
+    assert throttler.throttle({'ProductName': 'Firefox', 'ReleaseChannel': 'beta'}) == (
+        DEFER, 'is_beta', 100
+    )
+    assert throttler.throttle({'ProductName': 'Firefox'}) == (ACCEPT, 'accept_everything', 100)
+    assert throttler.throttle({}) == (REJECT, 'NO_MATCH', 0)
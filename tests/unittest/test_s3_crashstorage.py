@@ -2,12 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
 import io
+import socket
 from unittest.mock import patch
 
 import botocore
+from everett.manager import ConfigManager
+import gevent
 import pytest
 
+from antenna.breakpad_resource import BreakpadSubmitterResource, CrashReport
+from antenna.ext.s3.connection import (
+    HedgeBudget,
+    LatencyTracker,
+    S3Connection,
+    parse_bucket_names,
+)
+from antenna.ext.s3.crashstorage import S3CrashStorage
+from antenna.ext.s3.keylayout import decode_dump_pointer
 from testlib.mini_poster import multipart_encode
 
 
@@ -250,5 +263,399 @@ class TestS3CrashStorageIntegration:
         # Assert we did the entire s3 conversation
         assert s3mock.remaining_conversation() == []
 
+    def test_multiple_buckets(self, client, s3mock, mock_generate_test_filepath, metricsmock):
+        ROOT = 'http://fakes3:4569/'
+
+        # .verify_write_to_bucket() writes to every bucket
+        for bucket in ['fakebucket1', 'fakebucket2', 'fakebucket3']:
+            s3mock.add_step(
+                method='PUT',
+                url=ROOT + bucket + '/test/testwrite.txt',
+                body=b'test',
+                resp=s3mock.fake_response(status_code=200)
+            )
+
+        # All the files for the crash go to the bucket for this crash id
+        s3mock.add_step(
+            method='PUT',
+            url=ROOT + 'fakebucket2/v1/dump_names/de1bb258-cbbf-4589-a673-34f800160910',
+            body=b'["upload_file_minidump"]',
+            resp=s3mock.fake_response(status_code=200)
+        )
+        s3mock.add_step(
+            method='PUT',
+            url=ROOT + 'fakebucket2/v1/dump/de1bb258-cbbf-4589-a673-34f800160910',
+            body=b'abcd1234',
+            resp=s3mock.fake_response(status_code=200)
+        )
+        s3mock.add_step(
+            method='PUT',
+            url=ROOT + 'fakebucket2/v2/raw_crash/de1/20160910/de1bb258-cbbf-4589-a673-34f800160910',
+            resp=s3mock.fake_response(status_code=200)
+        )
+        data, headers = multipart_encode({
+            'uuid': 'de1bb258-cbbf-4589-a673-34f800160910',
+            'ProductName': 'Fennec',
+            'Version': '1.0',
+            'upload_file_minidump': ('fakecrash.dump', io.BytesIO(b'abcd1234'))
+        })
+
+        client.rebuild_app({
+            'CRASHSTORAGE_CLASS': 'antenna.ext.s3.crashstorage.S3CrashStorage',
+            'CRASHSTORAGE_ENDPOINT_URL': 'http://fakes3:4569',
+            'CRASHSTORAGE_ACCESS_KEY': 'fakekey',
+            'CRASHSTORAGE_SECRET_ACCESS_KEY': 'fakesecretkey',
+            'CRASHSTORAGE_BUCKET_NAME': 'fakebucket1, fakebucket2, fakebucket3',
+        })
+
+        with metricsmock as mm:
+            result = client.simulate_post(
+                '/submit',
+                headers=headers,
+                body=data
+            )
+            client.join_app()
+
+            assert mm.has_record(
+                stat='s3crashstorage.save_crash.time',
+                tags=['bucket:fakebucket2']
+            )
+
+        assert result.status_code == 200
+
+        # Assert we did the entire s3 conversation
+        assert s3mock.remaining_conversation() == []
+
+    def test_warm_up(self, client, s3mock, mock_generate_test_filepath):
+        s3mock.add_step(
+            method='PUT',
+            url='http://fakes3:4569/fakebucket/test/testwrite.txt',
+            body=b'test',
+            resp=s3mock.fake_response(status_code=200)
+        )
+        # Warming up connections HEADs the bucket once per connection
+        for i in range(2):
+            s3mock.add_step(
+                method='HEAD',
+                url='http://fakes3:4569/fakebucket',
+                resp=s3mock.fake_response(status_code=200)
+            )
+
+        client.rebuild_app({
+            'CONCURRENT_CRASHMOVERS': '2',
+            'CRASHSTORAGE_CLASS': 'antenna.ext.s3.crashstorage.S3CrashStorage',
+            'CRASHSTORAGE_ENDPOINT_URL': 'http://fakes3:4569',
+            'CRASHSTORAGE_ACCESS_KEY': 'fakekey',
+            'CRASHSTORAGE_SECRET_ACCESS_KEY': 'fakesecretkey',
+            'CRASHSTORAGE_BUCKET_NAME': 'fakebucket',
+        })
+
+        # Assert we did the entire s3 conversation
+        assert s3mock.remaining_conversation() == []
+
+    def test_warm_up_multiple_buckets(self, client, s3mock, mock_generate_test_filepath):
+        for bucket in ['fakebucket1', 'fakebucket2']:
+            s3mock.add_step(
+                method='PUT',
+                url='http://fakes3:4569/%s/test/testwrite.txt' % bucket,
+                body=b'test',
+                resp=s3mock.fake_response(status_code=200)
+            )
+        # Connections are spread across the buckets
+        for bucket in ['fakebucket1', 'fakebucket2', 'fakebucket1', 'fakebucket2']:
+            s3mock.add_step(
+                method='HEAD',
+                url='http://fakes3:4569/%s' % bucket,
+                resp=s3mock.fake_response(status_code=200)
+            )
+
+        client.rebuild_app({
+            'CONCURRENT_CRASHMOVERS': '4',
+            'CRASHSTORAGE_CLASS': 'antenna.ext.s3.crashstorage.S3CrashStorage',
+            'CRASHSTORAGE_ENDPOINT_URL': 'http://fakes3:4569',
+            'CRASHSTORAGE_ACCESS_KEY': 'fakekey',
+            'CRASHSTORAGE_SECRET_ACCESS_KEY': 'fakesecretkey',
+            'CRASHSTORAGE_BUCKET_NAME': 'fakebucket1, fakebucket2',
+        })
+
+        # Assert we did the entire s3 conversation
+        assert s3mock.remaining_conversation() == []
+
+    def test_warm_up_default(self, client, s3mock, mock_generate_test_filepath):
+        s3mock.add_step(
+            method='PUT',
+            url='http://fakes3:4569/fakebucket/test/testwrite.txt',
+            body=b'test',
+            resp=s3mock.fake_response(status_code=200)
+        )
+        # Without CONCURRENT_CRASHMOVERS, this warms up as many connections as
+        # the default number of crashmovers
+        num_crashmovers = int(
+            BreakpadSubmitterResource.required_config.options['concurrent_crashmovers'].default
+        )
+        for i in range(num_crashmovers):
+            s3mock.add_step(
+                method='HEAD',
+                url='http://fakes3:4569/fakebucket',
+                resp=s3mock.fake_response(status_code=200)
+            )
+
+        client.rebuild_app({
+            'CRASHSTORAGE_CLASS': 'antenna.ext.s3.crashstorage.S3CrashStorage',
+            'CRASHSTORAGE_ENDPOINT_URL': 'http://fakes3:4569',
+            'CRASHSTORAGE_ACCESS_KEY': 'fakekey',
+            'CRASHSTORAGE_SECRET_ACCESS_KEY': 'fakesecretkey',
+            'CRASHSTORAGE_BUCKET_NAME': 'fakebucket',
+        })
+
+        # Assert we did the entire s3 conversation
+        assert s3mock.remaining_conversation() == []
+
     # FIXME(willkg): Add test for bad region
     # FIXME(willkg): Add test for invalid credentials
+
+
+class FakeClient:
+    """Fake boto3 client that sleeps for the next duration when uploading."""
+    def __init__(self, durations):
+        self.durations = list(durations)
+        self.uploads = []
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        duration = self.durations.pop(0)
+        gevent.sleep(duration)
+        self.uploads.append((Bucket, Key, Fileobj.read()))
+
+
+class Test_parse_bucket_names:
+    def test_parse(self):
+        assert parse_bucket_names('fakebucket') == ['fakebucket']
+        assert parse_bucket_names('fakebucket1, fakebucket2,') == ['fakebucket1', 'fakebucket2']
+
+    def test_empty(self):
+        with pytest.raises(ValueError):
+            parse_bucket_names(' , ')
+
+
+class TestLatencyTracker:
+    def test_percentile(self):
+        tracker = LatencyTracker(size=100)
+        assert tracker.percentile(95) is None
+
+        for i in range(1, 101):
+            tracker.add(i)
+        assert tracker.percentile(50) == 51
+        assert tracker.percentile(95) == 96
+        assert tracker.percentile(100) == 100
+
+    def test_window(self):
+        tracker = LatencyTracker(size=10)
+        for i in range(100):
+            tracker.add(i)
+        assert len(tracker) == 10
+        assert tracker.percentile(0) == 90
+
+    def test_matches_sorting(self):
+        tracker = LatencyTracker(size=50)
+        samples = [(i * 37) % 101 / 10.0 for i in range(500)]
+        for i, value in enumerate(samples):
+            tracker.add(value)
+            window = sorted(samples[max(0, i - 49):i + 1])
+            assert tracker.ordered == window
+            assert tracker.percentile(95) == window[min(len(window) - 1, int(len(window) * 0.95))]
+
+
+class TestHedgeBudget:
+    def test_budget(self):
+        budget = HedgeBudget(percent=10, size=100)
+        assert budget.allows() is False
+
+        for i in range(9):
+            budget.record(False)
+        assert budget.allows() is False
+        budget.record(False)
+        assert budget.allows() is True
+        budget.record(True)
+        assert budget.allows() is False
+
+    def test_budget_window(self):
+        budget = HedgeBudget(percent=10, size=10)
+        budget.record(True)
+        for i in range(9):
+            budget.record(False)
+        assert budget.allows() is False
+
+        # The hedge falls out of the window, so we can hedge again
+        budget.record(False)
+        assert budget.allows() is True
+
+
+def build_conn(**extra):
+    config = {
+        'ENDPOINT_URL': 'http://fakes3:4569',
+        'ACCESS_KEY': 'fakekey',
+        'SECRET_ACCESS_KEY': 'fakesecretkey',
+        'BUCKET_NAME': 'fakebucket',
+    }
+    config.update(extra)
+    return S3Connection(ConfigManager.from_dict(config))
+
+
+class TestS3ConnectionPool:
+    def test_tcp_keepalive(self):
+        conn = build_conn(TCP_KEEPALIVE='true')
+        for adapter in conn.client._endpoint.http_session.adapters.values():
+            socket_options = adapter.poolmanager.connection_pool_kw['socket_options']
+            assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in socket_options
+
+    def test_pool_exhausted(self, metricsmock):
+        conn = build_conn(MAX_POOL_CONNECTIONS='1')
+        conn.client = FakeClient([0.1, 0.1])
+        with metricsmock as mm:
+            gevent.joinall([
+                gevent.spawn(conn.save_file, 'foo', b'bar'),
+                gevent.spawn(conn.save_file, 'foo2', b'bar'),
+            ])
+            assert len(mm.filter_records(stat='s3connection.pool_exhausted.count')) == 1
+        assert conn.in_flight == 0
+
+
+class TestS3ConnectionHedging:
+    def build_conn(self, **extra):
+        config = {
+            'HEDGE_ENABLED': 'true',
+            'HEDGE_BUDGET': '100',
+        }
+        config.update(extra)
+        return build_conn(**config)
+
+    def test_no_hedge_without_samples(self, metricsmock):
+        conn = self.build_conn()
+        conn.client = FakeClient([0.01])
+        with metricsmock as mm:
+            conn.save_file('foo', b'bar')
+            assert not mm.has_record(stat='s3connection.hedged_put.count')
+        assert conn.client.uploads == [('fakebucket', 'foo', b'bar')]
+
+    def test_hedge_slow_put(self, metricsmock):
+        conn = self.build_conn()
+        for i in range(conn.hedge_min_samples):
+            conn.put_latency.add(0.01)
+            conn.hedge_budget.record(False)
+
+        # First PUT is slow, so it gets hedged and the hedge wins
+        conn.client = FakeClient([1.0, 0.0])
+        with metricsmock as mm:
+            conn.save_file('foo', b'bar')
+            assert mm.has_record(stat='s3connection.hedged_put.count')
+            assert mm.has_record(
+                stat='s3connection.hedged_put.winner',
+                tags=['winner:hedge']
+            )
+        assert conn.client.uploads == [('fakebucket', 'foo', b'bar')]
+
+    def test_hedge_records_winner_latency(self):
+        conn = self.build_conn()
+        for i in range(conn.hedge_min_samples):
+            conn.put_latency.add(0.01)
+            conn.hedge_budget.record(False)
+
+        # The primary loses, but still finishes in the background; only the
+        # hedge's latency should be recorded
+        conn.client = FakeClient([0.5, 0.0])
+        conn.save_file('foo', b'bar')
+        gevent.sleep(0.6)
+        assert len(conn.client.uploads) == 2
+        assert len(conn.put_latency) == conn.hedge_min_samples + 1
+        assert max(conn.put_latency.samples) < 0.5
+
+    def test_hedge_over_budget(self, metricsmock):
+        conn = self.build_conn(HEDGE_BUDGET='0')
+        for i in range(conn.hedge_min_samples):
+            conn.put_latency.add(0.01)
+            conn.hedge_budget.record(False)
+
+        conn.client = FakeClient([0.1])
+        with metricsmock as mm:
+            conn.save_file('foo', b'bar')
+            assert not mm.has_record(stat='s3connection.hedged_put.count')
+        assert conn.client.uploads == [('fakebucket', 'foo', b'bar')]
+
+
+class TestS3CrashStorageDedupe:
+    def build_storage(self, **extra):
+        config = {
+            'ENDPOINT_URL': 'http://fakes3:4569',
+            'ACCESS_KEY': 'fakekey',
+            'SECRET_ACCESS_KEY': 'fakesecretkey',
+            'BUCKET_NAME': 'fakebucket',
+        }
+        config.update(extra)
+        storage = S3CrashStorage(ConfigManager.from_dict(config))
+        storage.conn.client = FakeClient([0] * 100)
+        return storage
+
+    def build_crash_report(self, crash_id):
+        return CrashReport(
+            raw_crash={'ProductName': 'Firefox'},
+            dumps={'upload_file_minidump': b'abcd1234'},
+            crash_id=crash_id
+        )
+
+    def test_disabled(self):
+        storage = self.build_storage()
+        storage.save_crash(self.build_crash_report('de1bb258-cbbf-4589-a673-34f800160918'))
+        assert ('fakebucket', 'v1/dump/de1bb258-cbbf-4589-a673-34f800160918', b'abcd1234') in (
+            storage.conn.client.uploads
+        )
+
+    def test_dedupe(self, metricsmock):
+        storage = self.build_storage(DEDUPE_DUMPS='true')
+        sha256 = hashlib.sha256(b'abcd1234').hexdigest()
+        hash_key = 'v1/dump_by_hash/%s/%s' % (sha256[:3], sha256)
+
+        with metricsmock as mm:
+            storage.save_crash(self.build_crash_report('de1bb258-cbbf-4589-a673-34f800160918'))
+            storage.save_crash(self.build_crash_report('de1bb258-cbbf-4589-a673-34f800160919'))
+            assert mm.has_record(stat='s3crashstorage.dedupe.bytes_saved', value=8)
+
+        uploads = storage.conn.client.uploads
+        # The dump is uploaded once and both crashes point to it
+        assert [key for bucket, key, data in uploads if data == b'abcd1234'] == [hash_key]
+        pointers = dict(
+            (key, decode_dump_pointer(data)) for bucket, key, data in uploads
+            if key.startswith('v1/dump/')
+        )
+        assert pointers == {
+            'v1/dump/de1bb258-cbbf-4589-a673-34f800160918': {'key': hash_key, 'sha256': sha256, 'size': 8},
+            'v1/dump/de1bb258-cbbf-4589-a673-34f800160919': {'key': hash_key, 'sha256': sha256, 'size': 8},
+        }
+
+    def test_dedupe_cache_keeps_recently_used(self):
+        storage = self.build_storage(DEDUPE_DUMPS='true', DEDUPE_CACHE_SIZE='2')
+
+        def save_dump(crash_id, dump):
+            storage.save_dump(crash_id, 'upload_file_minidump', dump, 'fakebucket', storage.conn)
+
+        def num_uploads(dump):
+            return len([key for bucket, key, data in storage.conn.client.uploads if data == dump])
+
+        save_dump('de1bb258-cbbf-4589-a673-34f800160911', b'dump1')
+        save_dump('de1bb258-cbbf-4589-a673-34f800160912', b'dump2')
+        # Using dump1 again makes dump2 the least recently used, so saving dump3
+        # evicts dump2
+        save_dump('de1bb258-cbbf-4589-a673-34f800160913', b'dump1')
+        save_dump('de1bb258-cbbf-4589-a673-34f800160914', b'dump3')
+        save_dump('de1bb258-cbbf-4589-a673-34f800160915', b'dump1')
+        save_dump('de1bb258-cbbf-4589-a673-34f800160916', b'dump2')
+
+        assert num_uploads(b'dump1') == 1
+        assert num_uploads(b'dump2') == 2
+        assert num_uploads(b'dump3') == 1
+
+    def test_uses_dump_checksums(self):
+        storage = self.build_storage(DEDUPE_DUMPS='true')
+        crash_report = self.build_crash_report('de1bb258-cbbf-4589-a673-34f800160918')
+        crash_report.raw_crash['dump_checksums'] = {'upload_file_minidump': 'abcdef'}
+        storage.save_crash(crash_report)
+        assert 'v1/dump_by_hash/abc/abcdef' in [key for bucket, key, data in storage.conn.client.uploads]
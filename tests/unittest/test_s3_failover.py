@@ -0,0 +1,190 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from unittest.mock import patch
+
+from botocore.client import ClientError
+from everett.manager import ConfigManager
+import gevent
+import pytest
+
+from antenna.ext.s3.failover import (
+    FailoverS3CrashStorage,
+    find_crash_endpoint,
+    parse_endpoint_names,
+)
+from antenna.health_resource import HealthState
+
+
+CRASH_ID = 'de1bb258-cbbf-4589-a673-34f800160918'
+
+
+class FakeConnection:
+    def __init__(self, bucket):
+        self.buckets = [bucket]
+        self.broken = False
+        self.delay = 0
+        self.files = {}
+
+    def save_file_once(self, path, data, bucket=None):
+        gevent.sleep(self.delay)
+        if self.broken:
+            raise ClientError({'Error': {'Code': '500'}}, 'PutObject')
+        self.files[(bucket, path)] = data
+
+    def load_file(self, path, bucket=None):
+        if (bucket, path) not in self.files:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return self.files[(bucket, path)]
+
+    def check_health(self, state):
+        if self.broken:
+            state.add_error('S3Connection', 'broken')
+
+
+def build_storage(**extra):
+    config = {
+        'ENDPOINTS': 'primary,secondary',
+        'PRIMARY_ENDPOINT_URL': 'http://fakes3a:4569',
+        'PRIMARY_BUCKET_NAME': 'primarybucket',
+        'SECONDARY_ENDPOINT_URL': 'http://fakes3b:4569',
+        'SECONDARY_BUCKET_NAME': 'secondarybucket',
+    }
+    config.update(extra)
+    storage = FailoverS3CrashStorage(ConfigManager.from_dict(config))
+    for endpoint in storage.endpoints:
+        endpoint.conn = FakeConnection(endpoint.conn.bucket)
+    return storage
+
+
+def saved_keys(endpoint):
+    return sorted(path for bucket, path in endpoint.conn.files)
+
+
+class Test_parse_endpoint_names:
+    def test_parse(self):
+        assert parse_endpoint_names('primary, secondary') == ['primary', 'secondary']
+
+    @pytest.mark.parametrize('val', ['', 'a,a', 'us-west'])
+    def test_invalid(self, val):
+        with pytest.raises(ValueError):
+            parse_endpoint_names(val)
+
+
+class TestFailoverS3CrashStorage:
+    def test_saves_to_primary(self, crash_report):
+        storage = build_storage()
+        report = crash_report()
+        storage.save_crash(report)
+
+        primary, secondary = storage.endpoints
+        assert saved_keys(primary) == [
+            'v1/dump/' + CRASH_ID,
+            'v1/dump_names/' + CRASH_ID,
+            'v2/raw_crash/de1/20160918/' + CRASH_ID,
+        ]
+        assert saved_keys(secondary) == []
+        assert report.raw_crash['storage_endpoint'] == 'primary'
+
+    def test_failover_and_failback(self, metricsmock, crash_report):
+        storage = build_storage(COOLDOWN='60')
+        primary, secondary = storage.endpoints
+        primary.conn.broken = True
+
+        with patch('antenna.ext.s3.failover.time.time') as mock_time:
+            mock_time.return_value = 1000
+
+            with metricsmock as mm:
+                report = crash_report()
+                storage.save_crash(report)
+                assert mm.has_record(stat='s3failover.failover.count', tags=['endpoint:secondary'])
+
+            # Whole crash went to secondary
+            assert len(saved_keys(secondary)) == 3
+            assert report.raw_crash['storage_endpoint'] == 'secondary'
+            assert storage.get_endpoints() == [secondary, primary]
+
+            # Primary recovers, but is skipped until the cooldown is over
+            primary.conn.broken = False
+            storage.save_crash(crash_report())
+            assert saved_keys(primary) == []
+
+            # After the cooldown, saves fail back to primary
+            mock_time.return_value = 1061
+            report = crash_report()
+            storage.save_crash(report)
+            assert len(saved_keys(primary)) == 3
+            assert report.raw_crash['storage_endpoint'] == 'primary'
+
+    def test_latency_threshold(self):
+        storage = build_storage(LATENCY_THRESHOLD='1')
+        primary, secondary = storage.endpoints
+
+        storage.record_success(primary, 0.5)
+        assert storage.get_endpoints() == [primary, secondary]
+
+        storage.record_success(primary, 10)
+        assert storage.get_endpoints() == [secondary, primary]
+
+    def test_all_endpoints_fail(self, crash_report):
+        storage = build_storage()
+        for endpoint in storage.endpoints:
+            endpoint.conn.broken = True
+
+        with pytest.raises(ClientError):
+            storage.save_crash(crash_report())
+
+    def test_doesnt_retry(self, crash_report):
+        storage = build_storage()
+        primary, secondary = storage.endpoints
+
+        # Use a real connection for primary with a client that always fails
+        primary.conn = storage.config('connection_class')(
+            ConfigManager.from_dict({'BUCKET_NAME': 'primarybucket'})
+        )
+        with patch.object(primary.conn, 'client') as mock_client:
+            mock_client.upload_fileobj.side_effect = ClientError({'Error': {'Code': '500'}}, 'PutObject')
+            storage.save_crash(crash_report())
+
+        # The first failed save fails over without waiting out the retries
+        assert mock_client.upload_fileobj.call_count == 1
+        assert len(saved_keys(secondary)) == 3
+
+    def test_endpoint_timeout(self, crash_report):
+        storage = build_storage(ENDPOINT_TIMEOUT='0.05')
+        primary, secondary = storage.endpoints
+        primary.conn.delay = 1
+
+        report = crash_report()
+        storage.save_crash(report)
+        assert len(saved_keys(secondary)) == 3
+        assert report.raw_crash['storage_endpoint'] == 'secondary'
+        assert primary.failures == 1
+
+    def test_check_health(self):
+        storage = build_storage()
+        primary, secondary = storage.endpoints
+
+        # One broken endpoint is fine
+        primary.conn.broken = True
+        state = HealthState()
+        storage.check_health(state)
+        assert state.is_healthy()
+        assert state.statsd['FailoverS3CrashStorage.endpoint.primary.healthy'] == 0
+        assert state.statsd['FailoverS3CrashStorage.endpoint.secondary.healthy'] == 1
+
+        # All broken endpoints is not
+        secondary.conn.broken = True
+        state = HealthState()
+        storage.check_health(state)
+        assert not state.is_healthy()
+
+    def test_find_crash_endpoint(self, crash_report):
+        storage = build_storage()
+        primary, secondary = storage.endpoints
+        primary.conn.broken = True
+        storage.save_crash(crash_report())
+
+        assert find_crash_endpoint(storage, CRASH_ID) == 'secondary'
+        assert find_crash_endpoint(storage, 'de1bb258-cbbf-4589-a673-34f800160919') is None
@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from botocore.client import ClientError
+from everett.manager import ConfigManager
+import pytest
+
+from antenna.ext.s3.keylayout import (
+    DUMP,
+    DUMP_HASH,
+    DUMP_NAMES,
+    RAW_CRASH,
+    S3KeyLayout,
+    encode_dump_pointer,
+    get_bucket_for_crash_id,
+    read_crash_file,
+)
+
+
+CRASH_ID = 'de1bb258-cbbf-4589-a673-34f800160918'
+
+
+def build_layout(**config):
+    return S3KeyLayout(ConfigManager.from_dict(config))
+
+
+class FakeConnection:
+    def __init__(self, files, buckets=None):
+        self.files = files
+        self.buckets = buckets or ['fakebucket']
+        self.loaded = []
+
+    def load_file(self, path, bucket=None):
+        self.loaded.append((bucket, path))
+        if (bucket, path) not in self.files:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return self.files[(bucket, path)]
+
+
+class TestS3KeyLayout:
+    def test_default_layout(self):
+        layout = build_layout()
+        assert layout.get_raw_crash_path(CRASH_ID) == 'v2/raw_crash/de1/20160918/' + CRASH_ID
+        assert layout.get_dump_names_path(CRASH_ID) == 'v1/dump_names/' + CRASH_ID
+        assert layout.get_dump_name_path(CRASH_ID, 'upload_file_minidump') == 'v1/dump/' + CRASH_ID
+        assert (
+            layout.get_dump_name_path(CRASH_ID, 'memory_report') ==
+            'v1/memory_report/' + CRASH_ID
+        )
+
+    def test_custom_templates(self):
+        layout = build_layout(
+            DUMP_KEY_TEMPLATE='{entropy}/v1/{dump_name}/{date}/{crash_id}',
+            ENTROPY_LENGTH='4',
+        )
+        assert (
+            layout.get_dump_name_path(CRASH_ID, 'upload_file_minidump') ==
+            'de1b/v1/dump/20160918/' + CRASH_ID
+        )
+
+    def test_sha256_entropy(self):
+        layout = build_layout(
+            DUMP_NAMES_KEY_TEMPLATE='{entropy}/v1/dump_names/{crash_id}',
+            ENTROPY_SCHEME='sha256',
+            ENTROPY_LENGTH='2',
+        )
+        assert layout.get_dump_names_path(CRASH_ID) == '98/v1/dump_names/' + CRASH_ID
+
+    def test_dump_hash(self):
+        sha256 = 'abcdef0123'
+        layout = build_layout()
+        assert layout.get_dump_hash_path(sha256) == 'v1/dump_by_hash/abc/abcdef0123'
+
+        # Entropy comes from the sha256 regardless of the entropy scheme
+        layout = build_layout(
+            DUMP_HASH_KEY_TEMPLATE='{entropy}/v1/dump_by_hash/{sha256}',
+            ENTROPY_SCHEME='sha256',
+            ENTROPY_LENGTH='4',
+        )
+        assert layout.get_dump_hash_path(sha256) == 'abcd/v1/dump_by_hash/abcdef0123'
+        assert layout.get_read_paths(DUMP_HASH, sha256) == [
+            'abcd/v1/dump_by_hash/abcdef0123', 'v1/dump_by_hash/abc/abcdef0123'
+        ]
+
+    @pytest.mark.parametrize('template', [
+        'v1/dump_by_hash/{entropy}',
+        'v1/dump_by_hash/{crash_id}/{sha256}',
+    ])
+    def test_invalid_dump_hash_template(self, template):
+        with pytest.raises(ValueError):
+            build_layout(DUMP_HASH_KEY_TEMPLATE=template)
+
+    @pytest.mark.parametrize('template', [
+        'v1/dump_names/{entropy}',
+        'v1/dump_names/{crash_id}/{foo}',
+        'v1/dump_names/{crash_id',
+    ])
+    def test_invalid_template(self, template):
+        with pytest.raises(ValueError):
+            build_layout(DUMP_NAMES_KEY_TEMPLATE=template)
+
+    def test_read_paths(self):
+        layout = build_layout()
+        assert layout.get_read_paths(DUMP_NAMES, CRASH_ID) == ['v1/dump_names/' + CRASH_ID]
+
+        layout = build_layout(DUMP_NAMES_KEY_TEMPLATE='{entropy}/v1/dump_names/{crash_id}')
+        assert (
+            layout.get_read_paths(DUMP_NAMES, CRASH_ID) ==
+            ['de1/v1/dump_names/' + CRASH_ID, 'v1/dump_names/' + CRASH_ID]
+        )
+
+
+class Test_get_bucket_for_crash_id:
+    def test_one_bucket(self):
+        assert get_bucket_for_crash_id(CRASH_ID, ['fakebucket']) == 'fakebucket'
+
+    def test_multiple_buckets(self):
+        buckets = ['fakebucket1', 'fakebucket2', 'fakebucket3']
+        crash_ids = ['de1bb258-cbbf-4589-a673-34f80016091%d' % i for i in range(10)]
+        picked = [get_bucket_for_crash_id(crash_id, buckets) for crash_id in crash_ids]
+
+        # Same crash id always gets the same bucket
+        assert picked == [get_bucket_for_crash_id(crash_id, buckets) for crash_id in crash_ids]
+        assert set(picked) == set(buckets)
+
+
+class Test_read_crash_file:
+    def test_new_layout(self):
+        layout = build_layout(DUMP_KEY_TEMPLATE='{entropy}/v1/{dump_name}/{crash_id}')
+        conn = FakeConnection({('fakebucket', 'de1/v1/dump/' + CRASH_ID): b'abcd'})
+        assert read_crash_file(conn, layout, DUMP, CRASH_ID, 'upload_file_minidump') == b'abcd'
+        assert conn.loaded == [('fakebucket', 'de1/v1/dump/' + CRASH_ID)]
+
+    def test_falls_back_to_default_layout(self):
+        layout = build_layout(RAW_CRASH_KEY_TEMPLATE='{entropy}/v2/raw_crash/{date}/{crash_id}')
+        conn = FakeConnection({('fakebucket', 'v2/raw_crash/de1/20160918/' + CRASH_ID): b'{}'})
+        assert read_crash_file(conn, layout, RAW_CRASH, CRASH_ID) == b'{}'
+
+    def test_multiple_buckets(self):
+        crash_id = 'de1bb258-cbbf-4589-a673-34f800160910'
+        conn = FakeConnection(
+            {('fakebucket2', 'v1/dump_names/' + crash_id): b'[]'},
+            buckets=['fakebucket1', 'fakebucket2', 'fakebucket3']
+        )
+        assert read_crash_file(conn, build_layout(), DUMP_NAMES, crash_id) == b'[]'
+
+    def test_follows_dump_pointer(self):
+        conn = FakeConnection({
+            ('fakebucket', 'v1/dump/' + CRASH_ID): encode_dump_pointer('v1/dump_by_hash/abcd', 'abcd', 4),
+            ('fakebucket', 'v1/dump_by_hash/abcd'): b'abcd',
+        })
+        assert read_crash_file(conn, build_layout(), DUMP, CRASH_ID, 'upload_file_minidump') == b'abcd'
+
+    def test_dump_pointer_falls_back_to_hash_key(self):
+        # The dump isn't at the key in the pointer anymore, but it's at the key
+        # for its hash in the current layout
+        layout = build_layout(DUMP_HASH_KEY_TEMPLATE='{entropy}/v1/dump_by_hash/{sha256}')
+        conn = FakeConnection({
+            ('fakebucket', 'v1/dump/' + CRASH_ID): encode_dump_pointer('old/abcd', 'abcd', 4),
+            ('fakebucket', 'abc/v1/dump_by_hash/abcd'): b'abcd',
+        })
+        assert read_crash_file(conn, layout, DUMP, CRASH_ID, 'upload_file_minidump') == b'abcd'
+        assert conn.loaded[-2:] == [
+            ('fakebucket', 'old/abcd'), ('fakebucket', 'abc/v1/dump_by_hash/abcd')
+        ]
+
+    def test_missing(self):
+        conn = FakeConnection({})
+        assert read_crash_file(conn, build_layout(), RAW_CRASH, CRASH_ID) is None
+
+    def test_other_errors_raise(self):
+        class BrokenConnection:
+            buckets = ['fakebucket']
+
+            def load_file(self, path, bucket=None):
+                raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetObject')
+
+        with pytest.raises(ClientError):
+            read_crash_file(BrokenConnection(), build_layout(), RAW_CRASH, CRASH_ID)
@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import threading
+from unittest.mock import patch
+
+from everett.manager import ConfigManager
+import gevent
+import pytest
+
+from antenna.ext.segmentlog.crashstorage import SegmentLogCrashStorage
+from antenna.ext.segmentlog.segment import (
+    CorruptRecordError,
+    SegmentLogReader,
+    list_segments,
+    rebuild_index,
+)
+
+
+def build_storage(root, **extra):
+    config = {'FS_ROOT': root}
+    config.update(extra)
+    return SegmentLogCrashStorage(ConfigManager.from_dict(config))
+
+
+CRASH_IDS = ['de1bb258-cbbf-4589-a673-34f80016091%d' % i for i in range(5)]
+
+
+class TestSegmentLogCrashStorage:
+    def test_save_and_read(self, tmpdir, crash_report):
+        root = str(tmpdir)
+        storage = build_storage(root)
+        dumps = {'upload_file_minidump': b'abcd1234', 'memory_report': b'efgh'}
+        for crash_id in CRASH_IDS:
+            storage.save_crash(crash_report(crash_id, dumps=dumps))
+        storage.close()
+
+        assert len(list_segments(root)) == 1
+
+        reader = SegmentLogReader(root)
+        assert len(reader) == 5
+        raw_crash, dumps = reader.get_crash(CRASH_IDS[2])
+        assert raw_crash == {'ProductName': 'Firefox', 'uuid': CRASH_IDS[2]}
+        assert dumps == {'upload_file_minidump': b'abcd1234', 'memory_report': b'efgh'}
+
+        assert [crash_id for crash_id, raw_crash, dumps in reader.iter_crashes()] == CRASH_IDS
+
+        with pytest.raises(KeyError):
+            reader.get_crash('de1bb258-cbbf-4589-a673-34f800160919')
+
+    def test_threadpool(self, tmpdir, crash_report):
+        root = str(tmpdir)
+        storage = build_storage(root, FSYNC='true')
+        crash_ids = ['de1bb258-cbbf-4589-a673-34f8001609%02d' % i for i in range(20)]
+
+        fsync = os.fsync
+        fsync_threads = set()
+
+        def record_fsync(fd):
+            fsync_threads.add(threading.get_ident())
+            fsync(fd)
+
+        with patch('antenna.ext.segmentlog.crashstorage.os.fsync', side_effect=record_fsync):
+            gevent.joinall([
+                gevent.spawn(storage.save_crash, crash_report(crash_id))
+                for crash_id in crash_ids
+            ])
+        storage.close()
+
+        # Appends happened in the threadpool and none were interleaved
+        assert threading.get_ident() not in fsync_threads
+        reader = SegmentLogReader(root)
+        assert sorted(crash_id for crash_id, raw_crash, dumps in reader.iter_crashes()) == crash_ids
+
+    def test_rotation(self, tmpdir, crash_report):
+        root = str(tmpdir)
+        storage = build_storage(root, SEGMENT_MAX_SIZE='100')
+        for crash_id in CRASH_IDS:
+            storage.save_crash(crash_report(crash_id))
+        storage.close()
+
+        # Every record is bigger than 100 bytes, so each is in its own segment
+        assert len(list_segments(root)) == 5
+        reader = SegmentLogReader(root)
+        assert sorted(reader.index) == CRASH_IDS
+        assert reader.get_crash(CRASH_IDS[4])[0]['uuid'] == CRASH_IDS[4]
+
+    def test_partial_record(self, tmpdir, crash_report):
+        root = str(tmpdir)
+        storage = build_storage(root)
+        for crash_id in CRASH_IDS[:2]:
+            storage.save_crash(crash_report(crash_id))
+        segment = storage.segment
+        storage.close()
+
+        # Simulate dying while appending a record
+        with open(os.path.join(root, segment + '.log'), 'ab') as fp:
+            fp.write(b'ACR1' + CRASH_IDS[2].encode('ascii') + b'\x00\x00')
+
+        reader = SegmentLogReader(root)
+        assert [crash_id for crash_id, raw_crash, dumps in reader.iter_crashes()] == CRASH_IDS[:2]
+
+    def test_corrupt_record(self, tmpdir, crash_report):
+        root = str(tmpdir)
+        storage = build_storage(root)
+        storage.save_crash(crash_report())
+        segment = storage.segment
+        storage.close()
+
+        # Flip a byte in the payload
+        path = os.path.join(root, segment + '.log')
+        with open(path, 'r+b') as fp:
+            fp.seek(-1, os.SEEK_END)
+            last = fp.read(1)
+            fp.seek(-1, os.SEEK_END)
+            fp.write(bytes([last[0] ^ 0xff]))
+
+        reader = SegmentLogReader(root)
+        with pytest.raises(CorruptRecordError):
+            reader.get_crash('de1bb258-cbbf-4589-a673-34f800160918')
+
+
+class Test_rebuild_index:
+    def test_rebuild(self, tmpdir, crash_report):
+        root = str(tmpdir)
+        storage = build_storage(root)
+        for crash_id in CRASH_IDS:
+            storage.save_crash(crash_report(crash_id))
+        segment = storage.segment
+        storage.close()
+
+        # Lose the last index entries like when the process dies between
+        # appending the record and appending the index entry
+        index_path = os.path.join(root, segment + '.idx')
+        with open(index_path, 'r+b') as fp:
+            fp.truncate(os.path.getsize(index_path) - 50)
+        assert len(SegmentLogReader(root)) == 3
+
+        assert rebuild_index(root, segment) == 5
+        reader = SegmentLogReader(root)
+        assert sorted(reader.index) == CRASH_IDS
+        assert reader.get_crash(CRASH_IDS[4])[0]['uuid'] == CRASH_IDS[4]
@@ -0,0 +1,212 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+
+from everett.manager import ConfigManager
+import pytest
+
+from antenna import sharedcounters
+from antenna.sharedcounters import (
+    SharedCounters,
+    SharedCountersFullError,
+    SharedCountersLockTimeoutError,
+    create_shared_counters,
+    get_shared_counters,
+)
+from antenna.throttler import (
+    ACCEPT,
+    REJECT,
+    AdaptiveSample,
+    Equals,
+    RateLimit,
+    Rule,
+    Throttler,
+)
+
+
+def build_shared_counters(num_slots=64):
+    return SharedCounters(ConfigManager.from_dict({
+        'SHARED_COUNTERS_SLOTS': str(num_slots)
+    }))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSharedCounters:
+    def test_incr(self):
+        counters = build_shared_counters()
+        assert counters.get('foo') == 0
+        assert counters.incr('foo') == 1
+        assert counters.incr('foo', 5) == 6
+        assert counters.incr('bar') == 1
+        assert counters.get('foo') == 6
+        assert len(counters) == 2
+
+    def test_shared_with_forked_processes(self):
+        counters = build_shared_counters()
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for j in range(500):
+                        counters.incr('foo')
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        for pid in pids:
+            os.waitpid(pid, 0)
+        assert counters.get('foo') == 2000
+
+    def test_take_token(self):
+        counters = build_shared_counters()
+        assert [counters.take_token('foo', 2, 3, 1000.0) for i in range(4)] == [
+            True, True, True, False
+        ]
+
+        # Half a second adds one token
+        assert counters.take_token('foo', 2, 3, 1000.5)
+        assert not counters.take_token('foo', 2, 3, 1000.5)
+
+    def test_full(self):
+        counters = build_shared_counters(num_slots=2)
+        counters.incr('foo')
+        counters.incr('bar')
+        with pytest.raises(SharedCountersFullError):
+            counters.incr('baz')
+        with pytest.raises(SharedCountersFullError):
+            counters.take_token('baz', 1, 1, 1000.0)
+
+    def test_reuse_full_token_buckets(self):
+        counters = build_shared_counters(num_slots=2)
+        counters.incr('foo')
+        assert counters.take_token('bucket1', 1, 1, 1000.0)
+
+        # bucket1 is still refilling, so there's no slot for bucket2
+        with pytest.raises(SharedCountersFullError):
+            counters.take_token('bucket2', 1, 1, 1000.5)
+
+        # bucket1 is full again, so bucket2 takes its slot; counters are never
+        # reused
+        assert counters.take_token('bucket2', 1, 1, 1001.0)
+        assert counters.get('foo') == 1
+        assert len(counters) == 2
+
+    def test_lock_timeout(self, metricsmock):
+        counters = build_shared_counters()
+        counters.lock_timeout = 0.001
+
+        # Another process holding the lock (or dying while holding it) makes
+        # calls time out rather than block forever
+        counters.lock.acquire()
+        try:
+            with metricsmock as mm:
+                with pytest.raises(SharedCountersLockTimeoutError):
+                    counters.take_token('foo', 1, 1, 1000.0)
+                with pytest.raises(SharedCountersLockTimeoutError):
+                    counters.incr('foo')
+                assert mm.has_record(fun_name='incr', stat='sharedcounters.lock_timeout', value=1)
+        finally:
+            counters.lock.release()
+
+        assert counters.incr('foo') == 1
+
+    def test_create(self, monkeypatch):
+        monkeypatch.setattr(sharedcounters, '_shared_counters', None)
+        assert create_shared_counters(ConfigManager.from_dict({})).num_slots == 4096
+        assert get_shared_counters() is not None
+
+        create_shared_counters(ConfigManager.from_dict({'SHARED_COUNTERS_SLOTS': '0'}))
+        assert get_shared_counters() is None
+
+
+class TestThrottlerSharedCounters:
+    def build_throttler(self, monkeypatch, counters, result):
+        monkeypatch.setattr(sharedcounters, '_shared_counters', counters)
+        throttler = Throttler(ConfigManager.from_dict({
+            'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS'
+        }))
+        result.clock = FakeClock()
+        if isinstance(result, AdaptiveSample):
+            result.last_adjusted = result.clock.now
+        throttler.rule_set = [
+            Rule('is_firefox', 'ProductName', Equals('Firefox'), result)
+        ]
+        return throttler
+
+    def test_rate_limit(self, monkeypatch):
+        # Two throttlers with the same shared counters are like two workers
+        counters = build_shared_counters()
+        throttlers = [
+            self.build_throttler(monkeypatch, counters, RateLimit(rate=1, burst=3, keys=['BuildID']))
+            for i in range(2)
+        ]
+        crash = {'ProductName': 'Firefox', 'BuildID': '1'}
+        results = [throttlers[i % 2].throttle(crash)[0] for i in range(4)]
+        assert results == [ACCEPT, ACCEPT, ACCEPT, REJECT]
+
+        # Buckets are in the shared counters
+        assert len(throttlers[0].rule_set[0].result.buckets) == 0
+
+    def test_rate_limit_full(self, monkeypatch):
+        # With no slots left, buckets are kept in the process
+        counters = build_shared_counters(num_slots=1)
+        counters.incr('foo')
+        rate_limit = RateLimit(rate=1, keys=['BuildID'])
+        throttler = self.build_throttler(monkeypatch, counters, rate_limit)
+        crash = {'ProductName': 'Firefox', 'BuildID': '1'}
+        assert [throttler.throttle(crash)[0] for i in range(2)] == [ACCEPT, REJECT]
+        assert len(rate_limit.buckets) == 1
+
+    def test_rate_limit_lock_timeout(self, monkeypatch):
+        # When the lock times out, buckets are kept in the process
+        counters = build_shared_counters()
+        counters.lock_timeout = 0.001
+        rate_limit = RateLimit(rate=1, keys=['BuildID'])
+        throttler = self.build_throttler(monkeypatch, counters, rate_limit)
+        crash = {'ProductName': 'Firefox', 'BuildID': '1'}
+
+        counters.lock.acquire()
+        try:
+            assert [throttler.throttle(crash)[0] for i in range(2)] == [ACCEPT, REJECT]
+        finally:
+            counters.lock.release()
+        assert len(rate_limit.buckets) == 1
+
+    def test_adaptive_sample(self, monkeypatch):
+        counters = build_shared_counters()
+        samples = [AdaptiveSample(target_rate=5, smoothing=1) for i in range(2)]
+        throttlers = [
+            self.build_throttler(monkeypatch, counters, adaptive_sample)
+            for adaptive_sample in samples
+        ]
+
+        def send_crashes():
+            # Each process gets 50 crashes a second, so the node gets 100
+            for throttler in throttlers:
+                for i in range(500):
+                    throttler.throttle({'ProductName': 'Firefox'})
+            for throttler, adaptive_sample in zip(throttlers, samples):
+                adaptive_sample.clock.now += 10
+                throttler.hb_adjust_sampling()
+
+        # The first process to adjust only sees its own crashes; the second
+        # sees both
+        send_crashes()
+        assert [adaptive_sample.incoming_rate for adaptive_sample in samples] == [50, 100]
+
+        # After that, the first process sees the other's crashes a heartbeat
+        # late
+        send_crashes()
+        assert [adaptive_sample.incoming_rate for adaptive_sample in samples] == [100, 100]
+        assert [adaptive_sample.percentage for adaptive_sample in samples] == [5, 5]
+        assert counters.get('adaptive_sample:is_firefox') == 2000
@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import fcntl
+import os
+import time
+from unittest.mock import patch
+
+from everett.manager import ConfigManager
+import gevent
+
+from antenna.ext.crashstorage_base import CrashStorageBase
+from antenna.ext.storeforward.crashstorage import StoreAndForwardCrashStorage
+
+
+CRASH_ID = 'de1bb258-cbbf-4589-a673-34f800160918'
+
+
+class FakeRemoteCrashStorage(CrashStorageBase):
+    broken = False
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.saved_things = []
+
+    def save_crash(self, crash_report):
+        if self.broken:
+            raise Exception('remote is broken')
+        self.saved_things.append((crash_report.crash_id, crash_report.raw_crash, crash_report.dumps))
+
+
+def build_storage(spool_dir, **extra):
+    config = {
+        'SPOOL_DIR': spool_dir,
+        'REMOTE_CLASS': FakeRemoteCrashStorage.__module__ + '.' + FakeRemoteCrashStorage.__name__,
+        'RETRY_DELAY': '0.01',
+        'FSYNC': 'false',
+    }
+    config.update(extra)
+    return StoreAndForwardCrashStorage(ConfigManager.from_dict(config))
+
+
+def get_spooled(storage):
+    return [fn for fn in os.listdir(storage.spool_dir) if fn != 'lock']
+
+
+class TestStoreAndForwardCrashStorage:
+    def test_forward(self, tmpdir, metricsmock, crash_report):
+        spool_dir = str(tmpdir)
+        storage = build_storage(spool_dir)
+
+        with metricsmock as mm:
+            storage.save_crash(crash_report())
+            # The crash is spooled before it's forwarded
+            assert get_spooled(storage) == [CRASH_ID + '.crash']
+
+            storage.join_pool()
+            assert mm.has_record(stat='storeforward.forwarded.count')
+
+        assert storage.remote.saved_things == [
+            (CRASH_ID, {'ProductName': 'Firefox', 'uuid': CRASH_ID}, {'upload_file_minidump': b'abcd1234'})
+        ]
+        assert storage.publish.published_things == [{'crash_id': CRASH_ID}]
+        assert get_spooled(storage) == []
+
+    def test_threadpool(self, tmpdir, metricsmock, crash_report):
+        spool_dir = str(tmpdir)
+        storage = build_storage(spool_dir, FSYNC='true')
+
+        # Make fsyncs block for a while
+        fsync = os.fsync
+
+        def slow_fsync(fd):
+            time.sleep(0.05)
+            fsync(fd)
+
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(1)
+                gevent.sleep(0.01)
+
+        ticker = gevent.spawn(tick)
+        with metricsmock as mm:
+            with patch('antenna.ext.fs.crashstorage.os.fsync', side_effect=slow_fsync):
+                storage.save_crash(crash_report())
+            assert mm.has_record(stat='storeforward.threadpool.queue_wait')
+        ticker.kill()
+
+        # Other greenlets kept running while the crash was spooled
+        assert len(ticks) > 5
+        storage.join_pool()
+        assert get_spooled(storage) == []
+
+    def test_retry(self, tmpdir, crash_report):
+        spool_dir = str(tmpdir)
+        storage = build_storage(spool_dir)
+        storage.remote.broken = True
+
+        storage.save_crash(crash_report())
+        storage.join_pool()
+        assert get_spooled(storage) == [CRASH_ID + '.crash']
+        assert storage.get_spool_size() == 1
+
+        # The remote recovers and the retry forwards the crash
+        storage.remote.broken = False
+        gevent.sleep(0.2)
+        storage.join_pool()
+        assert [crash_id for crash_id, raw_crash, dumps in storage.remote.saved_things] == [CRASH_ID]
+        assert get_spooled(storage) == []
+        assert storage.get_spool_size() == 0
+
+    def test_resume_after_restart(self, tmpdir, crash_report):
+        spool_dir = str(tmpdir)
+        storage = build_storage(spool_dir)
+        storage.remote.broken = True
+        storage.save_crash(crash_report())
+        storage.join_pool()
+
+        # A partially spooled crash from when the process died
+        with open(os.path.join(storage.spool_dir, '.' + CRASH_ID + 'abcd'), 'wb') as fp:
+            fp.write(b'ACR1')
+
+        # The process dies which releases its lock; rename its spool directory
+        # so it looks like it had a different pid
+        fcntl.flock(storage.lock_fd, fcntl.LOCK_UN)
+        dead_spool_dir = os.path.join(spool_dir, '1')
+        os.rename(storage.spool_dir, dead_spool_dir)
+
+        # A new process claims the spooled crash
+        storage = build_storage(spool_dir)
+        assert list(storage.forward_queue) == [CRASH_ID]
+        assert not os.path.exists(dead_spool_dir)
+        storage.hb_run_forwarder()
+        storage.join_pool()
+        assert [crash_id for crash_id, raw_crash, dumps in storage.remote.saved_things] == [CRASH_ID]
+        assert get_spooled(storage) == []
+
+    def test_shared_spool_dir(self, tmpdir, crash_report):
+        # Two processes (workers) share a spool dir
+        spool_dir = str(tmpdir)
+        storage1 = build_storage(spool_dir)
+        storage1.remote.broken = True
+        storage1.save_crash(crash_report())
+        storage1.join_pool()
+
+        # storage1 is in the middle of spooling another crash
+        tmp_path = os.path.join(storage1.spool_dir, '.de1bb258-cbbf-4589-a673-34f800160919abcd')
+        with open(tmp_path, 'wb') as fp:
+            fp.write(b'ACR1')
+
+        # Starting storage2 leaves storage1's spool alone
+        storage2 = build_storage(spool_dir)
+        assert storage2.spool_dir != storage1.spool_dir
+        assert list(storage2.forward_queue) == []
+        assert os.path.exists(tmp_path)
+        assert CRASH_ID + '.crash' in get_spooled(storage1)
+
+        # storage2 saves and forwards its own crashes
+        storage2.save_crash(crash_report('de1bb258-cbbf-4589-a673-34f800160920'))
+        storage2.join_pool()
+        assert [crash_id for crash_id, raw_crash, dumps in storage2.remote.saved_things] == [
+            'de1bb258-cbbf-4589-a673-34f800160920'
+        ]
+        assert storage1.remote.saved_things == []
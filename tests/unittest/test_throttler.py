@@ -3,16 +3,30 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import logging
+import os
+import textwrap
 
 from everett.manager import ConfigManager
 import pytest
 
+from antenna.health_resource import HealthState
+
 from antenna.throttler import (
     ACCEPT,
+    DEFER,
     REJECT,
     FAKEACCEPT,
+    MOZILLA_RULES,
+    AdaptiveSample,
+    CompiledRuleSet,
+    Equals,
+    OneOf,
+    RateLimit,
     Rule,
+    RuleStats,
     Throttler,
+    always_match,
+    validate_rule_set,
     match_infobar_true,
 )
 
@@ -65,6 +79,500 @@ class TestRule:
             assert throttler.throttle({'ProductName': 'test'}) == (REJECT, 'test', 50)
 
 
+class TestCompiledRuleSet:
+    def first_match(self, throttler, rules, crash):
+        for rule in rules:
+            if rule.match(throttler, crash):
+                return rule
+        return None
+
+    def test_rule_order(self, throttler):
+        rules = [
+            Rule('is_nightly', 'ReleaseChannel', lambda throttler, x: x.startswith('nightly'), ACCEPT),
+            Rule('has_comments', 'Comments', always_match, ACCEPT),
+            Rule('is_beta', 'ReleaseChannel', Equals('beta'), DEFER),
+            Rule('is_firefox', 'ProductName', OneOf(['Firefox', 'Fennec']), REJECT),
+            Rule('is_release', 'ReleaseChannel', OneOf(['release', 'beta']), ACCEPT),
+            Rule('accept_everything', '*', always_match, ACCEPT),
+            Rule('unreachable', 'ProductName', Equals('Thunderbird'), REJECT),
+        ]
+        compiled = CompiledRuleSet(rules)
+
+        crashes = [
+            {},
+            {'ReleaseChannel': 'nightly'},
+            {'ReleaseChannel': 'beta', 'Comments': 'foo'},
+            {'ReleaseChannel': 'beta', 'ProductName': 'Firefox'},
+            {'ReleaseChannel': 'release', 'ProductName': 'Firefox'},
+            {'ReleaseChannel': 'release'},
+            {'ProductName': 'Thunderbird'},
+        ]
+        for crash in crashes:
+            assert compiled.match(throttler, crash) is self.first_match(throttler, rules, crash)
+
+    def test_no_match(self, throttler):
+        compiled = CompiledRuleSet([
+            Rule('is_beta', 'ReleaseChannel', Equals('beta'), ACCEPT),
+        ])
+        assert compiled.match(throttler, {'ReleaseChannel': 'release'}) is None
+        assert compiled.match(throttler, {}) is None
+
+    def test_unhashable_values(self, throttler):
+        compiled = CompiledRuleSet([
+            Rule('is_beta', 'ReleaseChannel', OneOf(['beta']), ACCEPT),
+        ])
+        assert compiled.match(throttler, {'ReleaseChannel': ['beta']}) is None
+        assert OneOf(['beta'])(throttler, ['beta']) is False
+
+    def test_mozilla_rules(self, throttler):
+        throttler.rule_set = MOZILLA_RULES
+        crashes = [
+            {'ProductName': 'Firefox', 'ReleaseChannel': 'release'},
+            {'ProductName': 'Firefox', 'ReleaseChannel': 'nightly'},
+            {'ProductName': 'Firefox', 'ReleaseChannel': 'beta', 'Throttleable': '0'},
+            {'ProductName': 'Firefox', 'Comments': 'foo'},
+            {'ProductName': 'Fennec', 'ReleaseChannel': 'esr'},
+            {'ProductName': 'B2G'},
+            {'ProductName': 'Foo', 'HangID': 'xyz'},
+            {},
+        ]
+        for crash in crashes:
+            expected = self.first_match(throttler, MOZILLA_RULES, crash)
+            assert throttler.compiled_rule_set.match(throttler, crash) is expected
+
+
+class TestRuleStats:
+    RULES = [
+        Rule('is_nightly', 'ReleaseChannel', lambda throttler, x: x == 'nightly', ACCEPT),
+        Rule('is_beta', 'ReleaseChannel', Equals('beta'), ACCEPT),
+        Rule('is_firefox', 'ProductName', lambda throttler, x: x == 'Firefox', ACCEPT),
+    ]
+
+    def build_throttler(self, profile_interval='1'):
+        throttler = Throttler(ConfigManager.from_dict({
+            'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS',
+            'THROTTLE_PROFILE_INTERVAL': profile_interval,
+        }))
+        throttler.rule_set = self.RULES
+        return throttler
+
+    def throttle_crashes(self, throttler):
+        throttler.throttle({'ReleaseChannel': 'nightly'})
+        throttler.throttle({'ReleaseChannel': 'beta'})
+        throttler.throttle({'ReleaseChannel': 'beta'})
+        throttler.throttle({'ProductName': 'Firefox'})
+        throttler.throttle({'ProductName': 'Thunderbird'})
+
+    def test_counts(self):
+        throttler = self.build_throttler()
+        self.throttle_crashes(throttler)
+
+        stats = throttler.rule_stats.get_stats()
+        assert (
+            [(item['rule'], item['evaluations'], item['matches']) for item in stats] ==
+            [('is_nightly', 5, 1), ('is_beta', 4, 2), ('is_firefox', 2, 1)]
+        )
+        assert all(item['time_ms'] >= 0 for item in stats)
+
+    def test_profile_interval(self):
+        rule_stats = RuleStats(self.RULES, 3)
+        assert [rule_stats.should_time() for i in range(6)] == [
+            False, False, True, False, False, True
+        ]
+
+        rule_stats = RuleStats(self.RULES, 0)
+        assert not any(rule_stats.should_time() for i in range(6))
+        rule_stats.add(0)
+        assert rule_stats.get_stats()[0]['time_ms'] is None
+
+    def test_flush(self, metricsmock):
+        throttler = self.build_throttler()
+        self.throttle_crashes(throttler)
+
+        with metricsmock as mm:
+            throttler.hb_report_rule_stats()
+            assert mm.has_record(
+                fun_name='incr', stat='throttler.rule.evaluations', value=4, tags=['rule:is_beta']
+            )
+            assert mm.has_record(
+                fun_name='incr', stat='throttler.rule.matches', value=2, tags=['rule:is_beta']
+            )
+            assert mm.has_record(fun_name='timing', stat='throttler.rule.evaluation_time')
+
+        # Only crashes since the last flush are sent
+        throttler.throttle({'ReleaseChannel': 'beta'})
+        stats = throttler.rule_stats.flush()
+        assert [item['evaluations'] for item in stats] == [1, 1, 0]
+        assert stats[2]['time_ms'] is None
+
+    def test_check_health(self):
+        throttler = self.build_throttler()
+        self.throttle_crashes(throttler)
+
+        state = HealthState()
+        throttler.check_health(state)
+        assert state.statsd['Throttler.rule.is_beta.evaluations'] == 4
+        assert state.statsd['Throttler.rule.is_beta.matches'] == 2
+        assert state.statsd['Throttler.rule.is_beta.time_ms'] >= 0
+
+
+RULES_MODULE = textwrap.dedent("""\
+    from antenna.throttler import ACCEPT, REJECT, Equals, Rule
+
+    rules = [
+        Rule('is_firefox', 'ProductName', Equals('Firefox'), %s),
+    ]
+""")
+
+
+class TestReloadRuleSet:
+    def write_rules(self, tmpdir, module_name, contents, mtime):
+        path = tmpdir.join(module_name + '.py')
+        path.write(contents)
+        os.utime(str(path), (mtime, mtime))
+
+    def build_throttler(self, tmpdir, monkeypatch, module_name):
+        self.write_rules(tmpdir, module_name, RULES_MODULE % 'ACCEPT', 1000)
+        monkeypatch.syspath_prepend(str(tmpdir))
+        return Throttler(ConfigManager.from_dict({
+            'THROTTLE_RULES': module_name + '.rules',
+            'THROTTLE_RULES_RELOAD': 'true',
+        }))
+
+    def test_reload(self, tmpdir, monkeypatch, metricsmock):
+        throttler = self.build_throttler(tmpdir, monkeypatch, 'reloadrules_a')
+        old_version = throttler.rule_set_version
+        assert throttler.throttle({'ProductName': 'Firefox'}) == (ACCEPT, 'is_firefox', 100)
+
+        # Nothing changed, so nothing happens
+        throttler.hb_reload_rule_set()
+        assert throttler.rule_set_version == old_version
+
+        self.write_rules(tmpdir, 'reloadrules_a', RULES_MODULE % 'REJECT', 2000)
+        with metricsmock as mm:
+            throttler.hb_reload_rule_set()
+            assert mm.has_record(stat='throttler.rule_set.reload', tags=['result:success'])
+
+            throttler.hb_report_rule_stats()
+            assert mm.has_record(
+                fun_name='gauge', stat='throttler.rule_set.version', value=throttler.rule_set_version
+            )
+
+        assert throttler.rule_set_version != old_version
+        assert throttler.throttle({'ProductName': 'Firefox'}) == (REJECT, 'is_firefox', 100)
+
+        state = HealthState()
+        throttler.check_health(state)
+        assert state.statsd['Throttler.rule_set.version'] == throttler.rule_set_version
+
+    @pytest.mark.parametrize('contents', [
+        # Syntax error
+        'rules = [',
+        # No rule set
+        'foo = []',
+        # Invalid rule set
+        'rules = ["foo"]',
+        # Invalid result
+        RULES_MODULE % '(200, ACCEPT, REJECT)',
+    ])
+    def test_reload_error(self, tmpdir, monkeypatch, metricsmock, contents):
+        module_name = 'reloadrules_%s' % abs(hash(contents))
+        throttler = self.build_throttler(tmpdir, monkeypatch, module_name)
+        old_version = throttler.rule_set_version
+
+        self.write_rules(tmpdir, module_name, contents, 2000)
+        with metricsmock as mm:
+            throttler.hb_reload_rule_set()
+            assert mm.has_record(stat='throttler.rule_set.reload', tags=['result:error'])
+
+        # Keeps using the old rule set
+        assert throttler.rule_set_version == old_version
+        assert throttler.throttle({'ProductName': 'Firefox'}) == (ACCEPT, 'is_firefox', 100)
+
+
+class TestHashSampling:
+    def build_throttler(self, sample_keys):
+        throttler = Throttler(ConfigManager.from_dict({
+            'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS',
+            'THROTTLE_SAMPLE_KEYS': sample_keys,
+        }))
+        throttler.rule_set = [
+            Rule('sample', '*', always_match, (10, ACCEPT, REJECT))
+        ]
+        return throttler
+
+    def test_same_crash_same_result(self, randommock):
+        throttler = self.build_throttler('InstallTime,BuildID')
+        crashes = [
+            {'InstallTime': str(i), 'BuildID': '20190701000000'} for i in range(1000)
+        ]
+        results = [throttler.throttle(crash)[0] for crash in crashes]
+
+        # Random numbers don't matter and a second throttler on another node
+        # gets the same results
+        with randommock(0.99):
+            other_throttler = self.build_throttler('InstallTime,BuildID')
+            assert [other_throttler.throttle(crash)[0] for crash in crashes] == results
+
+        # Roughly 10% are accepted
+        assert 50 < results.count(ACCEPT) < 150
+
+    def test_smaller_percentages_are_subsets(self):
+        throttler = self.build_throttler('uuid')
+        crashes = [{'uuid': 'de1bb258-cbbf-4589-a673-34f8%08d' % i} for i in range(1000)]
+        values = [throttler.get_sample_value(crash) for crash in crashes]
+        assert all(0 <= value < 100 for value in values)
+
+        at_10 = {i for i, value in enumerate(values) if value <= 10}
+        at_20 = {i for i, value in enumerate(values) if value <= 20}
+        assert at_10 < at_20
+
+    @pytest.mark.parametrize('sample_keys, crash', [
+        # Not hashing
+        ('', {'uuid': 'abc'}),
+        # Crash has none of the keys
+        ('uuid', {'ProductName': 'Firefox'}),
+    ])
+    def test_random(self, randommock, sample_keys, crash):
+        throttler = self.build_throttler(sample_keys)
+        with randommock(0.05):
+            assert throttler.throttle(crash)[0] == ACCEPT
+        with randommock(0.5):
+            assert throttler.throttle(crash)[0] == REJECT
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimit:
+    def build_throttler(self, rate_limit):
+        throttler = Throttler(ConfigManager.from_dict({
+            'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS'
+        }))
+        rate_limit.clock = FakeClock()
+        throttler.rule_set = [
+            Rule('limit_per_build', '*', always_match, rate_limit)
+        ]
+        return throttler
+
+    def test_bucket_per_key(self):
+        rate_limit = RateLimit(rate=2, keys=['ProductName', 'BuildID'])
+        throttler = self.build_throttler(rate_limit)
+
+        crash_a = {'ProductName': 'Firefox', 'BuildID': '1'}
+        crash_b = {'ProductName': 'Firefox', 'BuildID': '2'}
+        assert [throttler.throttle(crash_a)[0] for i in range(3)] == [ACCEPT, ACCEPT, REJECT]
+        assert throttler.throttle(crash_a) == (REJECT, 'limit_per_build', 100)
+
+        # Other builds have their own bucket
+        assert throttler.throttle(crash_b)[0] == ACCEPT
+        assert len(rate_limit.buckets) == 2
+
+    def test_refill(self):
+        rate_limit = RateLimit(rate=2, burst=4, keys=['ProductName'], overflow=DEFER)
+        throttler = self.build_throttler(rate_limit)
+        crash = {'ProductName': 'Firefox'}
+
+        assert [throttler.throttle(crash)[0] for i in range(5)] == [ACCEPT] * 4 + [DEFER]
+
+        # Half a second adds one token
+        rate_limit.clock.now += 0.5
+        assert [throttler.throttle(crash)[0] for i in range(2)] == [ACCEPT, DEFER]
+
+        # Buckets don't fill up past burst
+        rate_limit.clock.now += 60
+        assert [throttler.throttle(crash)[0] for i in range(5)] == [ACCEPT] * 4 + [DEFER]
+
+    def test_max_buckets(self):
+        rate_limit = RateLimit(rate=1, keys=['BuildID'], max_buckets=2)
+        throttler = self.build_throttler(rate_limit)
+        for build_id in ['1', '2', '3']:
+            throttler.throttle({'BuildID': build_id})
+        assert len(rate_limit.buckets) == 2
+
+        # Bucket for 1 was evicted, so it starts over
+        assert throttler.throttle({'BuildID': '1'})[0] == ACCEPT
+
+    def test_metrics(self, metricsmock):
+        rate_limit = RateLimit(rate=1, keys=['ProductName', 'BuildID'])
+        rate_limit.max_reported_buckets = 1
+        throttler = self.build_throttler(rate_limit)
+        for i in range(4):
+            throttler.throttle({'ProductName': 'Firefox', 'BuildID': '1'})
+        for i in range(2):
+            throttler.throttle({'ProductName': 'Firefox', 'BuildID': '2'})
+
+        state = HealthState()
+        throttler.check_health(state)
+        assert state.statsd['Throttler.rate_limit.limit_per_build.buckets'] == 2
+        assert state.statsd['Throttler.rate_limit.limit_per_build.limited'] == 4
+
+        with metricsmock as mm:
+            throttler.hb_report_rule_stats()
+            assert mm.has_record(
+                fun_name='incr', stat='throttler.rate_limit.limited', value=3,
+                tags=['rule:limit_per_build', 'bucket:Firefox/1']
+            )
+            assert mm.has_record(
+                fun_name='incr', stat='throttler.rate_limit.limited', value=1,
+                tags=['rule:limit_per_build', 'bucket:other']
+            )
+            assert mm.has_record(
+                fun_name='gauge', stat='throttler.rate_limit.buckets', value=2,
+                tags=['rule:limit_per_build']
+            )
+
+        assert rate_limit.flush_limited() == []
+
+    def test_new_rule_set_keeps_buckets(self):
+        rate_limit = RateLimit(rate=1, keys=['ProductName'])
+        throttler = self.build_throttler(rate_limit)
+        crash = {'ProductName': 'Firefox'}
+        assert [throttler.throttle(crash)[0] for i in range(2)] == [ACCEPT, REJECT]
+
+        # Same name and parameters keeps the empty bucket
+        same = RateLimit(rate=1, keys=['ProductName'])
+        same.clock = rate_limit.clock
+        throttler.rule_set = [Rule('limit_per_build', '*', always_match, same)]
+        assert throttler.throttle(crash)[0] == REJECT
+
+        # Different parameters start with a full bucket
+        changed = RateLimit(rate=2, keys=['ProductName'])
+        changed.clock = rate_limit.clock
+        throttler.rule_set = [Rule('limit_per_build', '*', always_match, changed)]
+        assert throttler.throttle(crash)[0] == ACCEPT
+
+    @pytest.mark.parametrize('kwargs', [
+        {'rate': 0, 'keys': ['BuildID']},
+        {'rate': 1, 'keys': []},
+        {'rate': 1, 'keys': 'BuildID'},
+        {'rate': 1, 'keys': ['BuildID'], 'burst': 0.5},
+        {'rate': 1, 'keys': ['BuildID'], 'overflow': ACCEPT},
+        {'rate': 1, 'keys': ['BuildID'], 'result': 10},
+    ])
+    def test_invalid(self, kwargs):
+        with pytest.raises(ValueError):
+            RateLimit(**kwargs)
+
+
+class TestAdaptiveSample:
+    def build_throttler(self, adaptive_sample):
+        throttler = Throttler(ConfigManager.from_dict({
+            'PRODUCTS': 'antenna.throttler.ALL_PRODUCTS'
+        }))
+        adaptive_sample.clock = FakeClock()
+        adaptive_sample.last_adjusted = adaptive_sample.clock.now
+        throttler.rule_set = [
+            Rule('is_firefox', 'ProductName', Equals('Firefox'), adaptive_sample)
+        ]
+        return throttler
+
+    def send_crashes(self, throttler, adaptive_sample, per_second):
+        """Throttle crashes for a 10 second heartbeat and adjust."""
+        for i in range(per_second * 10):
+            throttler.throttle({'ProductName': 'Firefox'})
+        adaptive_sample.clock.now += 10
+        throttler.hb_adjust_sampling()
+
+    def test_adjusts_to_target(self, randommock):
+        adaptive_sample = AdaptiveSample(target_rate=5, floor=1, ceiling=50)
+        throttler = self.build_throttler(adaptive_sample)
+        assert adaptive_sample.percentage == 1
+
+        # 100 crashes a second -> 5%
+        self.send_crashes(throttler, adaptive_sample, 100)
+        assert adaptive_sample.percentage == 5
+
+        # Volume doubles -> smoothed rate is 150/s for one heartbeat, then
+        # approaches 200/s
+        self.send_crashes(throttler, adaptive_sample, 200)
+        assert adaptive_sample.percentage == 3.33
+        self.send_crashes(throttler, adaptive_sample, 200)
+        assert adaptive_sample.percentage == 2.86
+
+        # Percentage is written as the throttle rate
+        with randommock(0.02):
+            assert throttler.throttle({'ProductName': 'Firefox'}) == (ACCEPT, 'is_firefox', 2.86)
+        with randommock(0.03):
+            assert throttler.throttle({'ProductName': 'Firefox'}) == (REJECT, 'is_firefox', 2.86)
+
+    def test_new_rule_set_keeps_percentage(self):
+        adaptive_sample = AdaptiveSample(target_rate=5, floor=1, ceiling=50)
+        throttler = self.build_throttler(adaptive_sample)
+        self.send_crashes(throttler, adaptive_sample, 100)
+        assert adaptive_sample.percentage == 5
+
+        # Same name and parameters keeps the percentage and smoothed rate
+        same = AdaptiveSample(target_rate=5, floor=1, ceiling=50)
+        same.clock = adaptive_sample.clock
+        throttler.rule_set = [Rule('is_firefox', 'ProductName', Equals('Firefox'), same)]
+        assert same.percentage == 5
+        self.send_crashes(throttler, same, 200)
+        assert same.percentage == 3.33
+
+        # Different parameters start over
+        changed = AdaptiveSample(target_rate=10, floor=1, ceiling=50)
+        throttler.rule_set = [Rule('is_firefox', 'ProductName', Equals('Firefox'), changed)]
+        assert changed.percentage == 1
+
+    def test_bounds(self):
+        adaptive_sample = AdaptiveSample(target_rate=5, floor=10, ceiling=50, smoothing=1)
+        throttler = self.build_throttler(adaptive_sample)
+
+        self.send_crashes(throttler, adaptive_sample, 1000)
+        assert adaptive_sample.percentage == 10
+
+        self.send_crashes(throttler, adaptive_sample, 1)
+        assert adaptive_sample.percentage == 50
+
+        self.send_crashes(throttler, adaptive_sample, 0)
+        assert adaptive_sample.percentage == 50
+
+    def test_metrics(self, metricsmock):
+        adaptive_sample = AdaptiveSample(target_rate=5)
+        throttler = self.build_throttler(adaptive_sample)
+        with metricsmock as mm:
+            self.send_crashes(throttler, adaptive_sample, 10)
+            assert mm.has_record(
+                fun_name='gauge', stat='throttler.adaptive_sample.percentage', value=50,
+                tags=['rule:is_firefox']
+            )
+            assert mm.has_record(
+                fun_name='gauge', stat='throttler.adaptive_sample.incoming_rate', value=10,
+                tags=['rule:is_firefox']
+            )
+
+        state = HealthState()
+        throttler.check_health(state)
+        assert state.statsd['Throttler.adaptive_sample.is_firefox.percentage'] == 50
+
+    @pytest.mark.parametrize('kwargs', [
+        {'target_rate': 0},
+        {'target_rate': 1, 'floor': 50, 'ceiling': 10},
+        {'target_rate': 1, 'ceiling': 200},
+        {'target_rate': 1, 'unsampled': 10},
+        {'target_rate': 1, 'smoothing': 0},
+    ])
+    def test_invalid(self, kwargs):
+        with pytest.raises(ValueError):
+            AdaptiveSample(**kwargs)
+
+
+class Test_validate_rule_set:
+    def test_valid(self):
+        validate_rule_set(MOZILLA_RULES)
+
+    @pytest.mark.parametrize('result', [5, (10, ACCEPT), (-1, ACCEPT, REJECT), (10, ACCEPT, 5)])
+    def test_invalid_result(self, result):
+        with pytest.raises(ValueError):
+            validate_rule_set([Rule('test', '*', always_match, result)])
+
+
 class TestACCEPT_ALL:
     def test_ruleset(self):
         throttler = Throttler(ConfigManager.from_dict({
@@ -8,6 +8,7 @@ from freezegun import freeze_time
 import pytest
 
 from antenna.util import (
+    LRUCache,
     MaxAttemptsError,
     create_crash_id,
     get_date_from_crash_id,
@@ -223,3 +224,18 @@ class Test_retry:
         with pytest.raises(Exception):
             some_thing()
         assert sleeps == [1, 1, 2, 2, 1, 1]
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache['a'] = 1
+        cache['b'] = 2
+
+        # Using "a" makes "b" the least recently used
+        assert cache['a'] == 1
+        cache['c'] = 3
+        assert 'b' not in cache
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert len(cache) == 2